@@ -1,20 +1,28 @@
 #!/usr/bin/env python3
 import argparse
 import base64
+import concurrent.futures
+import copy
 import fnmatch
+import hashlib
+import json
 import mimetypes
 import os
+import re
 import shutil
+import stat
 import subprocess
 import sys
 import textwrap
+import threading
 import time
 import urllib
 import gettext
+from html.parser import HTMLParser
 
 import netcache
 import offthemes
-from offutils import is_local, looks_like_base64, looks_like_url, run, term_width, xdg, _LOCALE_DIR, find_root, is_url_blocked, urlify, CMDS
+from offutils import atomic_open, sniff_image, sniff_mime, SNIFF_SIZE, get_file_mime, get_file_charset, set_file_charset, is_local, looks_like_base64, looks_like_url, run, term_width, xdg, _LOCALE_DIR, find_root, is_url_blocked, urlify, CMDS, span, traced
 
 gettext.bindtextdomain('offpunk', _LOCALE_DIR)
 gettext.textdomain('offpunk')
@@ -22,13 +30,26 @@ _ = gettext.gettext
 
 def load_READABILITY():
     global Document
+    global shorten_title
     try:
         from readability import Document
+        from readability.htmls import shorten_title
         _HAS_READABILITY = True
     except ModuleNotFoundError:
         _HAS_READABILITY = False
     return _HAS_READABILITY
 
+# lxml is faster than html.parser and already needed by readability
+def load_LXML():
+    global lxml
+    try:
+        import lxml.etree
+        import lxml.html
+        _HAS_LXML = True
+    except ModuleNotFoundError:
+        _HAS_LXML = False
+    return _HAS_LXML
+
 def load_HTML():
     try:
         # if bs4 version >= 4.11, we need to silent some xml warnings
@@ -83,6 +104,8 @@ def load_FEED():
     return _DO_FEED
 
 _RENDER_IMAGE = False
+# Versions of chafa and timg: images converted by another version are not reused
+_IMAGE_TOOLS_VERSIONS = []
 
 # All this code to know if we render image inline or not
 #Do we have chafa >= 1.10 ?
@@ -93,6 +116,7 @@ if CMDS["chafa"]:
     # check for m < 1.10
     try:
         output = run(CMDS["chafa"] + " --version")
+        _IMAGE_TOOLS_VERSIONS.append(output.split("\n")[0])
         chafa_major, chafa_minor, rest = output.split("\n")[0].split(" ")[-1].split(".")
         if int(chafa_major) >= 1 and int(chafa_minor) >= 10:
             _RENDER_IMAGE = True
@@ -105,42 +129,197 @@ if CMDS["timg"]:
     except subprocess.CalledProcessError:
         output = False
     # We don’t deal with timg before 1.3.2 (looping options)
+    if output:
+        _IMAGE_TOOLS_VERSIONS.append(output.split("\n")[0])
     if output and output[5:10] > "1.3.2":
         _RENDER_IMAGE = True
 if not _RENDER_IMAGE:
-    print(_("To render images inline, you need either chafa >= 1.10 or timg > 1.3.2"))
-
-# return ANSI text that can be show by less
-def inline_image(img_file, width):
-    # We don’t even try displaying pictures that are not there
-    if not os.path.exists(img_file):
-        return ""
-    # Chafa is faster than timg inline. Let use that one by default
-    # But we keep a list of "inlines" (possible commands to use)
-    # just in case chafa fails
+    print(_("To render images inline, you need either chafa >= 1.10 or timg > 1.3.2"),
+          file=sys.stderr)
+
+# Renderings can be kept on disk, in cache/rendered/, so that a page opened
+# in a new session doesn’t need to be rendered again (see _build_body_and_links)
+# The options of offpunk that change the rendering
+_RENDER_OPTIONS = ["preformat_wrap", "gemini_images", "images_size", "ftr_site_config"]
+# A new version of ansicat may render differently
+_ANSICAT_MTIME = os.path.getmtime(__file__)
+
+# Approximate memory used by documents parsed by BeautifulSoup, lxml and
+# feedparser (per character of the source) and by an operation of a PageModel
+# (see footprint(), measured with tracemalloc)
+_SOUP_FACTOR = 10
+_TREE_FACTOR = 3
+_FEED_FACTOR = 5
+_OP_SIZE = 150
+
+
+def _render_cache_path(key):
+    return os.path.join(xdg("cache"), "rendered", key[:2], key + ".json")
+
+
+# The renderings and images kept on disk are limited to this size (in bytes)
+_RENDER_CACHE_MAX_SIZE = 200 * 1000 * 1000
+
+
+# Remove the renderings and images which have not been used for max_age
+# seconds, then the least recently used until they fit in max_size bytes.
+# They are touched when read, so their mtime is their last use.
+def prune_render_cache(max_age=30 * 24 * 3600, max_size=_RENDER_CACHE_MAX_SIZE):
+    limit = time.time() - max_age
+    removed = 0
+    entries = []
+    for folder in ["rendered", "images"]:
+        for root, dirs, files in os.walk(os.path.join(xdg("cache"), folder)):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                    if st.st_mtime < limit:
+                        os.remove(path)
+                        removed += 1
+                    else:
+                        entries.append((st.st_mtime, st.st_size, path))
+                except OSError:
+                    pass
+    total = sum(size for mtime, size, path in entries)
+    entries.sort()
+    while entries and total > max_size:
+        mtime, size, path = entries.pop(0)
+        try:
+            os.remove(path)
+            removed += 1
+        except OSError:
+            pass
+        total -= size
+    return removed
+
+
+# Images converted to ANSI by chafa or timg are kept in cache/images/. The
+# key is the content of the image, the width and the commands used, so an
+# image is converted only once whatever the page and the session.
+# Conversions can be started in advance with prefetch_images(): they run in
+# parallel (the work is done by chafa or timg) and inline_image() waits for
+# them if needed.
+_IMAGE_WORKERS = max(2, min(os.cpu_count() or 1, 8))
+_IMAGE_POOL = None
+_IMAGE_JOBS = {}
+_IMAGE_LOCK = threading.Lock()
+# sha256 of the images, by (path, mtime, size)
+_IMAGE_DIGESTS = {}
+
+
+def _inline_commands():
     inlines = []
-    ansi_img = ""
-    # We avoid errors by not trying to render non-image files
-    if CMDS["file"]:
-        mime = run(CMDS["file"] + " -b --mime-type %s", parameter=img_file).strip()
-        if "image" not in mime:
-            return ansi_img
     if CMDS["chafa"]:
         # -O 0 remove optimisation and allows every line to be the same length
         inlines.append(CMDS["chafa"] + " -O 0 --bg white -t 1 -s %s -f symbols --animate=off")
     if CMDS["timg"]:
         inlines.append(CMDS["timg"] + " --frames=1 -p q -g %sx1000")
+    return inlines
+
+
+# Return the key of an image converted at width, None if it is not an image
+def _image_key(img_file, width):
+    try:
+        st = os.stat(img_file)
+    except OSError:
+        return None
+    stamp = (img_file, st.st_mtime_ns, st.st_size)
+    digest = _IMAGE_DIGESTS.get(stamp)
+    if digest is None:
+        with open(img_file, "rb") as f:
+            data = f.read()
+        # We avoid errors by not trying to render non-image files
+        if not sniff_image(data[:1024]):
+            digest = ""
+        else:
+            digest = hashlib.sha256(data).hexdigest()
+        _IMAGE_DIGESTS[stamp] = digest
+    if not digest:
+        return None
+    key = json.dumps([digest, width, _inline_commands(), _IMAGE_TOOLS_VERSIONS])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def _image_cache_path(key):
+    return os.path.join(xdg("cache"), "images", key[:2], key + ".ansi")
+
+
+def _convert_image(img_file, width, key):
+    # Chafa is faster than timg inline. Let use that one by default
+    # But we keep a list of "inlines" (possible commands to use)
+    # just in case chafa fails
+    inlines = _inline_commands()
+    ansi_img = ""
     image_success = False
     while not image_success and len(inlines) > 0:
         cmd = inlines.pop(0) % width + " %s"
         try:
-            ansi_img = run(cmd, parameter=img_file)
+            with span("image.convert"):
+                ansi_img = run(cmd, parameter=img_file)
             image_success = True
         except Exception as err:
             ansi_img = "***IMAGE ERROR***\n%s…\n…%s" % (str(err)[:50], str(err)[-50:])
+    if image_success:
+        path = _image_cache_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with atomic_open(path) as f:
+                f.write(ansi_img)
+        except OSError:
+            pass
     return ansi_img
 
 
+# Start the conversion of [(img_file, width),…] in the background
+def prefetch_images(images):
+    global _IMAGE_POOL
+    if not _RENDER_IMAGE:
+        return
+    for img_file, width in images:
+        key = _image_key(img_file, width)
+        if not key or os.path.exists(_image_cache_path(key)):
+            continue
+        with _IMAGE_LOCK:
+            if key in _IMAGE_JOBS:
+                continue
+            if _IMAGE_POOL is None:
+                _IMAGE_POOL = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=_IMAGE_WORKERS, thread_name_prefix="image")
+            job = _IMAGE_POOL.submit(_convert_image, img_file, width, key)
+            _IMAGE_JOBS[key] = job
+        # Once done, the image is read from the cache
+        job.add_done_callback(lambda job, key=key: _forget_image_job(key, job))
+
+
+def _forget_image_job(key, job):
+    with _IMAGE_LOCK:
+        if _IMAGE_JOBS.get(key) is job:
+            del _IMAGE_JOBS[key]
+
+
+# return ANSI text that can be show by less
+@traced("inline_image")
+def inline_image(img_file, width):
+    key = _image_key(img_file, width)
+    # We don’t even try displaying pictures that are not there
+    if not key:
+        return ""
+    path = _image_cache_path(key)
+    try:
+        with open(path) as f:
+            ansi_img = f.read()
+        os.utime(path)
+        return ansi_img
+    except OSError:
+        pass
+    with _IMAGE_LOCK:
+        job = _IMAGE_JOBS.pop(key, None)
+    if job:
+        return job.result()
+    return _convert_image(img_file, width, key)
+
+
 def terminal_image(img_file):
     # This code will try chafa first and, if it fails, try timg
     cmds = []
@@ -189,6 +368,86 @@ def get_gopher_mime(url):
         mime = "text/gopher"
     return mime
 
+
+# The width-independent model of a page, built once by a renderer (see
+# AbstractRenderer.model) and laid out at any width by a representation.
+# It is the list of what the renderer asks to the representation: texts,
+# blocks and images with their themes, indents and paragraphs.
+class PageModel:
+    def __init__(self, title=None, center=True, theme=None):
+        self.title = title
+        self.center = center
+        self.theme = theme if theme is not None else {}
+        # [(name of a representation method, its arguments),…]. They are
+        # only data, so that a model can be kept or saved.
+        self.ops = []
+        # (number of ops, footprint)
+        self.size = (0, 0)
+
+    def _op(name):
+        def op(self, *args, **kwargs):
+            self.ops.append((name, args, kwargs))
+        return op
+
+    newline = _op("newline")
+    newparagraph = _op("newparagraph")
+    add_space = _op("add_space")
+    add_text = _op("add_text")
+    add_block = _op("add_block")
+    center_line = _op("center_line")
+    startindent = _op("startindent")
+    endindent = _op("endindent")
+    open_color = _op("open_color")
+    close_color = _op("close_color")
+    close_theme = _op("close_theme")
+    close_all = _op("close_all")
+    # an image, converted to ANSI text by renderer.render_image(src, width)
+    add_image = _op("add_image")
+    # the image files to convert in advance (see prefetch_images)
+    prefetch = _op("prefetch")
+
+    # renderers choose a theme depending on the themes which are defined
+    def open_theme(self, element):
+        self.ops.append(("open_theme", (element,), {}))
+        return element in self.theme
+
+    # The model laid out in the representation r of renderer
+    def layout(self, r, renderer):
+        # an empty model (links_only modes) is not laid out at all
+        if not self.ops and not self.title:
+            return ""
+        for name, args, kwargs in self.ops:
+            if name == "add_image":
+                r.add_block(renderer.render_image(*args, width=r.width, **kwargs))
+            elif name == "prefetch":
+                size = renderer.image_size(r.width)
+                prefetch_images([(img, size) for img in args[0]])
+            else:
+                getattr(r, name)(*args, **kwargs)
+        return r.get_final()
+
+    # An approximation of the memory used by the model, in bytes
+    def footprint(self):
+        if self.size[0] != len(self.ops):
+            size = sys.getsizeof(self.ops)
+            for name, args, kwargs in self.ops:
+                size += _OP_SIZE + sum(sys.getsizeof(a) for a in args if isinstance(a, str))
+            self.size = (len(self.ops), size)
+        return self.size[1]
+
+    # The text of the page, without layout (to search it, for example)
+    def get_text(self):
+        text = [self.title + "\n"] if self.title else []
+        for name, args, kwargs in self.ops:
+            if name == "add_text":
+                text.append(args[0])
+            elif name == "add_block":
+                text.append("\n" + args[0])
+            elif name in ("newline", "newparagraph", "startindent", "endindent"):
+                text.append("\n")
+        return "".join(text)
+
+
 # First, we define the different content->text renderers, outside of the rest
 # (They could later be factorized in other files or replaced)
 class AbstractRenderer:
@@ -197,10 +456,21 @@ class AbstractRenderer:
         #base url is used to construct relative urls (see <base> in html)
         self.base = None
         self.body = str(content)
-        # there’s one rendered text and one links table per mode
+        # there’s one links table per mode and one rendered text per mode,
+        # with the layout it was done for (see _layout). Only the last layout
+        # is kept: with the model, a resized terminal only needs a new layout
         self.rendered_text = {}
         self.links = {}
         self.images = {}
+        # renderers of the parts in another format (see prepare), by format
+        # and digest of the content, kept to render them again at another width
+        self.subrenderers = {}
+        # models of the parts (see model), by mode, position, format and
+        # digest of the content. They are laid out again at another width.
+        self.models = {}
+        # by mode, the links looked up in the cache while rendering -> their
+        # cache mtime (see _renderings_valid)
+        self.lookups = {}
         self.title = None
         self.validity = True
         self.temp_files = {}
@@ -214,8 +484,84 @@ class AbstractRenderer:
         self.cleanlib = {} 
         #url redirections
         self.redirects = redirects
-
-    def display(self, mode=None, directdisplay=False):
+        # the file the content comes from, if any (see renderer_from_file)
+        # and its (mtime, size) when it was read
+        self.source_path = None
+        self.source_stamp = None
+        # if set, the rendered text is given to this function while rendering
+        self.stream = None
+
+    # The body is dropped by unload() and read again from its file when it
+    # is needed. If the file has changed, what was found in the previous
+    # version (title, links) is forgotten.
+    @property
+    def body(self):
+        if self._body is None:
+            try:
+                st = os.stat(self.source_path)
+                self._body = decode_file(self.source_path)
+            except OSError:
+                st = None
+                self._body = ""
+            if not st or (st.st_mtime_ns, st.st_size) != self.source_stamp:
+                self.title = None
+                self.links = {}
+                self.images = {}
+                self.cleanlib = {}
+        return self._body
+
+    @body.setter
+    def body(self, body):
+        self._body = body
+
+    # An approximation of the memory used by the renderer, in bytes. The
+    # renderers not used for a while are unloaded when they use too much
+    # (see openk.opencache)
+    def footprint(self):
+        size = sys.getsizeof(self._body) if self._body else 0
+        for layout, text in self.rendered_text.values():
+            size += sys.getsizeof(text)
+        for links in self.links.values():
+            size += sum(sys.getsizeof(l) for l in links)
+        for model, links in self.models.values():
+            size += model.footprint()
+        for renderer in self.subrenderers.values():
+            size += renderer.footprint()
+        return size
+
+    # Frees everything which can be built again: the body (if it can be read
+    # again from its file), the renderings and the models. The title and the
+    # links are kept, they are enough for most commands.
+    def unload(self):
+        if self.source_path and self.source_stamp and self._body != self.source_path:
+            self._body = None
+        self.rendered_text = {}
+        self.models = {}
+        self.subrenderers = {}
+        self.lookups = {}
+
+    # If stream is given, the text is also given to stream() as soon as it
+    # is rendered, so a long page can be displayed before the end of the
+    # rendering. The title is then without the number of links (not known yet)
+    def display(self, mode=None, directdisplay=False, stream=None):
+        if stream and mode != "source" and not is_local(self.url) \
+                and not self._has_body(mode):
+            wtitle = self.get_formatted_title(linksnbr=False)
+            stream(wtitle + "\n")
+            self.stream = stream
+            try:
+                body = wtitle + "\n" + self.get_body(mode=mode)
+            finally:
+                self.stream = None
+            if "linkmode" in self.options and self.options["linkmode"] == "end":
+                links = self.get_links(mode=mode)
+                for i in range(len(links)):
+                    stream("[%s] %s\n" % (i + 1, links[i]))
+                    body += "[%s] %s\n" % (i + 1, links[i])
+            return body
+        # The body first, as a rendering loaded from the disk also gives the title
+        if mode != "source":
+            self.get_body(mode=mode)
         wtitle = self.get_formatted_title()
         if mode == "source":
             body = self.body
@@ -227,6 +573,10 @@ class AbstractRenderer:
                     links = self.get_links(mode=mode)
                     for i in range(len(links)):
                         body += "[%s] %s\n" % (i + 1, links[i])
+        # already rendered (or loaded from the disk): given at once
+        if stream:
+            stream(body)
+            return body
         if directdisplay:
             print(body)
             return True
@@ -254,10 +604,16 @@ class AbstractRenderer:
 
     # This class hold an internal representation of the HTML text
     class representation:
-        def __init__(self, width, title=None, center=True, theme={},options={}):
+        def __init__(self, width, title=None, center=True, theme={},options={},
+                     stream=None):
             self.title = title
             self.center = center
-            self.final_text = ""
+            # The finished lines, joined only once in get_final()
+            self.final_text = []
+            # With stream, finished lines are given to stream() regularly
+            # and get_final() returns all of them
+            self.stream = stream
+            self.streamed = []
             self.opened = []
             self.width = width
             self.last_line = ""
@@ -273,6 +629,8 @@ class AbstractRenderer:
             self.theme = theme
             self.options = options
             self.colors = offthemes.colors
+            # ANSI sequences already computed for a list of [color, open/close]
+            self.sgr = {}
 
         def _insert(self, color, open=True):
             if open:
@@ -289,30 +647,41 @@ class AbstractRenderer:
             else:
                 self.last_line_colors[pos].append([color, o])  # +color+str(o))
 
+        def _ansicol(self, colors):
+            key = tuple((c, o) for c, o in colors)
+            ansicol = self.sgr.get(key)
+            if ansicol is None:
+                ansicol = "\x1b[" + ";".join(self.colors[c][o] for c, o in colors) + "m"
+                self.sgr[key] = ansicol
+            return ansicol
+
         # Take self.last line and add ANSI codes to it before adding it to
         # self.final_text.
         def _endline(self):
             if len(self.last_line.strip()) > 0:
                 for c in self.opened:
                     self._insert(c, open=False)
-                nextline = ""
+                line = self.last_line
+                end = len(line)
+                parts = []
                 added_char = 0
                 # we insert the color code at the saved positions
-                while len(self.last_line_colors) > 0:
-                    pos, colors = self.last_line_colors.popitem()
-                    # popitem iterates LIFO.
-                    # So we go, backward, to the pos (starting at the end of last_line)
-                    # but we only act if there are true colors at the position
+                # We go backward (LIFO, like popitem), to the pos (starting at
+                # the end of last_line) but we only act if there are true
+                # colors at the position
+                for pos in reversed(self.last_line_colors):
+                    colors = self.last_line_colors[pos]
                     if len(colors) > 0:
-                        nextline = self.last_line[pos:] + nextline
-                        ansicol = "\x1b["
-                        for c, o in colors:
-                            ansicol += self.colors[c][o] + ";"
-                        ansicol = ansicol[:-1] + "m"
-                        nextline = ansicol + nextline
+                        start = min(pos, end)
+                        parts.append(line[start:end])
+                        ansicol = self._ansicol(colors)
+                        parts.append(ansicol)
                         added_char += len(ansicol)
-                        self.last_line = self.last_line[:pos]
-                nextline = self.last_line + nextline
+                        end = start
+                self.last_line_colors = {}
+                parts.append(line[:end])
+                parts.reverse()
+                nextline = "".join(parts)
                 if self.last_line_center:
                     # we have to care about the ansi char while centering
                     width = term_width() + added_char
@@ -324,9 +693,11 @@ class AbstractRenderer:
                     # why it is there. Trying to replace it with a "rstrip"
                     nextline = self.current_indent + nextline.rstrip() + self.r_indent
                     self.current_indent = self.s_indent
-                self.final_text += nextline
+                self.final_text.append(nextline)
                 self.last_line = ""
-                self.final_text += "\n"
+                self.final_text.append("\n")
+                if self.stream and len(self.final_text) > 400:
+                    self._flush()
                 for c in self.opened:
                     self._insert(c, open=True)
             else:
@@ -411,7 +782,7 @@ class AbstractRenderer:
         def newparagraph(self, force=False):
             if force or not self.new_paragraph:
                 self._endline()
-                self.final_text += "\n"
+                self.final_text.append("\n")
                 self.new_paragraph = True
 
         def add_space(self):
@@ -458,7 +829,7 @@ class AbstractRenderer:
                 self.last_line += "\n"
             # one thing is sure : we need to keep unthemed blocks for images!
             else:
-                self.final_text += self.current_indent + intext
+                self.final_text.append(self.current_indent + intext)
                 self.new_paragraph = False
                 self._endline()
             self._enable_indents()
@@ -490,22 +861,50 @@ class AbstractRenderer:
             else:
                 self.last_line = last
 
+        def _margin(self):
+            termspace = shutil.get_terminal_size()[0]
+            # Following code insert blank spaces to center the content
+            if self.center and termspace > term_width():
+                return int((termspace - term_width()) // 2)
+            else:
+                return 0
+
+        # Give the finished lines to self.stream. The result, once joined,
+        # is exactly what get_final() would return without stream.
+        def _flush(self, final=False):
+            text = "".join(self.final_text)
+            self.final_text = []
+            if not final:
+                cut = text.rfind("\n") + 1
+                if text[cut:]:
+                    self.final_text.append(text[cut:])
+                text = text[:cut]
+            lines = text.splitlines()
+            if not lines:
+                return
+            margin = self._margin()
+            if margin:
+                lines = [margin * " " + l for l in lines]
+            chunk = "\n".join(lines)
+            # the newline is only added before the next lines
+            if self.streamed:
+                chunk = "\n" + chunk
+            self.streamed.append(chunk)
+            self.stream(chunk)
+
         def get_final(self):
             self.close_all()
             self._endline()
             # if no content, we still add the title
             self._title_first()
-            lines = self.final_text.splitlines()
-            lines2 = []
-            termspace = shutil.get_terminal_size()[0]
-            # Following code insert blank spaces to center the content
-            if self.center and termspace > term_width():
-                margin = int((termspace - term_width()) // 2)
-            else:
-                margin = 0
-            for l in lines:
-                lines2.append(margin * " " + l)
-            return "\n".join(lines2)
+            if self.stream:
+                self._flush(final=True)
+                return "".join(self.streamed)
+            lines = "".join(self.final_text).splitlines()
+            margin = self._margin()
+            if margin:
+                return "\n".join(margin * " " + l for l in lines)
+            return "\n".join(lines)
 
     def get_subscribe_links(self):
         return [[self.url, self.get_mime(), self.get_title()]]
@@ -547,16 +946,15 @@ class AbstractRenderer:
 
     def get_formatted_title(self,linksnbr=True):
         title = self.get_url_title()
-        nbr = len(self.get_links())
         if is_local(self.url):
-            title += " (%s items)" % nbr
+            title += " (%s items)" % len(self.get_links())
             str_last = "local file"
         else:
             str_last = "last accessed on %s" % time.ctime(
                 netcache.cache_last_modified(self.url)
             )
             if linksnbr:
-                title += " (%s links)" % nbr
+                title += " (%s links)" % len(self.get_links())
         return self._window_title(title, info=str_last)
 
     # this function is about creating a title derived from the URL
@@ -580,7 +978,7 @@ class AbstractRenderer:
         if mode not in self.images:
             self.get_body(mode=mode)
             # we also invalidate the body that was done without images
-            self.rendered_text.pop(mode)
+            self.rendered_text.pop(mode, None)
         if mode in self.images:
             return self.images[mode]
         else:
@@ -590,45 +988,217 @@ class AbstractRenderer:
     def prepare(self, body, mode=None):
         return [[body, None]]
 
+    # A rendering is kept on disk if the renderer comes from a file and the
+    # "render_cache" option is set. Its key is everything it depends on,
+    # except the cache of the links and images which is checked when loading.
+    def _render_cache_key(self, mode, width):
+        if not self.source_path or not self.options.get("render_cache"):
+            return None
+        try:
+            st = os.stat(self.source_path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        blocklist = getattr(self.redirects, "blocklist", None)
+        key = [
+            _ANSICAT_MTIME, type(self).__name__, self.url, self.source_path,
+            st.st_mtime_ns, st.st_size, mode, width, term_width(),
+            shutil.get_terminal_size()[0], self.center, _RENDER_IMAGE, self.theme,
+            getattr(self, "soup_parser", None),
+            [self.options.get(o) for o in _RENDER_OPTIONS],
+            sorted(self.redirects.items()) if self.redirects else None,
+            blocklist.digest() if blocklist else None,
+        ]
+        key = json.dumps(key, sort_keys=True, default=str)
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    # The key of a rendered text: its mode and the widths it depends on, the
+    # width of the text and the one of the terminal (to center it)
+    def _layout(self, mode, width=None):
+        return (mode, width or term_width(), term_width(), shutil.get_terminal_size()[0])
+
+    def _load_rendered(self, mode, key, width=None):
+        path = _render_cache_path(key)
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+        # A link or an image has been downloaded (or refreshed) since
+        with netcache.stat_cache():
+            for url, mtime in saved["lookups"].items():
+                if netcache.cache_last_modified(url) != mtime:
+                    return False
+        self.rendered_text[mode] = (self._layout(mode, width), saved["body"])
+        self.lookups[mode] = saved["lookups"]
+        self.links[mode] = saved["links"]
+        if saved["images"] is not None:
+            self.images[mode] = saved["images"]
+        if saved["cleanlib"]:
+            self.cleanlib[mode] = saved["cleanlib"]
+        if self.title is None:
+            self.title = saved["title"]
+        # Renderings not used for a while are removed by prune_render_cache
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return True
+
+    def _save_rendered(self, mode, key, lookups, width=None):
+        saved = {
+            "body": self.rendered_text[mode][1],
+            "links": self.links[mode],
+            "images": self.images.get(mode),
+            "cleanlib": self.cleanlib.get(mode),
+            "title": self.title,
+            "lookups": lookups,
+        }
+        path = _render_cache_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with atomic_open(path) as f:
+                json.dump(saved, f)
+        except OSError:
+            pass
+
+    # The text of mode if it is laid out for width, else None
+    def _rendered(self, mode, width=None):
+        layout, text = self.rendered_text.get(mode, (None, None))
+        if layout == self._layout(mode, width):
+            return text
+        return None
+
+    # True if the body is already rendered (or can be loaded from the disk)
+    def _has_body(self, mode, width=None):
+        if self._rendered(mode, width) is not None:
+            return True
+        key = self._render_cache_key(mode, width or term_width())
+        return bool(key) and self._load_rendered(mode, key, width)
+
     def _build_body_and_links(self, mode, width=None):
         if not width:
             width = term_width()
+        layout = self._layout(mode, width)
+        key = self._render_cache_key(mode, width)
+        if key and self._load_rendered(mode, key, width):
+            if self.stream:
+                self.stream(self.rendered_text[mode][1])
+            return
         prepared_bodies = self.prepare(self.body, mode=mode)
-        self.rendered_text[mode] = ""
-        self.links[mode] = []
-        for b in prepared_bodies:
-            results = None
-            size = len(self.links[mode])
-            if b[1] in _FORMAT_RENDERERS:
-                r = _FORMAT_RENDERERS[b[1]](b[0], self.url, center=self.center)
-                results = r.render(b[0], width=width, mode=mode, startlinks=size)
-            else:
-                results = self.render(b[0], width=width, mode=mode, startlinks=size)
-            if results:
-                self.rendered_text[mode] += results[0] + "\n"
-                # we should absolutize all URLs here
-                for l in results[1]:
-                    ll = l.split()
-                    if len(ll) > 0:
-                        try:
-                            abs_l = urllib.parse.urljoin(self.url, ll[0])
-                        except Exception:
-                            print(_(
-                                "Urljoin Error: Could not make an URL out of %s and %s"
-                                % (self.url, ll)
-                                ))
-                    else:
-                        abs_l = self.url
-                    self.links[mode].append(abs_l)
-                #for l in self.get_subscribe_links()[1:]:
-                #    self.links[mode].append(l[0])
+        keys = [(mode, i, b[1], hashlib.sha256(b[0].encode()).hexdigest())
+                for i, b in enumerate(prepared_bodies)]
+        if any(k not in self.models for k in keys):
+            # images are found again while building the models
+            self.images.pop(mode, None)
+            self.lookups.pop(mode, None)
+            for k in [k for k in self.models if k[0] == mode]:
+                self.models.pop(k)
+        rendered = []
+        # the links are only kept once the page is fully rendered: the
+        # rendering can be stopped by stream() (see openk.less_stream)
+        links = []
+        # The cache of every link is checked: list each folder only once
+        with netcache.stat_cache() as lookups:
+            for b, part in zip(prepared_bodies, keys):
+                results = None
+                size = len(links)
+                # what the renderer streamed itself (see representation)
+                streamed = []
+                stream = None
+                if self.stream:
+                    def stream(text, output=self.stream):
+                        streamed.append(text)
+                        output(text)
+                if b[1] in _FORMAT_RENDERERS:
+                    r = self.subrenderers.get(part[2:])
+                    if not r:
+                        r = _FORMAT_RENDERERS[b[1]](b[0], self.url, center=self.center)
+                        self.subrenderers[part[2:]] = r
+                    r.stream = stream
+                    try:
+                        results = self._render_part(r, part, b[0], width, size)
+                    finally:
+                        r.stream = None
+                else:
+                    previous, self.stream = self.stream, stream
+                    try:
+                        results = self._render_part(self, part, b[0], width, size)
+                    finally:
+                        self.stream = previous
+                if results:
+                    rendered.append(results[0] + "\n")
+                    if self.stream:
+                        self.stream(results[0][len("".join(streamed)):] + "\n")
+                    # we should absolutize all URLs here
+                    for l in results[1]:
+                        ll = l.split()
+                        if len(ll) > 0:
+                            try:
+                                abs_l = urllib.parse.urljoin(self.url, ll[0])
+                            except Exception:
+                                print(_(
+                                    "Urljoin Error: Could not make an URL out of %s and %s"
+                                    % (self.url, ll)
+                                    ))
+                        else:
+                            abs_l = self.url
+                        links.append(abs_l)
+                    #for l in self.get_subscribe_links()[1:]:
+                    #    self.links[mode].append(l[0])
+        self.links[mode] = links
+        self.rendered_text[mode] = (layout, "".join(rendered))
+        self.lookups.setdefault(mode, {}).update(lookups)
+        if key:
+            self._save_rendered(mode, key, lookups, width)
+
+    # False if a link has been downloaded (or refreshed) since the mode was
+    # rendered: it may be displayed differently (as a new link, an image…)
+    def _renderings_valid(self, mode):
+        with netcache.stat_cache():
+            for url, mtime in self.lookups.get(mode, {}).items():
+                if netcache.cache_last_modified(url) != mtime:
+                    return False
+        return True
+
+    def _forget_renderings(self, mode):
+        self.rendered_text.pop(mode, None)
+        for k in [k for k in self.models if k[0] == mode]:
+            self.models.pop(k)
+        self.images.pop(mode, None)
+        self.lookups.pop(mode, None)
+
+    # A part of the page rendered by renderer, from its model if it has one
+    def _render_part(self, renderer, part, body, width, startlinks):
+        mode = part[0]
+        if part not in self.models:
+            self.models[part] = renderer.model(body, mode=mode, startlinks=startlinks)
+        model = self.models[part]
+        if model:
+            return renderer.layout(model[0], width), model[1]
+        return renderer.render(body, width=width, mode=mode, startlinks=startlinks)
+
+    # Image width is set in the option to 40 by default
+    # it cannot be bigger than the width of the text
+    def image_size(self, width):
+        if "images_size" in self.options.keys() and width and \
+                            width > self.options["images_size"] :
+            return self.options["images_size"]
+        return width
 
     def get_body(self, width=None, mode=None):
         if not mode:
             mode = self.last_mode
-        if mode not in self.rendered_text:
+        # Renderers of local pages (lists) are kept while their links are
+        # downloaded (see openk.opencache)
+        if is_local(self.url) and not self._renderings_valid(mode):
+            self._forget_renderings(mode)
+        text = self._rendered(mode, width)
+        if text is None:
             self._build_body_and_links(mode, width)
-        return self.rendered_text[mode]
+            text = self.rendered_text[mode][1]
+        return text
 
     def get_links(self, mode=None):
         if not mode:
@@ -648,9 +1218,12 @@ class AbstractRenderer:
             title_r.close_theme("window_subtitle")
         return title_r.get_final()
 
-    # An instance of AbstractRenderer should have a 
-    # self.render(body,width=,mode=,startlinks=0) method.
-    # It returns a tuple (rendered_body,[list of links])
+    # An instance of AbstractRenderer should have a
+    # self.model(body,mode=,startlinks=0) method.
+    # It returns a tuple (PageModel,[list of links]), the model being laid out
+    # at each width by self.layout(). Renderers without a model (images) have
+    # a self.render(body,width=,mode=,startlinks=0) method instead, returning
+    # a tuple (rendered_body,[list of links])
     # 3 modes are used : readable (by default), full and links_only (the fastest, when
     # rendered content is not used, only the links are needed)
     # The prepare() function is called before the rendering. It is useful if
@@ -659,6 +1232,23 @@ class AbstractRenderer:
     # format should be in _FORMAT_RENDERERS. If None, current renderer is used
 
 
+    def model(self, body, mode=None, startlinks=0):
+        return None
+
+    def layout(self, model, width=None):
+        r = self.representation(width or term_width(), title=model.title, center=model.center,
+                                theme=self.theme, options=self.options, stream=self.stream)
+        return model.layout(r, self)
+
+    # An image of the model (see PageModel.add_image) as ANSI text
+    def render_image(self, src, width=None, mode=None):
+        return ""
+
+    def render(self, body, width=None, mode=None, startlinks=0):
+        model, links = self.model(body, mode=mode, startlinks=startlinks)
+        return self.layout(model, width), links
+
+
 # A renderer for format that are not supported
 class FakeRenderer(AbstractRenderer):
     def set_mime(self,mime):
@@ -679,7 +1269,8 @@ class FakeRenderer(AbstractRenderer):
         gemtext += "File %s is of format %s.\n"%(self.get_title(),self.mime)
         gemtext += "It cannot be rendered in your terminal.\n"
         gemtext += "Use \"open\" to open the file using an external handler"
-        r = self.representation(width, theme=self.theme,options=self.options)
+        r = self.representation(width, theme=self.theme,options=self.options,
+                                stream=self.stream)
         for line in gemtext.splitlines():
             r.newline()
             if len(line.strip()) == 0:
@@ -711,8 +1302,8 @@ class PlaintextRenderer(AbstractRenderer):
         else:
             return "(unknown)"
 
-    def render(self, gemtext, width=None, mode=None, startlinks=0):
-        r = self.representation(width, theme=self.theme,options=self.options)
+    def model(self, gemtext, mode=None, startlinks=0):
+        r = PageModel(theme=self.theme)
         links = []
         for line in gemtext.splitlines():
             r.newline()
@@ -725,7 +1316,7 @@ class PlaintextRenderer(AbstractRenderer):
                         if "://" in w and looks_like_url(w):
                             links.append(w)
                 r.add_text(line)
-        return r.get_final(), links
+        return r, links
 
 
 # Gemtext Rendering Engine
@@ -756,14 +1347,28 @@ class GemtextRenderer(AbstractRenderer):
         else:
             return "(unknown)"
 
+    # The image a link points to (src is its absolute URL)
+    def render_image(self, src, width=None, mode=None):
+        ansi_img = ""
+        try:
+            # 4 followings line are there to translate the URL into cache path
+            img = netcache.get_cache_path(src)
+            renderer = ImageRenderer(img, src)
+            size = self.image_size(width)
+            ansi_img += renderer.get_body(width=size, mode="inline")
+        except Exception:
+            # we sometimes encounter really bad formatted files or URL
+            # we fall back to normal links in that case
+            pass
+        return ansi_img
+
     # render_gemtext
-    def render(self, gemtext, width=None, mode=None, startlinks=0):
-        if not width:
-            width = term_width()
-        r = self.representation(width, theme=self.theme,options=self.options)
+    def model(self, gemtext, mode=None, startlinks=0):
+        r = PageModel(theme=self.theme)
         links = []
         hidden_links = []
         preformatted = False
+        current_modif = netcache.cache_last_modified(self.url)
 
         def format_link(url, index, name=None):
             if "://" in url:
@@ -779,6 +1384,22 @@ class GemtextRenderer(AbstractRenderer):
             line = "[%d%s] %s" % (index, protocol, name)
             return line
 
+        # images are converted in parallel while the page is rendered
+        if (
+            _RENDER_IMAGE
+            and not self.url.startswith("list://")
+            and self.options.get("gemini_images")
+        ):
+            images = []
+            for line in gemtext.splitlines():
+                if line.startswith("=>"):
+                    splitted = line[2:].split(maxsplit=1)
+                    if splitted and splitted[0][-4:].lower() in [".jpg",".png",".gif","jpeg"]:
+                        abs_url = urllib.parse.urljoin(self.url, splitted[0])
+                        if netcache.is_cache_valid(abs_url):
+                            images.append(netcache.get_cache_path(abs_url))
+            r.prefetch(images)
+
         for line in gemtext.splitlines():
             r.newline()
             if line.startswith("```"):
@@ -806,10 +1427,8 @@ class GemtextRenderer(AbstractRenderer):
                     link = format_link(url, len(links) + startlinks, name=name)
                     # If the link point to a page that has been cached less than
                     # 600 seconds after this page, we consider it as a new_link
-                    current_modif = netcache.cache_last_modified(self.url)
-                    link_modif = netcache.cache_last_modified(url)
+                    link_modif = netcache.cache_last_modified(abs_url)
                     # Let’s see first if this is a picture
-                    image_displayed = False
                     if (
                         _RENDER_IMAGE
                         and not self.url.startswith("list://")
@@ -821,25 +1440,7 @@ class GemtextRenderer(AbstractRenderer):
                         and url[-4:].lower() in [".jpg",".png",".gif","jpeg"] 
                         and netcache.is_cache_valid(abs_url)
                     ):
-                        ansi_img = ""
-                        try:
-                            # 4 followings line are there to translate the URL into cache path
-                            img = netcache.get_cache_path(abs_url)
-                            renderer = ImageRenderer(img, abs_url)
-                            # Image width is set in the option to 40 by default
-                            # it cannot be bigger than the width of the text
-                            if "images_size" in self.options.keys() and width and \
-                                                width > self.options["images_size"] :
-                                size = self.options["images_size"]
-                            else:
-                                size = width
-                            ansi_img += renderer.get_body(width=size, mode="inline")
-                            image_displayed = True
-                        except Exception as err:
-                            # we sometimes encounter really bad formatted files or URL
-                            # we fall back to normal links in that case
-                            image_displayed = False
-                        r.add_block(ansi_img)
+                        r.add_image(abs_url)
                         r.open_theme("image_link")
                         r.center_line()
                         theme = "image_link"
@@ -906,7 +1507,7 @@ class GemtextRenderer(AbstractRenderer):
                             hidden_links.append(w)
                 r.add_text(line.rstrip())
         links += hidden_links
-        return r.get_final(), links
+        return r, links
 
 
 class EmptyRenderer(GemtextRenderer):
@@ -934,27 +1535,21 @@ class GopherRenderer(AbstractRenderer):
         return self.title
 
     # menu_or_text
-    def render(self, body, width=None, mode=None, startlinks=0):
-        if not width:
-            width = term_width()
+    def model(self, body, mode=None, startlinks=0):
         try:
-            render, links = self._render_goph(
-                body, width=width, mode=mode, startlinks=startlinks
-            )
+            r, links = self._render_goph(body, mode=mode, startlinks=startlinks)
         except Exception as err:
             print(_("Error rendering Gopher "), err)
-            r = self.representation(width, theme=self.theme,options=self.options)
+            r = PageModel(theme=self.theme)
             r.add_block(body)
-            render = r.get_final()
             links = []
-        return render, links
+        return r, links
 
-    def _render_goph(self, body, width=None, mode=None, startlinks=0):
-        if not width:
-            width = term_width()
+    def _render_goph(self, body, mode=None, startlinks=0):
         # This was copied straight from Agena (then later adapted)
         links = []
-        r = self.representation(width, theme=self.theme,options=self.options)
+        current_modif = netcache.cache_last_modified(self.url)
+        r = PageModel(theme=self.theme)
         for line in self.body.split("\n"):
             r.newline()
             if line.startswith("i"):
@@ -997,7 +1592,6 @@ class GopherRenderer(AbstractRenderer):
                         towrap = "[%s%s] " % (str(number), protocol) + name
                         # If the link point to a page that has been cached less than
                         # 600 seconds after this page, we consider it as a new_link
-                        current_modif = netcache.cache_last_modified(self.url)
                         link_modif = netcache.cache_last_modified(url)
                         if (
                             current_modif
@@ -1015,7 +1609,77 @@ class GopherRenderer(AbstractRenderer):
                         r.close_theme(theme)
                 else:
                     r.add_text(line)
-        return r.get_final(), links
+        return r, links
+
+
+# The status, title and number of items of a list, as FolderRenderer shows it
+def _summarize_list(path, stamp):
+    first_line = None
+    items = 0
+    preformatted = False
+    for i, line in enumerate(decode_file(path).splitlines()):
+        if i == 0 and line.startswith("#"):
+            first_line = line.strip()
+        # the links, as GemtextRenderer finds them: the "=>" lines and the
+        # URLs in the text
+        if line.startswith("```"):
+            preformatted = not preformatted
+        elif preformatted:
+            pass
+        elif line.startswith("=>"):
+            if line[2:].strip():
+                items += 1
+        elif "://" in line and not line.startswith(("* ", ">", "#")):
+            items += sum(1 for w in line.split() if "://" in w and looks_like_url(w))
+    return {
+        "stamp": stamp,
+        "title": first_line,
+        "subscribed": bool(first_line and "#subscribed" in first_line),
+        "frozen": bool(first_line and "#frozen" in first_line),
+        "items": items,
+    }
+
+
+# The summary of each list of listdir, by name. Summaries are kept in the
+# cache (lists.json) with the mtime and size of their list, which is only
+# read again when it has been modified.
+def list_summary(listdir):
+    path = os.path.join(xdg("cache"), "lists.json")
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        saved = {}
+    summary = {}
+    changed = False
+    names = os.listdir(listdir) if os.path.isdir(listdir) else []
+    for name in names:
+        #We only take gmi files
+        if not name.endswith(".gmi"):
+            continue
+        listpath = os.path.join(listdir, name)
+        try:
+            st = os.stat(listpath)
+            stamp = [st.st_mtime_ns, st.st_size]
+            entry = saved.get(listpath)
+            if not entry or entry["stamp"] != stamp:
+                entry = _summarize_list(listpath, stamp)
+                changed = True
+        except OSError:
+            continue
+        # removing the .gmi at the end of the name
+        summary[name[:-4]] = entry
+    # the summaries of the deleted lists are forgotten
+    others = {k: v for k, v in saved.items() if os.path.dirname(k) != listdir}
+    if changed or len(others) + len(summary) != len(saved):
+        others.update((os.path.join(listdir, name + ".gmi"), entry)
+                      for name, entry in summary.items())
+        try:
+            with atomic_open(path) as f:
+                json.dump(others, f)
+        except OSError:
+            pass
+    return summary
 
 
 class FolderRenderer(GemtextRenderer):
@@ -1029,38 +1693,21 @@ class FolderRenderer(GemtextRenderer):
         return "Directory"
 
     def prepare(self, body, mode=None):
-        def get_first_line(l):
-            path = os.path.join(listdir, l + ".gmi")
-            with open(path) as f:
-                first_line = f.readline().strip()
-                f.close()
-            if first_line.startswith("#"):
-                return first_line
-            else:
-                return None
-
         def write_list(l):
             body = ""
             for li in l:
                 #making sure we don’t write ".gmi"
                 if l != "":
                     path = "list:///%s" % li
-                    r = renderer_from_file(netcache.get_cache_path(path))
-                    size = len(r.get_links())
+                    size = summary[li]["items"]
                     body += "=> %s %s (%s items)\n" % (str(path), li, size)
             return body
 
         listdir = os.path.join(self.datadir, "lists")
         self.title = "My lists"
-        lists = []
-        if os.path.exists(listdir):
-            listfiles = os.listdir(listdir)
-            if len(listfiles) > 0:
-                for l in listfiles:
-                    #We only take gmi files
-                    if l.endswith(".gmi"):
-                        # removing the .gmi at the end of the name
-                        lists.append(l[:-4])
+        # the lists are only read if they have been modified
+        summary = list_summary(listdir)
+        lists = list(summary)
         if len(lists) > 0:
             body = ""
             my_lists = []
@@ -1073,10 +1720,9 @@ class FolderRenderer(GemtextRenderer):
                 if l in ["history", "to_fetch", "archives", "tour"]:
                     system_lists.append(l)
                 elif l != "":
-                    first_line = get_first_line(l)
-                    if first_line and "#subscribed" in first_line:
+                    if summary[l]["subscribed"]:
                         subscriptions.append(l)
-                    elif first_line and "#frozen" in first_line:
+                    elif summary[l]["frozen"]:
                         frozen.append(l)
                     else:
                         my_lists.append(l)
@@ -1099,10 +1745,26 @@ class FeedRenderer(GemtextRenderer):
     def get_mime(self):
         return "application/rss+xml"
 
+    def footprint(self):
+        size = super().footprint()
+        if getattr(self, "parsed", None):
+            size += len(self.parsed[0]) * _FEED_FACTOR
+        return size
+
+    def unload(self):
+        super().unload()
+        self.parsed = None
+
+    # The feed is parsed only once, whatever the mode and the width
+    def parse(self, content):
+        if not getattr(self, "parsed", None) or self.parsed[0] != content:
+            self.parsed = (content, feedparser.parse(content))
+        return self.parsed[1]
+
     def is_valid(self):
         if load_FEED():
             try:
-                parsed = feedparser.parse(self.body)
+                parsed = self.parse(self.body)
             except Exception:
                 parsed = False
         else:
@@ -1135,7 +1797,7 @@ class FeedRenderer(GemtextRenderer):
         toreturn = []
         page = ""
         if load_FEED():
-            parsed = feedparser.parse(content)
+            parsed = self.parse(content)
         else:
             page += "Please install python-feedparser to handle RSS/Atom feeds\n"
             self.validity = False
@@ -1264,23 +1926,243 @@ class ImageRenderer(AbstractRenderer):
             terminal_image(self.body)
             return True
 
+# When only the links of a page are needed, we don’t build a soup but a
+# minimal tree (tags, attributes and the place of strings) exactly like
+# BeautifulSoup does with the events of its parser. _LinksParser gets them
+# from html.parser like the "html.parser" builder of bs4 (tags are never
+# closed implicitly, empty elements are closed at once…) and
+# _LxmlLinksParser from lxml like the "lxml" builder. That way, links are
+# found in the same elements as when rendering.
+class _LinksTree:
+    class Element:
+        __slots__ = ("name", "attrs", "children")
+
+        def __init__(self, name, attrs):
+            self.name = name
+            self.attrs = attrs
+            # strings are None
+            self.children = []
+
+        def get(self, key):
+            return self.attrs.get(key)
+
+        # Same as bool(element.string) in BeautifulSoup
+        def has_string(self):
+            element = self
+            while len(element.children) == 1:
+                element = element.children[0]
+                if element is None:
+                    return True
+            return False
+
+        def find(self, name):
+            for child in self.children:
+                if child is not None:
+                    if child.name == name:
+                        return child
+                    found = child.find(name)
+                    if found:
+                        return found
+            return None
+
+    def __init__(self):
+        self.root = self.Element("[document]", {})
+        self.stack = [self.root]
+        self.open_tags = {}
+        self.text = False
+
+    def end_text(self):
+        if self.text:
+            self.stack[-1].children.append(None)
+            self.text = False
+
+    def start_element(self, tag, attrs):
+        self.end_text()
+        element = self.Element(tag, attrs)
+        self.stack[-1].children.append(element)
+        self.stack.append(element)
+        self.open_tags[tag] = self.open_tags.get(tag, 0) + 1
+
+    # closes the last open tag with this name (and all tags opened after it)
+    def end_element(self, tag):
+        self.end_text()
+        if self.open_tags.get(tag):
+            while True:
+                element = self.stack.pop()
+                self.open_tags[element.name] -= 1
+                if element.name == tag:
+                    break
+
+    # Comments, doctypes, CDATA… are strings of their own
+    def add_string(self):
+        self.end_text()
+        self.stack[-1].children.append(None)
+
+
+# With tree=False, only <base> and <link> tags are looked for.
+class _LinksParser(_LinksTree, HTMLParser):
+    EMPTY_ELEMENTS = ["area", "base", "basefont", "bgsound", "br", "col", "command",
+                      "embed", "frame", "hr", "image", "img", "input", "isindex", "keygen",
+                      "link", "menuitem", "meta", "nextid", "param", "source", "spacer",
+                      "track", "wbr"]
+
+    def __init__(self, tree=True):
+        _LinksTree.__init__(self)
+        HTMLParser.__init__(self, convert_charrefs=False)
+        self.tree = tree
+        self.already_closed = []
+        self.base = None
+        self.feeds = []
+
+    @classmethod
+    def parse(cls, body, tree=True):
+        parser = cls(tree=tree)
+        parser.feed(body)
+        parser.close()
+        parser.end_text()
+        return parser
+
+    def handle_starttag(self, tag, attrs, empty=True):
+        attributes = {}
+        for key, value in attrs:
+            attributes[key] = "" if value is None else value
+        if tag == "base" and self.base is None:
+            self.base = attributes
+        elif tag == "link" and "alternate" in attributes.get("rel", "").split():
+            self.feeds.append(attributes)
+        if self.tree:
+            self.start_element(tag, attributes)
+            if empty and tag in self.EMPTY_ELEMENTS:
+                self.handle_endtag(tag, check_already_closed=False)
+                self.already_closed.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs, empty=False)
+        self.handle_endtag(tag, check_already_closed=False)
+
+    def handle_endtag(self, tag, check_already_closed=True):
+        if not self.tree:
+            return
+        if check_already_closed and tag in self.already_closed:
+            self.already_closed.remove(tag)
+        else:
+            self.end_element(tag)
+
+    def handle_data(self, data):
+        self.text = True
+
+    def handle_charref(self, name):
+        self.text = True
+
+    def handle_entityref(self, name):
+        self.text = True
+
+    def handle_comment(self, data):
+        if self.tree:
+            self.add_string()
+
+    handle_decl = handle_comment
+    unknown_decl = handle_comment
+    handle_pi = handle_comment
+
+
+# A "target" for the lxml parser
+class _LxmlLinksParser(_LinksTree):
+    @classmethod
+    def parse(cls, body):
+        target = cls()
+        if body.startswith("\ufeff"):
+            body = body[1:]
+        parser = lxml.etree.HTMLParser(target=target, recover=True)
+        try:
+            parser.feed(body)
+            parser.close()
+        except lxml.etree.ParserError:
+            # empty document
+            pass
+        target.end_text()
+        return target
+
+    def start(self, tag, attrib, nsmap=None):
+        self.start_element(tag, dict(attrib))
+
+    def end(self, tag):
+        self.end_element(tag)
+
+    def data(self, data):
+        self.text = True
+
+    def comment(self, text):
+        self.add_string()
+
+    def pi(self, target, data=None):
+        self.add_string()
+
+    def doctype(self, *args):
+        self.add_string()
+
+    def close(self):
+        pass
+
+
 class HtmlRenderer(AbstractRenderer):
     def __init__(self, content, url, center=True,redirects={},**kwargs):
         super().__init__(content, url, center=True,redirects={},**kwargs)
         self.DO_HTML = load_HTML()
         self.HAS_READABILITY = load_READABILITY()
+        self.HAS_LXML = load_LXML()
+        # BeautifulSoup is faster with lxml
+        self.soup_parser = "lxml" if self.HAS_LXML else "html.parser"
         self.soup = None
+        self.tree = None
+        # readability and unmerdify are slow: their result is kept
+        self.summary = None
+
+    def footprint(self):
+        size = super().footprint()
+        if self.soup:
+            size += len(self._body or "") * _SOUP_FACTOR
+        if self.tree is not None:
+            size += len(self._body or "") * _TREE_FACTOR
+        if self.summary:
+            size += sys.getsizeof(self.summary[1])
+            if self.summary[3] is not None:
+                size += len(self.summary[1]) * _SOUP_FACTOR
+        return size
+
+    def unload(self):
+        super().unload()
+        self.soup = None
+        self.tree = None
+        self.summary = None
 
     #This method build the "soup" document only once to be reused later
     #This is the full HTML
     def has_soup(self):
         if not self.soup and self.DO_HTML and self.body:
-            self.soup = BeautifulSoup(self.body, "html.parser")
+            with span("html.soup"):
+                self.soup = BeautifulSoup(self.body, self.soup_parser)
         if self.soup:
             return True
         else: 
             return False
 
+    # The full HTML parsed by lxml, only once. It is used for the title,
+    # <base> and feeds and readability works on a copy of it (it is
+    # parsed exactly like readability would do).
+    def get_tree(self):
+        if self.tree is None and self.HAS_LXML and self.body:
+            with span("html.tree"):
+                try:
+                    parser = lxml.html.HTMLParser(encoding="utf-8")
+                    self.tree = lxml.html.document_fromstring(
+                        self.body.encode("utf-8", "replace"), parser=parser)
+                except Exception:
+                    self.tree = False
+        if self.tree is False:
+            return None
+        return self.tree
+
     def get_mime(self):
         return "text/html"
 
@@ -1293,9 +2175,14 @@ class HtmlRenderer(AbstractRenderer):
 
     def get_subscribe_links(self):
         subs = []
-        if self.has_soup() :
+        tree = self.get_tree()
+        if tree is not None or self.has_soup():
             subs = [[self.url, self.get_mime(), self.get_title()]]
-            links = self.soup.find_all("link", rel="alternate", recursive=True)
+            if tree is not None:
+                links = [l for l in tree.iter("link")
+                         if "alternate" in l.get("rel", "").split()]
+            else:
+                links = self.soup.find_all("link", rel="alternate", recursive=True)
             for l in links:
                 ty = l.get("type")
                 if ty:
@@ -1311,8 +2198,12 @@ class HtmlRenderer(AbstractRenderer):
         elif self.DO_HTML and self.body:
             if self.HAS_READABILITY:
                 try:
-                    readable = Document(self.body)
-                    self.title = readable.short_title()
+                    with span("html.title"):
+                        tree = self.get_tree()
+                        if tree is not None:
+                            self.title = shorten_title(tree)
+                        else:
+                            self.title = Document(self.body).short_title()
                     return self.title
                 except Exception:
                     pass
@@ -1326,7 +2217,14 @@ class HtmlRenderer(AbstractRenderer):
 
     def get_base_url(self):
         if not self.base :
-            if self.has_soup():
+            tree = self.get_tree()
+            if tree is not None:
+                base = tree.find(".//base")
+                if base is not None:
+                    self.base = urllib.parse.urljoin(self.url, base.get("href"))
+                else:
+                    self.base = self.url
+            elif self.has_soup():
                 if self.soup.base :
                     base = self.soup.base.get("href")
                     self.base = urllib.parse.urljoin(self.url,base)
@@ -1338,58 +2236,21 @@ class HtmlRenderer(AbstractRenderer):
     # Our own HTML engine (crazy, isn’t it?)
     # Return [rendered_body, list_of_links]
     # mode is either links_only, readable or full
-    def render(self, body, mode=None, width=None, add_title=True, startlinks=0):
+    def model(self, body, mode=None, add_title=True, startlinks=0):
         if not mode:
             mode = self.last_mode
-        if not width:
-            width = term_width()
         if not self.DO_HTML:
             print(
                 _("HTML document detected. Please install python-bs4 and python-readability.")
             )
-            return
+            return PageModel(), []
         # This method recursively parse the HTML
-        r = self.representation(
-            width, title=self.get_title(), center=self.center, theme=self.theme
-            ,options=self.options)
+        r = PageModel(title=self.get_title(), center=self.center, theme=self.theme)
         links = []
         # You know how bad html is when you realize that space sometimes meaningful, sometimes not.
         # CR are not meaningful. Except that, sometimes, they should be interpreted as spaces.
         # HTML is real crap. At least the one people are generating.
 
-        def render_image(src, width=None, mode=None):
-            ansi_img = ""
-            imgurl, imgdata = looks_like_base64(src, self.get_base_url())
-            if (
-                _RENDER_IMAGE
-                and mode not in ["full_links_only", "links_only"]
-                and imgurl
-            ):
-                try:
-                    # 4 followings line are there to translate the URL into cache path
-                    img = netcache.get_cache_path(imgurl)
-                    if imgdata:
-                        os.makedirs(os.path.dirname(img), exist_ok=True)
-                        with open(img, "wb") as cached:
-                            cached.write(base64.b64decode(imgdata))
-                            cached.close()
-                    if netcache.is_cache_valid(img):
-                        renderer = ImageRenderer(img, imgurl)
-                        # Image width is set in the option to 40 by default
-                        # it cannot be bigger than the width of the text
-                        if "images_size" in self.options.keys() and width and \
-                                            width > self.options["images_size"] :
-                            size = self.options["images_size"]
-                        else:
-                            size = width
-                        ansi_img = "\n" + renderer.get_body(width=size, mode="inline")
-                except Exception as err:
-                    # we sometimes encounter really bad formatted files or URL
-                    ansi_img = (
-                        textwrap.fill("[BAD IMG] %s - %s" % (err, src), width) + "\n"
-                    )
-            return ansi_img
-
         def sanitize_string(string):
             # never start with a "\n"
             # string = string.lstrip("\n")
@@ -1501,20 +2362,9 @@ class HtmlRenderer(AbstractRenderer):
                     for child in element.children:
                         if child.name == "img":
                             recursive_render(child)
-                            display_this_picture = True
                             normal_link = False
-                            #print( "%s same as previous link %s ?"%(link,str(links[-1])))
-                    # we check if the link is the same as the image itself
-                    # if so, it is the last link in the links list
-                    # We will not display the link if it is the same or if
-                    # pointing to a blocked URL
-                    abs_url = urllib.parse.urljoin(self.get_base_url(),link)
-                    if not normal_link and len(links) > 0:
-                        last_link = links[-1].split()
-                        if len(last_link) > 0:
-                            different_urls = abs_url != last_link[0]
-                            blocked = is_url_blocked(abs_url,self.redirects)
-                            display_this_picture = different_urls and not blocked
+                    if not normal_link:
+                        display_this_picture = self._show_image_link(link, links)
                     if display_this_picture:
                         imgtext = "[IMG LINK %s]"
                     if display_this_picture or normal_link:
@@ -1540,80 +2390,30 @@ class HtmlRenderer(AbstractRenderer):
                     for child in element.children:
                         recursive_render(child, preformatted=preformatted)
             elif element.name == "img":
-                src = element.get("src")
-                text = ""
-                alt = element.get("alt")
-                if alt:
-                    alt = sanitize_string(alt)
-                    text += "[IMG] %s" % alt
-                else:
-                    text += "[IMG]"
-                if src:
-                    if mode not in self.images:
-                        self.images[mode] = []
-                    abs_url, data = looks_like_base64(src, self.get_base_url())
-                    # if abs_url is None, it means we don’t support
-                    # the image (such as svg+xml). So we hide it.
-                    # But we first check if there’s a data-src
-                    if not abs_url:
-                        src = element.get("data-src")
-                        abs_url, data = looks_like_base64(src,self.get_base_url())
-                    # Do not even try to show IMG from blocked URL
-                    if abs_url and not is_url_blocked(abs_url,self.redirects):
-                        ansi_img = render_image(src, width=width, mode=mode)
-                        abs_url = urlify(abs_url)
-                        links.append(abs_url + " " + text)
-                        self.images[mode].append(abs_url)
-                        link_id = " [%s]" % (len(links) + startlinks)
-                        r.add_block(ansi_img)
-                        r.open_theme("image_link")
-                        r.center_line()
-                        r.add_text(text + link_id)
-                        r.close_theme("image_link")
-                        r.newline()
+                image = self._html_image(element, mode, sanitize_string)
+                if image:
+                    src, abs_url, text = image
+                    links.append(abs_url + " " + text)
+                    link_id = " [%s]" % (len(links) + startlinks)
+                    r.add_image(src, mode=mode)
+                    r.open_theme("image_link")
+                    r.center_line()
+                    r.add_text(text + link_id)
+                    r.close_theme("image_link")
+                    r.newline()
 
             elif element.name == "video":
-                poster = element.get("poster")
-                src = element.get("src")
-                for child in element.children:
-                    if not src:
-                        if child.name == "source":
-                            src = child.get("src")
-                text = ""
-                if poster:
-                    ansi_img = render_image(poster, width=width, mode=mode)
-                alt = element.get("alt")
-                if alt:
-                    alt = sanitize_string(alt)
-                    text += "[VIDEO] %s" % alt
-                else:
-                    text += "[VIDEO]"
-
+                poster, link, text = self._html_video(element, mode, sanitize_string)
                 if poster:
-                    if mode not in self.images:
-                        self.images[mode] = []
-                    poster_url, d = looks_like_base64(poster, self.get_base_url())
-                    if poster_url:
-                        vid_url, d2 = looks_like_base64(src, self.get_base_url())
-                        self.images[mode].append(poster_url)
-                        r.add_block(ansi_img)
-                        r.open_theme("image_link")
-                        r.center_line()
-                        if vid_url and src:
-                            links.append(vid_url + " " + text)
-                            link_id = " [%s]" % (len(links) + startlinks)
-                            r.add_text(text + link_id)
-                        else:
-                            r.add_text(text)
-                        r.close_theme("image_link")
-                        r.newline()
-                elif src:
-                    vid_url, d = looks_like_base64(src, self.get_base_url())
-                    links.append(vid_url + " " + text)
-                    link_id = " [%s]" % (len(links) + startlinks)
+                    r.add_image(poster, mode=mode)
+                if poster or link:
                     r.open_theme("image_link")
                     r.center_line()
-                    r.add_text(text + link_id)
+                    if link:
+                        links.append(link)
+                        r.add_text(text + " [%s]" % (len(links) + startlinks))
+                    else:
+                        r.add_text(text)
                     r.close_theme("image_link")
                     r.newline()
 
@@ -1643,6 +2443,7 @@ class HtmlRenderer(AbstractRenderer):
         # the real render_html hearth
         # We will transform the body into a "summary" (clean-up version)
         summary = None
+        cleaned = False
         self.cleanlib[mode] = ""
         #If domain is whitelisted, we don’t clean anything
         domain = urllib.parse.urlparse(self.url).netloc.removeprefix("www.")
@@ -1653,15 +2454,21 @@ class HtmlRenderer(AbstractRenderer):
         elif mode in ["full", "full_links_only"]:
             summary = body
             self.cleanlib[mode] += _("Full as requested")
+        # the page was already cleaned (for another width or mode)
+        elif self.summary and self.summary[0] == body:
+            summary = self.summary[1]
+            self.cleanlib[mode] += self.summary[2]
         # let’s try unmerdify but only for non-local pages
         elif not is_local(self.url) and load_UNMERDIFY(self.options):
+            cleaned = True
             ftr = ftr_site_config=self.options["ftr_site_config"]
             # we want to unmerdify only if there’s a rule
             if unmerdify.is_unmerdifiable(self.url,ftr):
                 ftr_config = unmerdify.get_config_file_for_url(self.url,ftr)
                 try:
-                    summary = unmerdify.unmerdify_html(body,url=self.url,\
-                            ftr_site_config=ftr,NOCONF_FAIL=False)
+                    with span("html.unmerdify"):
+                        summary = unmerdify.unmerdify_html(body,url=self.url,\
+                                ftr_site_config=ftr,NOCONF_FAIL=False)
                 except Exception as e:
                     self.cleanlib[mode] += _("Unmerdify CRASH with %s "%ftr_config) + "- %s - "%e
                 if not summary:
@@ -1669,11 +2476,18 @@ class HtmlRenderer(AbstractRenderer):
                 else:
                     self.cleanlib[mode] += _("Unmerdify with %s "%ftr_config)
         if not summary:
+            cleaned = True
             # if no summary from unmerdify, we try readability
             if self.HAS_READABILITY:
                 try:
-                    readable = Document(body)
-                    summary = readable.summary()
+                    with span("html.readability"):
+                        # readability changes the tree it is given
+                        tree = self.get_tree() if body == self.body else None
+                        if tree is not None:
+                            readable = Document(copy.deepcopy(tree))
+                        else:
+                            readable = Document(body)
+                        summary = readable.summary()
                     self.cleanlib[mode] += _("Readability")
                 except Exception as e:
                     summary = body
@@ -1681,12 +2495,32 @@ class HtmlRenderer(AbstractRenderer):
             else:
                 summary = body
                 self.cleanlib[mode] += _("Full (No readability installed)")
-        soup = BeautifulSoup(summary, "html.parser")
+        if cleaned:
+            # [page, summary, cleanlib, soup of the summary]
+            self.summary = [body, summary, self.cleanlib[mode], None]
+        if mode in ["links_only", "full_links_only"]:
+            with span("html.links"):
+                return PageModel(), self.render_links(summary, mode, sanitize_string)
+        # the full page and its summary are only parsed once
+        if summary == self.body and self.has_soup():
+            soup = self.soup
+        elif self.summary and summary is self.summary[1]:
+            if self.summary[3] is None:
+                with span("html.soup"):
+                    self.summary[3] = BeautifulSoup(summary, self.soup_parser)
+            soup = self.summary[3]
+        else:
+            with span("html.soup"):
+                soup = BeautifulSoup(summary, self.soup_parser)
+        if soup and _RENDER_IMAGE:
+            images = self.soup_images(soup)
+            r.prefetch(images)
         if soup:
-            if soup.body:
-                recursive_render(soup.body)
-            else:
-                recursive_render(soup)
+            with span("html.layout"):
+                if soup.body:
+                    recursive_render(soup.body)
+                else:
+                    recursive_render(soup)
         # inserting available feeds at the end of the page (if any)
         sublinks = self.get_subscribe_links()
         if len(sublinks) > 1:
@@ -1695,20 +2529,216 @@ class HtmlRenderer(AbstractRenderer):
             r.add_text("Available feeds: ")
             r.close_theme("subtitle")
             r.newparagraph()
-        for s in sublinks[1:]:
-            title = str(s[2])
-            mime = str(s[1])
-            # we remove the "application/" part of the mime
-            if "/" in mime: mime = mime.split("/")[1]
-            text = title + " (%s)"%mime
-            url = str(s[0])
+        for url, text in self._feed_links(sublinks[1:]):
             links.append(url + " " + text)
             link_id = str(len(links) + startlinks)
             r.open_theme("link")
             r.add_text("%s [%s]" %(text,link_id))
             r.close_theme("link")
             r.newline()
-        return r.get_final(), links
+        return r, links
+
+    # The links and images are found the same way by model() and by
+    # render_links(), so that links have the same numbers in every mode.
+
+    # An <img>: (src, url, text) if it is displayed, its URL is then one of
+    # the images of mode
+    def _html_image(self, element, mode, sanitize_string):
+        src = element.get("src")
+        alt = element.get("alt")
+        if alt:
+            text = "[IMG] %s" % sanitize_string(alt)
+        else:
+            text = "[IMG]"
+        if not src:
+            return None
+        if mode not in self.images:
+            self.images[mode] = []
+        abs_url, data = looks_like_base64(src, self.get_base_url())
+        # if abs_url is None, it means we don’t support
+        # the image (such as svg+xml). So we hide it.
+        # But we first check if there’s a data-src
+        if not abs_url:
+            src = element.get("data-src")
+            abs_url, data = looks_like_base64(src, self.get_base_url())
+        # Do not even try to show IMG from blocked URL
+        if not abs_url or is_url_blocked(abs_url, self.redirects):
+            return None
+        abs_url = urlify(abs_url)
+        self.images[mode].append(abs_url)
+        return src, abs_url, text
+
+    # A link around an image is not displayed if it is the same as the image
+    # itself (the last link in links) or if it points to a blocked URL
+    def _show_image_link(self, link, links):
+        if links:
+            last_link = links[-1].split()
+            if last_link:
+                abs_url = urllib.parse.urljoin(self.get_base_url(), link)
+                return abs_url != last_link[0] and not is_url_blocked(abs_url, self.redirects)
+        return True
+
+    # A <video>: (poster, link, text). poster is the src of its image (which
+    # is then one of the images of mode), link the "url text" of the video.
+    def _html_video(self, element, mode, sanitize_string):
+        poster = element.get("poster")
+        src = element.get("src")
+        for child in element.children:
+            if not src and child is not None and child.name == "source":
+                src = child.get("src")
+        alt = element.get("alt")
+        if alt:
+            text = "[VIDEO] %s" % sanitize_string(alt)
+        else:
+            text = "[VIDEO]"
+        if poster:
+            if mode not in self.images:
+                self.images[mode] = []
+            poster_url, d = looks_like_base64(poster, self.get_base_url())
+            if not poster_url:
+                return None, None, text
+            self.images[mode].append(poster_url)
+            vid_url, d = looks_like_base64(src, self.get_base_url())
+            if vid_url and src:
+                return poster, vid_url + " " + text, text
+            return poster, None, text
+        elif src:
+            vid_url, d = looks_like_base64(src, self.get_base_url())
+            return None, "%s %s" % (vid_url, text), text
+        return None, None, text
+
+    # The feeds of the page as (url, text), text being the title and the
+    # type of the feed
+    def _feed_links(self, sublinks):
+        for s in sublinks:
+            mime = str(s[1])
+            # we remove the "application/" part of the mime
+            if "/" in mime:
+                mime = mime.split("/")[1]
+            yield str(s[0]), "%s (%s)" % (s[2], mime)
+
+    # An <img> or the poster of a <video>, by its src (which may be a data:
+    # URL), as ANSI text
+    def render_image(self, src, width=None, mode=None):
+        ansi_img = ""
+        imgurl, imgdata = looks_like_base64(src, self.get_base_url())
+        if (
+            _RENDER_IMAGE
+            and mode not in ["full_links_only", "links_only"]
+            and imgurl
+        ):
+            try:
+                # 4 followings line are there to translate the URL into cache path
+                img = netcache.get_cache_path(imgurl)
+                if imgdata:
+                    os.makedirs(os.path.dirname(img), exist_ok=True)
+                    with open(img, "wb") as cached:
+                        cached.write(base64.b64decode(imgdata))
+                        cached.close()
+                if netcache.is_cache_valid(img):
+                    renderer = ImageRenderer(img, imgurl)
+                    size = self.image_size(width)
+                    ansi_img = "\n" + renderer.get_body(width=size, mode="inline")
+            except Exception as err:
+                # we sometimes encounter really bad formatted files or URL
+                ansi_img = (
+                    textwrap.fill("[BAD IMG] %s - %s" % (err, src), width) + "\n"
+                )
+        return ansi_img
+
+    # Images of the page are converted in parallel while it is laid out
+    # (see render_image())
+    def soup_images(self, soup):
+        images = []
+        for element in soup.find_all(["img", "video"]):
+            src = element.get("poster" if element.name == "video" else "src")
+            if not src:
+                continue
+            imgurl, imgdata = looks_like_base64(src, self.get_base_url())
+            if imgurl and not imgdata and not is_url_blocked(imgurl, self.redirects):
+                img = netcache.get_cache_path(imgurl)
+                if netcache.is_cache_valid(img):
+                    images.append(img)
+        return images
+
+    # The links found by render() in links_only modes but without the soup
+    # and the layout: the tree of _LinksParser is walked following the same
+    # rules as recursive_render(). Links must be in the same order.
+    def render_links(self, summary, mode, sanitize_string):
+        links = []
+        if self.HAS_LXML:
+            page = _LxmlLinksParser.parse(summary)
+        else:
+            page = _LinksParser.parse(summary)
+        # base and feeds come from the full page
+        if self.soup or not self.body or self.get_tree() is not None:
+            sublinks = self.get_subscribe_links()[1:]
+        else:
+            if isinstance(page, _LinksParser) and summary == self.body:
+                head = page
+            else:
+                head = _LinksParser.parse(self.body, tree=False)
+            if not self.base:
+                if head.base is not None:
+                    self.base = urllib.parse.urljoin(self.url, head.base.get("href"))
+                else:
+                    self.base = self.url
+            sublinks = []
+            for l in head.feeds:
+                ty = l.get("type")
+                if ty:
+                    if "rss" in ty or "atom" in ty or "feed" in ty:
+                        sublink = urllib.parse.urljoin(self.url, l.get("href"))
+                        sublinks.append([sublink, ty, l.get("title")])
+        def recursive_links(element):
+            name = element.name
+            if name in ["blockquote", "dd", "div", "p", "dt", "span", "h1", "h2", "h3",
+                        "h4", "h5", "h6", "code", "tt", "abbr", "li", "tr", "td", "th",
+                        "em", "i", "b", "strong", "br"]:
+                for child in element.children:
+                    if child is not None:
+                        recursive_links(child)
+            elif name in ["pre", "script", "style", "template"]:
+                pass
+            elif name == "a":
+                link = element.get("href")
+                if link:
+                    link = urlify(link)
+                    normal_link = True
+                    display_this_picture = False
+                    for child in element.children:
+                        if child is not None and child.name == "img":
+                            recursive_links(child)
+                            normal_link = False
+                    if not normal_link:
+                        display_this_picture = self._show_image_link(link, links)
+                    if display_this_picture or normal_link:
+                        links.append(link + " ")
+                    for child in element.children:
+                        if child is not None and child.name != "img":
+                            recursive_links(child)
+                else:
+                    for child in element.children:
+                        if child is not None:
+                            recursive_links(child)
+            elif name == "img":
+                image = self._html_image(element, mode, sanitize_string)
+                if image:
+                    links.append(image[1] + " " + image[2])
+            elif name == "video":
+                poster, link, text = self._html_video(element, mode, sanitize_string)
+                if link:
+                    links.append(link)
+            elif not element.has_string():
+                for child in element.children:
+                    if child is not None:
+                        recursive_links(child)
+
+        root = page.root.find("body") or page.root
+        recursive_links(root)
+        for url, text in self._feed_links(sublinks):
+            links.append(url + " " + text)
+        return links
 
 ## Now the custom renderers
 class XkcdRenderer(HtmlRenderer):
@@ -1810,8 +2840,59 @@ _CUSTOM_RENDERERS = {
         }
 
 
+# Types that servers often give wrongly: the content has to be checked
+_VAGUE_MIMES = ["text/plain", "text/html", "text/xml", "application/xml",
+                "application/octet-stream"]
+
+
+# Returns the mime of the file and its mime from its extension
+def _guess_mime(path):
+    mime2, encoding = mimetypes.guess_type(path, strict=False)
+    # The type given by the server when the file was fetched
+    mime = get_file_mime(path)
+    if mime:
+        mime = mime.lower()
+        if "/" in mime and mime not in _VAGUE_MIMES:
+            return mime, mime2
+    # We only run "file" if its first bytes are not enough
+    try:
+        with open(path, "rb") as f:
+            head = f.read(SNIFF_SIZE)
+    except OSError:
+        head = b""
+    mime = sniff_mime(head)
+    if not mime:
+        if CMDS["file"]:
+            with span("get_mime.file"):
+                mime = run(CMDS["file"] + " -b --mime-type %s", parameter=path).strip()
+        else:
+            return mime2, mime2
+    # If we hesitate between html and xml, takes the xml one
+    # because the FeedRendered fallback to HtmlRenderer
+    if mime2 and mime != mime2 and "html" in mime and "xml" in mime2:
+        mime = "text/xml"
+    # We will also check if the first line starts with <rss
+    elif not mime2 and "html" in mime:
+        if head.startswith(b"<rss"):
+            mime = "text/xml"
+        else:
+            mime = "text/html"
+    # If it’s a xml file, consider it as such, regardless of what file thinks
+    elif path.endswith(".xml"):
+        mime = "text/xml"
+    # If it doesn’t contain .svg, it is probably an xml, not a SVG file
+    elif "svg" in mime and not ".svg" in path: #path.endswith(".svg"):
+        mime = "text/xml"
+    # Some xml/html document are considered as octet-stream
+    if mime == "application/octet-stream":
+        mime = "text/xml"
+    return mime, mime2
+
+
+@traced("get_mime")
 def get_mime(path, url=None):
     # Beware, this one is really a shady ad-hoc function
+    mime2 = None
     if not path:
         return None
     # If the file is empty, simply returns it
@@ -1828,41 +2909,13 @@ def get_mime(path, url=None):
         mime = "text/gemini"
     elif path.endswith("gophermap"):
         mime = "text/gopher"
-    elif CMDS["file"]:
-        mime = run(CMDS["file"] + " -b --mime-type %s", parameter=path).strip()
-        mime2, encoding = mimetypes.guess_type(path, strict=False)
-        # If we hesitate between html and xml, takes the xml one
-        # because the FeedRendered fallback to HtmlRenderer
-        if mime2 and mime != mime2 and "html" in mime and "xml" in mime2:
-            mime = "text/xml"
-        # We will also check if the first line starts with <rss
-        elif not mime2 and "html" in mime:
-            if path and os.path.exists(path):
-                firstline = None
-                # Avoid crash from non-unicode charset
-                with open(path, "rb") as f:
-                    firstline = f.readline()
-                    f.close()
-                if firstline.startswith(b"<rss"):
-                    mime = "text/xml"
-                else:
-                    mime = "text/html"
-            else:
-                mime = "text/html"
-        # If it’s a xml file, consider it as such, regardless of what file thinks
-        elif path.endswith(".xml"):
-            mime = "text/xml"
-        # If it doesn’t contain .svg, it is probably an xml, not a SVG file
-        elif "svg" in mime and not ".svg" in path: #path.endswith(".svg"):
-            mime = "text/xml"
-        # Some xml/html document are considered as octet-stream
-        if mime == "application/octet-stream":
-            mime = "text/xml"
     else:
-        mime, encoding = mimetypes.guess_type(path, strict=False)
+        mime, mime2 = _guess_mime(path)
     # gmi Mimetype is not recognized yet
-    if not mime and not CMDS["file"]:
-        print(_('Cannot guess the mime type of the file. Please install "file".'))
+    if not mime:
+        if not CMDS["file"]:
+            print(_('Cannot guess the mime type of the file. Please install "file".'))
+        return mime
     if mime.startswith("text") and mime not in _FORMAT_RENDERERS:
         if mime2 and mime2 in _FORMAT_RENDERERS:
             mime = mime2
@@ -1876,6 +2929,55 @@ def get_mime(path, url=None):
     return mime
 
 
+# The charset declared in an HTML or XML document
+_DECLARED_CHARSET = re.compile(rb"""<(?:meta\s[^>]*?charset|\?xml\s[^>]*?encoding)\s*=\s*["']?"""
+                               rb"""([\w.:-]+)""", re.IGNORECASE)
+# Charsets detected by charset_normalizer, by (path, mtime, size), when they
+# can’t be kept with the files
+_DETECTED_CHARSETS = {}
+
+
+# Read a text file, whatever its charset. Most files are in UTF-8, then we
+# try the charset declared by the server or in the document and, only if
+# they are wrong, the (slow) detection of the charset, done once per file.
+@traced("decode_file")
+def decode_file(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    if data.startswith((b"\xff\xfe", b"\xfe\xff")):
+        charsets = ["utf-16"]
+    else:
+        # utf-8-sig removes the BOM
+        charsets = ["utf-8-sig"]
+    charsets.append(get_file_charset(path))
+    declared = _DECLARED_CHARSET.search(data[:SNIFF_SIZE])
+    if declared:
+        charsets.append(declared.group(1).decode("ascii"))
+    st = os.stat(path)
+    stamp = (path, st.st_mtime_ns, st.st_size)
+    charsets.append(_DETECTED_CHARSETS.get(stamp))
+    for charset in charsets:
+        if charset:
+            try:
+                return data.decode(charset)
+            except (LookupError, UnicodeDecodeError):
+                pass
+    charset = None
+    if netcache.load_CHARDET():
+        with span("decode_file.detect"):
+            charset = netcache.chardet.detect(data)["encoding"]
+    if charset:
+        try:
+            content = data.decode(charset)
+            _DETECTED_CHARSETS[stamp] = charset
+            set_file_charset(path, charset)
+            return content
+        except (LookupError, UnicodeDecodeError):
+            pass
+    return data.decode("utf-8", errors="ignore")
+
+
+@traced("renderer_from_file")
 def renderer_from_file(path, url=None, theme=None, redirectlist={}, **kwargs):
     if not path:
         return None
@@ -1883,18 +2985,16 @@ def renderer_from_file(path, url=None, theme=None, redirectlist={}, **kwargs):
     if not url:
         url = path
     if os.path.exists(path):
+        st = os.stat(path)
         if mime.startswith("text/") or mime in _FORMAT_RENDERERS:
-            try:
-                from charset_normalizer import from_path
-                content = str(from_path(path).best())
-            except:
-                with open(path, errors="ignore") as f:
-                    content = f.read()
-                    f.close()
+            content = decode_file(path)
         else:
             content = path
         toreturn = set_renderer(content, url, mime, theme=theme, \
                                 redirectlist=redirectlist,**kwargs)
+        if os.path.isfile(path):
+            toreturn.source_path = path
+            toreturn.source_stamp = (st.st_mtime_ns, st.st_size)
     else:
         toreturn = None
     return toreturn
@@ -1,14 +1,18 @@
 #!/usr/bin/env python3
 import argparse
 import codecs
+import contextlib
 import datetime
 import getpass
 import glob
 import hashlib
+import json
 import os
 import socket
 import ssl
+import stat
 import sys
+import threading
 import time
 import urllib.parse
 import warnings
@@ -140,14 +144,104 @@ def external_editor_input(url, meta, options):
             done = True
     return text
 
+# DNS cache, only enabled in the netcache daemon (which lives long enough)
+_DNS_CACHE = None
+_DNS_CACHE_TTL = 300
+
+
+def _getaddrinfo(host, port, **kwargs):
+    if _DNS_CACHE is None:
+        return socket.getaddrinfo(host, port, **kwargs)
+    key = (host, port, tuple(sorted(kwargs.items())))
+    cached = _DNS_CACHE.get(key)
+    if cached and time.monotonic() - cached[0] < _DNS_CACHE_TTL:
+        return list(cached[1])
+    addresses = socket.getaddrinfo(host, port, **kwargs)
+    _DNS_CACHE[key] = (time.monotonic(), addresses)
+    return list(addresses)
+
+
+# Rendering a page checks the cache of each of its links, which used to be
+# several stats per link. Inside "with stat_cache():", each folder is listed
+# once and the cache lookups below are answered from that listing.
+# (per thread, as the daemon and fetch_batch use netcache from threads)
+_STAT_CACHE = threading.local()
+
+
+@contextlib.contextmanager
+def stat_cache():
+    # The block gets a dict of the URLs looked up -> their cache mtime (or
+    # None), which is what a rendering depends on besides the page itself.
+    outer = getattr(_STAT_CACHE, "folders", None) is not None
+    if not outer:
+        _STAT_CACHE.folders = {}
+        _STAT_CACHE.xdg = {}
+        _STAT_CACHE.lookups = {}
+    try:
+        yield _STAT_CACHE.lookups
+    finally:
+        if not outer:
+            _STAT_CACHE.folders = None
+            _STAT_CACHE.xdg = None
+            _STAT_CACHE.lookups = None
+
+
+# xdg() checks and creates its folders each time it is called
+def _xdg(folder):
+    known = getattr(_STAT_CACHE, "xdg", None)
+    if known is None:
+        return xdg(folder)
+    if folder not in known:
+        known[folder] = xdg(folder)
+    return known[folder]
+
+
+def _stat(path):
+    folders = getattr(_STAT_CACHE, "folders", None)
+    if folders is None:
+        try:
+            return os.stat(path)
+        except (OSError, ValueError):
+            return None
+    folder, name = os.path.split(path.rstrip("/") or path)
+    entries = folders.get(folder)
+    if entries is None:
+        entries = {}
+        try:
+            with os.scandir(folder or ".") as it:
+                for entry in it:
+                    entries[entry.name] = entry
+        except (OSError, ValueError):
+            pass
+        folders[folder] = entries
+    entry = entries.get(name)
+    if entry is None:
+        return None
+    try:
+        # DirEntry keeps the result, each file is stat’ed once
+        return entry.stat()
+    except OSError:
+        return None
+
+
+def _isdir(path):
+    st = _stat(path)
+    return st is not None and stat.S_ISDIR(st.st_mode)
+
+
 def cache_last_modified(url):
     if not url:
         return None
     path = get_cache_path(url)
-    if path and os.path.isfile(path):
-        return os.path.getmtime(path)
+    st = path and _stat(path)
+    if st and stat.S_ISREG(st.st_mode):
+        mtime = st.st_mtime
     else:
-        return None
+        mtime = None
+    lookups = getattr(_STAT_CACHE, "lookups", None)
+    if lookups is not None:
+        lookups[url] = mtime
+    return mtime
 
 
 def is_cache_valid(url, validity=0):
@@ -155,6 +249,8 @@ def is_cache_valid(url, validity=0):
     # a cache to be valid  (in seconds)
     # If 0, then any cache is considered as valid
     # (use validity = 1 if you want to refresh everything)
+    if getattr(_STAT_CACHE, "lookups", None) is not None:
+        cache_last_modified(url)
     if offutils.is_local(url):
         return True
     cache = get_cache_path(url)
@@ -164,11 +260,10 @@ def is_cache_valid(url, validity=0):
         if len(cache) > 259:
             print(_("We return False because path is too long"))
             return False
-        if os.path.exists(cache) and not os.path.isdir(cache):
+        st = _stat(cache)
+        if st and not stat.S_ISDIR(st.st_mode):
             if validity > 0:
-                last_modification = cache_last_modified(url)
-                now = time.time()
-                age = now - last_modification
+                age = time.time() - st.st_mtime
                 return age < validity
             else:
                 return True
@@ -192,7 +287,7 @@ def get_cache_path(url, add_index=True, include_protocol=True, xdgfolder="cache"
         return None
     url = clean_url(url)
     parsed = urllib.parse.urlparse(url)
-    if url[0] == "/" or url.startswith("./") or os.path.exists(url):
+    if url[0] == "/" or url.startswith("./") or _stat(url):
         scheme = "file"
     elif parsed.scheme:
         scheme = parsed.scheme
@@ -207,7 +302,7 @@ def get_cache_path(url, add_index=True, include_protocol=True, xdgfolder="cache"
         elif scheme == "mailto":
             path = parsed.path
         elif url.startswith("list://"):
-            listdir = os.path.join(xdg("data"), "lists")
+            listdir = os.path.join(_xdg("data"), "lists")
             listname = url[7:].lstrip("/")
             if listname in [""]:
                 name = "My Lists"
@@ -256,7 +351,7 @@ def get_cache_path(url, add_index=True, include_protocol=True, xdgfolder="cache"
         schemepath = ""
         if include_protocol: schemepath = scheme + "/"
         if subfolder: schemepath += subfolder + "/"
-        cache_path = os.path.expanduser(xdg(xdgfolder) + schemepath + host + path)
+        cache_path = os.path.expanduser(_xdg(xdgfolder) + schemepath + host + path)
         # There’s an OS limitation of 260 characters per path.
         # We will thus cut the path enough to add the index afterward
         cache_path = cache_path[:249]
@@ -273,7 +368,7 @@ def get_cache_path(url, add_index=True, include_protocol=True, xdgfolder="cache"
             index = "gophermap"
         else:
             index = "index.gmi"
-        if path == "" or os.path.isdir(cache_path):
+        if path == "" or _isdir(cache_path):
             if not cache_path.endswith("/"):
                 cache_path += "/"
             if not url.endswith("/"):
@@ -283,7 +378,7 @@ def get_cache_path(url, add_index=True, include_protocol=True, xdgfolder="cache"
         # sometimes, the index itself is a dir
         # like when folder/index.gmi?param has been created
         # and we try to access folder
-        if add_index and os.path.isdir(cache_path):
+        if add_index and _isdir(cache_path):
             cache_path += "/" + index
     else:
         # URL is missing either a supported scheme or a valid host
@@ -301,6 +396,11 @@ def get_cache_path(url, add_index=True, include_protocol=True, xdgfolder="cache"
     return cache_path
 
 
+# What the last fetch of the thread has downloaded (see fetch): "bytes"
+# received and "unchanged" if the server said the cache was up to date
+_TRANSFER = threading.local()
+
+
 def write_body(url, body, mime=None):
     # body is a copy of the raw gemtext
     # Write_body() also create the cache !
@@ -326,9 +426,11 @@ def write_body(url, body, mime=None):
         if os.path.isfile(root_dir):
             os.remove(root_dir)
         os.makedirs(cache_dir, exist_ok=True)
-        with open(cache_path, mode=mode) as f:
+        with offutils.atomic_open(cache_path, mode=mode) as f:
             f.write(body)
-            f.close()
+        _TRANSFER.bytes = os.path.getsize(cache_path)
+        # get_mime() will not have to guess it
+        offutils.set_file_mime(cache_path, mime)
         return cache_path
 
 
@@ -348,7 +450,7 @@ def set_error(url, err):
             os.remove(root_dir)
         os.makedirs(cache_dir, exist_ok=True)
         if os.path.isdir(cache_dir):
-            with open(cache, "w") as c:
+            with offutils.atomic_open(cache, "w") as c:
                 c.write(str(datetime.datetime.now()) + "\n")
                 c.write(_("ERROR while caching %s\n\n") % url)
                 c.write("*****\n\n")
@@ -357,10 +459,23 @@ def set_error(url, err):
                 c.write("\n*****\n\n")
                 c.write(_("If you believe this error was temporary, type " "reload" ".\n"))
                 c.write(_("The resource will be tentatively fetched during next sync.\n"))
-                c.close()
     return cache
 
 
+# Cookie jars are kept in memory for the whole process, one per domain.
+# curl reads and writes the cookie files by itself so a jar is only saved
+# when it was modified from python (it is then "dirty") and it is reloaded
+# when the file changed on disk (because curl updated it).
+_COOKIEJARS = {}
+_DIRTY_COOKIEJARS = set()
+_COOKIEJARS_LOCK = threading.Lock()
+
+
+def _cookie_signature(path):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
 def get_cookiejar(url, create=False):
     if load_HTTP():
         parsed = urllib.parse.urlparse(url)
@@ -374,12 +489,43 @@ def get_cookiejar(url, create=False):
             else:
                 return None
         import http.cookiejar
-        jar = http.cookiejar.MozillaCookieJar(cookie_path)
-        jar.load()
+        with _COOKIEJARS_LOCK:
+            jar, signature = _COOKIEJARS.get(cookie_path, (None, None))
+            current = _cookie_signature(cookie_path)
+            if jar is None:
+                jar = http.cookiejar.MozillaCookieJar(cookie_path)
+                jar.load()
+            elif signature != current and cookie_path not in _DIRTY_COOKIEJARS:
+                jar.clear()
+                jar.load()
+            _COOKIEJARS[cookie_path] = (jar, current)
         return jar
     else:
         return None
 
+
+def mark_cookiejar_dirty(jar):
+    # The jar will be written on disk by the next flush_cookiejars()
+    # (or before curl needs it)
+    with _COOKIEJARS_LOCK:
+        _DIRTY_COOKIEJARS.add(jar.filename)
+        _COOKIEJARS[jar.filename] = (jar, None)
+
+
+def _save_cookiejar(jar):
+    with _COOKIEJARS_LOCK:
+        if jar.filename in _DIRTY_COOKIEJARS:
+            jar.save()
+            _DIRTY_COOKIEJARS.discard(jar.filename)
+            _COOKIEJARS[jar.filename] = (jar, _cookie_signature(jar.filename))
+
+
+def flush_cookiejars():
+    # Called once at the end of a command or of a sync
+    for path in list(_DIRTY_COOKIEJARS):
+        jar, signature = _COOKIEJARS[path]
+        _save_cookiejar(jar)
+
 #23: CURLE_WRITE_ERROR
 CURL_WRITE_ERROR = 23
 # 60: Peer certificate cannot be authenticated with known CA certificates.
@@ -390,6 +536,9 @@ CURL_MAX_FILE_SIZE_EXCEEDED = 63
 class CurlError(Exception):
     pass
 
+class TofuError(Exception):
+    pass
+
 def _fetch_curl(url, verify=True, headers={}, timeout=DEFAULT_TIMEOUT, cookies=None, max_size=None, extra_args=[]):
     """
     return cache path
@@ -401,13 +550,12 @@ def _fetch_curl(url, verify=True, headers={}, timeout=DEFAULT_TIMEOUT, cookies=N
     import http.cookiejar
     use_cookie = cookies is not None and isinstance(cookies, http.cookiejar.MozillaCookieJar)
 
-    def too_large_error(url, length, max_size):
-        err = _("Size of %s is %s Mo\n") % (url, length)
-        err += _("Offpunk only download automatically content under %s Mo\n") % (
+    def too_large_error(url, max_size):
+        err = _("Offpunk only download automatically content under %s Mo\n") % (
             max_size / 1000000
         )
         err += _("To retrieve this content anyway, type 'reload'.")
-        return set_error(url, err)
+        return set_error(url, err), url
 
     # -b : use cookies from file
     # -c : save cookies to file
@@ -436,30 +584,51 @@ def _fetch_curl(url, verify=True, headers={}, timeout=DEFAULT_TIMEOUT, cookies=N
     if max_size:
         cmd += ["--max-filesize", str(max_size)]
     if use_cookie:
-        # save all cookies for curl to read
-        cookies.save()
+        # save modified cookies for curl to read
+        _save_cookiejar(cookies)
         cmd += ["-c", cookies.filename]
         cmd += ["-b", cookies.filename]
     # curl only write its output as-is, it DOES NOT re-encode output to utf-8 like python-requests.
     # Response with non-unicode charset may crash with UnicodeDecodeError when python read the output file.
     cache = get_cache_path(url)
-    cmd += [url, "-o", cache]
+    # curl writes in a temporary file which then replaces the cache
+    # so readers never see a partial file
+    tmp = os.path.join(os.path.dirname(cache),
+                       ".tmp-curl-%s-%s" % (os.getpid(), threading.get_ident()))
+    cmd += [url, "-o", tmp]
     # save the Last-Modified time as the file modification time
     cmd += ["--remote-time"]
+    # and what was received and its content type on stdout
+    cmd += ["-w", "%{http_code} %{size_download} %{content_type}"]
     # if we already have it, make a conditional request
     if os.path.isfile(cache):
         cmd += ["-z", cache]
     cmd += extra_args
     try:
-        subprocess.run(cmd, capture_output=True, check=True)
+        result = subprocess.run(cmd, capture_output=True, check=True)
     except Exception as err:
+        if os.path.exists(tmp):
+            os.remove(tmp)
         if err.returncode == CURL_MAX_FILE_SIZE_EXCEEDED:
-            return too_large_error(url, length, max_size)
+            return too_large_error(url, max_size)
         elif err.returncode == CURL_WRITE_ERROR:
             #There’s a write error so we don’t have any cache, we return none
             return None
         else:
             raise CurlError(err.returncode, err.stderr.decode().strip())
+    code, size, content_type = (result.stdout.decode(errors="replace") + "  ").split(" ", 2)
+    _TRANSFER.bytes = int(size) if size.isdigit() else 0
+    # Nothing is written if the remote file is not newer than the cache
+    _TRANSFER.unchanged = not os.path.exists(tmp)
+    if os.path.exists(tmp):
+        mime, *params = content_type.strip().lower().split(";")
+        offutils.set_file_mime(tmp, mime.strip())
+        # curl doesn’t decode the body, the declared charset will be needed
+        for param in params:
+            name, equal, value = param.partition("=")
+            if name.strip() == "charset" and value.strip(" \"'"):
+                offutils.set_file_charset(tmp, value.strip(" \"'"))
+        os.replace(tmp, cache)
     return cache, url
 
 def _fetch_http(
@@ -498,8 +667,7 @@ def _fetch_gopher(url, timeout=DEFAULT_TIMEOUT, interactive=True, **kwargs):
     else:
         itemtype = "1"
         selector = ""
-    addresses = socket.getaddrinfo(host, port, family=0, type=socket.SOCK_STREAM)
-    s = socket.create_connection((host, port))
+    addresses = _getaddrinfo(host, port, family=0, type=socket.SOCK_STREAM)
     for address in addresses:
         s = socket.socket(address[0], address[1])
         s.settimeout(timeout)
@@ -508,6 +676,8 @@ def _fetch_gopher(url, timeout=DEFAULT_TIMEOUT, interactive=True, **kwargs):
             break
         except OSError as e:
             err = e
+    else:
+        raise err
     # gophermap lines can't have a query included.
     # if there is something in parsed.query, it's because an error
     # or a rogue "?" character in the selector
@@ -531,7 +701,7 @@ def _fetch_gopher(url, timeout=DEFAULT_TIMEOUT, interactive=True, **kwargs):
         # Try most common encodings
         for encoding in ("UTF-8", "ISO-8859-1"):
             try:
-                response = response.decode("UTF-8")
+                response = response.decode(encoding)
                 break
             except UnicodeDecodeError:
                 pass
@@ -566,7 +736,7 @@ def _fetch_finger(url, timeout=DEFAULT_TIMEOUT, **kwargs):
         sock.settimeout(timeout)
         sock.send(query.encode())
         response = sock.makefile("rb").read().decode("UTF-8")
-        cache = write_body(response, "text/plain")
+        cache = write_body(url, response, "text/plain")
     return cache, url
 
 
@@ -600,10 +770,13 @@ def _fetch_spartan(url, **kwargs):
         elif code == 3:
             redirect_url = url_parts._replace(path=meta).geturl()
         else:
-            return set_error(url, "Spartan code %s: Error %s" % (code, meta))
+            return set_error(url, "Spartan code %s: Error %s" % (code, meta)), url
     if redirect_url:
-        cache = _fetch_spartan(redirect_url)
-    return cache
+        return _fetch_spartan(redirect_url)
+    return cache, url
+
+
+_TOFU_LOCK = threading.Lock()
 
 
 def _validate_cert(address, host, cert, accept_bad_ssl=False, automatic_choice=None):
@@ -703,7 +876,7 @@ def _validate_cert(address, host, cert, accept_bad_ssl=False, automatic_choice=N
                     # Matched!
                     # Increase the counter for this certificate (this also updates
                     # the modification time of the file)
-                    with open(filepath, "w") as f:
+                    with offutils.atomic_open(filepath) as f:
                         f.write(str(count + 1))
                     matching_fingerprint = True
                     break
@@ -745,70 +918,154 @@ def _validate_cert(address, host, cert, accept_bad_ssl=False, automatic_choice=N
             #TRANSLATORS: keep "Y/N" because the answer has to be one of those
             choice = input(_("Accept this new certificate? Y/N ")).strip().lower()
         if choice in ("y", "yes"):
-            with open(os.path.join(sitedir, fingerprint), "w") as fp:
+            with offutils.atomic_open(os.path.join(sitedir, fingerprint)) as fp:
                 fp.write("1")
-            with open(os.path.join(certcache, fingerprint + ".crt"), "wb") as fp:
+            with offutils.atomic_open(os.path.join(certcache, fingerprint + ".crt"), "wb") as fp:
                 fp.write(cert)
         else:
-            raise Exception(_("TOFU Failure!"))
+            raise TofuError(_("TOFU Failure!"))
 
     # 3. If no directory or no cert found in it, we cache it
     if not most_frequent_cert:
-        if not os.path.exists(certdir):  # XDG_DATA/offpunk/certs
-            os.makedirs(certdir)
-        if not os.path.exists(hostdir):  # XDG_DATA/offpunk/certs/site.net
-            os.makedirs(hostdir)
-        if not os.path.exists(
-            sitedir
-        ):  # XDG_DATA/offpunk/certs/site.net/123.123.123.123
-            os.makedirs(sitedir)
-
-        with open(os.path.join(sitedir, fingerprint), "w") as fp:
+        # XDG_DATA/offpunk/certs/site.net/123.123.123.123
+        os.makedirs(sitedir, exist_ok=True)
+
+        with offutils.atomic_open(os.path.join(sitedir, fingerprint)) as fp:
             fp.write("1")
         certcache = os.path.join(xdg("config"), "cert_cache")
         if not os.path.exists(certcache):
             os.makedirs(certcache)
-        with open(os.path.join(certcache, fingerprint + ".crt"), "wb") as fp:
+        with offutils.atomic_open(os.path.join(certcache, fingerprint + ".crt"), "wb") as fp:
             fp.write(cert)
 
 
+# Client certificates (identities) live in XDG_DATA/certs/HOST/NAME.cert
+# (with the matching NAME.key). Instead of walking the disk on each request,
+# they are indexed once by host in _IDENTITIES. The index is rebuilt lazily
+# after create_certificate() resets it, or when the certs folder or one of its
+# host folders is modified (by another offpunk or by the user).
+_IDENTITIES = None
+# the mtimes of the certs folder and of its host folders when it was indexed
+_IDENTITIES_STAMP = None
+# Prepared SSL contexts, by (certfile, keyfile). (None, None) is the anonymous one
+_SSL_CONTEXTS = {}
+
+
+def _certs_stamp(certdir):
+    try:
+        stamp = [os.stat(certdir).st_mtime_ns]
+        with os.scandir(certdir) as entries:
+            stamp += sorted((e.name, e.stat().st_mtime_ns) for e in entries if e.is_dir())
+        return stamp
+    except OSError:
+        return None
+
+
+def _get_identities():
+    global _IDENTITIES, _IDENTITIES_STAMP
+    certdir = os.path.join(xdg("data"), "certs")
+    stamp = _certs_stamp(certdir)
+    if _IDENTITIES is not None and stamp != _IDENTITIES_STAMP:
+        _reset_identities()
+    if _IDENTITIES is None:
+        _IDENTITIES_STAMP = stamp
+        identities = {}
+        # Certificates directly in certdir are global identities (host "")
+        for certfile in sorted(glob.glob(os.path.join(certdir, "*.cert")) +
+                               glob.glob(os.path.join(certdir, "*", "*.cert"))):
+            host = os.path.relpath(os.path.dirname(certfile), certdir)
+            if host == ".":
+                host = ""
+            site_id = os.path.basename(certfile)[: -len(".cert")]
+            keyfile = certfile[: -len(".cert")] + ".key"
+            if not os.path.exists(keyfile):
+                keyfile = None
+            identities.setdefault(host, {})[site_id] = (certfile, keyfile)
+        _IDENTITIES = identities
+    return _IDENTITIES
+
+
+def _reset_identities():
+    global _IDENTITIES
+    _IDENTITIES = None
+    _SSL_CONTEXTS.clear()
+
+
+def _host_suffixes(host):
+    # "a.b.c" -> "a.b.c", "b.c", "c"
+    parts = host.split(".")
+    for i in range(len(parts)):
+        yield ".".join(parts[i:])
+
+
 def _get_client_certkey(site_id: str, host: str):
     # returns {cert: str, key: str}
-    certdir = os.path.join(xdg("data"), "certs", host)
-    certf = os.path.join(certdir, "%s.cert" % site_id)
-    keyf = os.path.join(certdir, "%s.key" % site_id)
-    if not os.path.exists(certf) or not os.path.exists(keyf):
-        if host != "":
-            split = host.split(".")
-            # if len(split) > 2:  # Why not allow a global identity? Maybe I want
-            # to login to all sites with the same
-            # certificate.
-            return _get_client_certkey(site_id, ".".join(split[1:]))
-        return None
-    certkey = dict(cert=certf, key=keyf)
-    return certkey
+    identities = _get_identities()
+    # We also allow a global identity (host ""). Maybe I want
+    # to login to all sites with the same certificate.
+    for suffix in list(_host_suffixes(host)) + [""]:
+        certf, keyf = identities.get(suffix, {}).get(site_id, (None, None))
+        if certf and keyf:
+            return dict(cert=certf, key=keyf)
+    return None
+
+
+def _list_site_ids(netloc):
+    site_ids = []
+    identities = _get_identities()
+    for suffix in _host_suffixes(netloc):
+        site_ids.extend(identities.get(suffix, {}))
+    return site_ids
 
 
 def _get_site_ids(url: str):
     newurl = normalize_url(url)
     u = urllib.parse.urlparse(newurl)
     if u.scheme == "gemini" and u.username is None:
-        certdir = os.path.join(xdg("data"), "certs")
-        netloc_parts = u.netloc.split(".")
-        site_ids = []
-
-        for i in range(len(netloc_parts), 0, -1):
-            lasti = ".".join(netloc_parts[-i:])
-            direc = os.path.join(certdir, lasti)
-
-            for certfile in glob.glob(os.path.join(direc, "*.cert")):
-                site_id = certfile.split("/")[-1].split(".")[-2]
-                site_ids.append(site_id)
-        return site_ids
+        return _list_site_ids(u.netloc)
     else:
         return []
 
 
+def _get_ssl_context(certkey=None):
+    if certkey:
+        key = (certkey["cert"], certkey["key"])
+    else:
+        key = (None, None)
+    if key in _SSL_CONTEXTS:
+        return _SSL_CONTEXTS[key]
+    protocol = (
+        ssl.PROTOCOL_TLS_CLIENT if sys.version_info.minor >= 6 else ssl.PROTOCOL_TLSv1_2
+    )
+    context = ssl.SSLContext(protocol)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    # When using an identity, use the certificate and key
+    if certkey:
+        context.load_cert_chain(certkey["cert"], certkey["key"])
+    # Impose minimum TLS version
+    # In 3.7 and above, this is easy...
+    if sys.version_info.minor >= 7:
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+    # Otherwise, it seems very hard...
+    # The below is less strict than it ought to be, but trying to disable
+    # TLS v1.1 here using ssl.OP_NO_TLSv1_1 produces unexpected failures
+    # with recent versions of OpenSSL.  What a mess...
+    else:
+        context.options |= ssl.OP_NO_SSLv3
+        context.options |= ssl.OP_NO_SSLv2
+    # Try to enforce sensible ciphers
+    try:
+        context.set_ciphers(
+            "AESGCM+ECDHE:AESGCM+DHE:CHACHA20+ECDHE:CHACHA20+DHE:!DSS:!SHA1:!MD5:@STRENGTH"
+        )
+    except ssl.SSLError:
+        # Rely on the server to only support sensible things, I guess...
+        pass
+    _SSL_CONTEXTS[key] = context
+    return context
+
+
 def create_certificate(name: str, days: int, hostname: str):
     key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
     sitecertdir = os.path.join(xdg("data"), "certs", hostname)
@@ -843,6 +1100,7 @@ def create_certificate(name: str, days: int, hostname: str):
     certfile = os.path.join(sitecertdir, name + ".cert")
     with open(certfile, "wb") as f:
         f.write(cert.public_bytes(serialization.Encoding.PEM))
+    _reset_identities()
 
 def ask_certs(url: str):
     certs = get_certs(url)
@@ -891,21 +1149,9 @@ def ask_certs(url: str):
 def get_certs(url: str):
     u = urllib.parse.urlparse(normalize_url(url))
     if u.scheme == "gemini":
-        certdir = os.path.join(xdg("data"), "certs")
-        netloc_parts = u.netloc.split(".")
-        site_ids = []
-        if "@" in netloc_parts[0]:
-            netloc_parts[0] = netloc_parts[0].split("@")[1]
-        # certdir does not contemplate ports, so we should take it out here if present
-        if ":" in netloc_parts[-1]:
-            netloc_parts[-1] = netloc_parts[-1].split(":")[0]
-        for i in range(len(netloc_parts), 0, -1):
-            lasti = ".".join(netloc_parts[-i:])
-            direc = os.path.join(certdir, lasti)
-            for certfile in glob.glob(os.path.join(direc, "*.cert")):
-                site_id = certfile.split("/")[-1].split(".")[-2]
-                site_ids.append(site_id)
-        return site_ids
+        # certdir does not contemplate ports nor users, so we take them out
+        netloc = u.netloc.split("@")[-1].split(":")[0]
+        return _list_site_ids(netloc)
     else:
         return []
 
@@ -941,47 +1187,21 @@ def _fetch_gemini(
     else:
         # IPv4 only
         family_mask = socket.AF_INET
-    addresses = socket.getaddrinfo(
+    addresses = _getaddrinfo(
         host, port, family=family_mask, type=socket.SOCK_STREAM
     )
     # Sort addresses so IPv6 ones come first
     addresses.sort(key=lambda add: add[0] == socket.AF_INET6, reverse=True)
     # Continuation of send_request
     # Prepare TLS context
-    protocol = (
-        ssl.PROTOCOL_TLS_CLIENT if sys.version_info.minor >= 6 else ssl.PROTOCOL_TLSv1_2
-    )
-    context = ssl.SSLContext(protocol)
-    context.check_hostname = False
-    context.verify_mode = ssl.CERT_NONE
-
     # When using an identity, use the certificate and key
+    certkey = None
     if site_id:
         certkey = _get_client_certkey(site_id, host)
-        if certkey:
-            context.load_cert_chain(certkey["cert"], certkey["key"])
-        else:
+        if not certkey:
             print(_("This identity doesn't exist for this site (or is disabled)."))
-    # Impose minimum TLS version
-    # In 3.7 and above, this is easy...
-    if sys.version_info.minor >= 7:
-        context.minimum_version = ssl.TLSVersion.TLSv1_2
-    # Otherwise, it seems very hard...
-    # The below is less strict than it ought to be, but trying to disable
-    # TLS v1.1 here using ssl.OP_NO_TLSv1_1 produces unexpected failures
-    # with recent versions of OpenSSL.  What a mess...
-    else:
-        context.options |= ssl.OP_NO_SSLv3
-        context.options |= ssl.OP_NO_SSLv2
-    # Try to enforce sensible ciphers
-    try:
-        context.set_ciphers(
-            "AESGCM+ECDHE:AESGCM+DHE:CHACHA20+ECDHE:CHACHA20+DHE:!DSS:!SHA1:!MD5:@STRENGTH"
-        )
-    except ssl.SSLError:
-        # Rely on the server to only support sensible things, I guess...
-        pass
-        # Connect to remote host by any address possible
+    context = _get_ssl_context(certkey)
+    # Connect to remote host by any address possible
     err = None
     for address in addresses:
         try:
@@ -1002,7 +1222,9 @@ def _fetch_gemini(
     cert = s.getpeercert(binary_form=True)
     # Remember that we showed the current cert to this domain...
     # TODO : accept badssl and automatic choice
-    _validate_cert(address[4][0], host, cert, automatic_choice="y")
+    # (one at a time as the certificates counters are read and rewritten)
+    with _TOFU_LOCK:
+        _validate_cert(address[4][0], host, cert, automatic_choice="y")
     # Send request and wrap response in a file descriptor
     url = urllib.parse.urlparse(url)
     new_host = host
@@ -1135,6 +1357,39 @@ def _fetch_gemini(
     return cache, url
 
 # This is the list of supported protocols and their method
+# Classify a fetching error for reports and metrics
+CURL_COULDNT_RESOLVE_HOST = 6
+CURL_COULDNT_CONNECT = 7
+CURL_OPERATION_TIMEDOUT = 28
+def error_class(err):
+    if isinstance(err, socket.gaierror):
+        return "dns"
+    elif isinstance(err, ConnectionRefusedError):
+        return "refused"
+    elif isinstance(err, ConnectionResetError):
+        return "reset"
+    elif isinstance(err, (TimeoutError, socket.timeout)):
+        return "timeout"
+    elif isinstance(err, (TofuError, CertificateError)):
+        return "tofu"
+    elif isinstance(err, ssl.SSLError):
+        return "ssl"
+    elif isinstance(err, CurlError):
+        code = err.args[0]
+        if code == CURL_COULDNT_RESOLVE_HOST:
+            return "dns"
+        elif code == CURL_COULDNT_CONNECT:
+            return "refused"
+        elif code == CURL_OPERATION_TIMEDOUT:
+            return "timeout"
+        return "curl-%s" % code
+    elif isinstance(err, RuntimeError):
+        # Errors returned by the server (gemini 4x/5x, bad headers, …)
+        return "server"
+    else:
+        return "other"
+
+
 PROTOCOLS = {
     "gemini": { "port": 1965, "fetch": _fetch_gemini},
     "gopher": { "port": 70, "fetch": _fetch_gopher},
@@ -1159,29 +1414,41 @@ def fetch(
     redirects={},
     #blocked is empty by default to allow blocking rules having been removed
     blocked={},
+    report=None,
     **kwargs,
 ):
+    # If report is a dict, it is filled with what happened: "status" is one of
+    # blocked, cached, offline (not in cache), unsupported, fetched, aborted
+    # or error (with "error" and "error_class")
+    if report is None:
+        report = {}
     url = normalize_url(url)
     url = clean_url(url)
     newurl = url
     path = None
     print_error = "print_error" in kwargs.keys() and kwargs["print_error"]
     #Step 0: we apply redirect and/or block
-    #Let’s add the blocked list into the redirects
+    #Let’s add the blocked list into (a copy of) the redirects
     #This will not overwrite existing rule for that domain
-    for b in blocked:
-        if b not in redirects.keys(): redirects[b] = "blocked"
+    if blocked:
+        redirects = offutils.redirect_list(redirects, blocked)
     redirection, key = get_url_redirected(url,redirects,returnkey=True)
     if redirection and redirection.lower() == "blocked":
         text = ""
         text += _("Blocked URL: ")+url + "\n"
-        text += _("This website has been blocked with the following rule:\n")
-        text += key + "\n"
-        text += _("Use the following redirect command to unblock it:\n")
-        text += "redirect %s NONE" %key
+        if key in redirects:
+            text += _("This website has been blocked with the following rule:\n")
+            text += key + "\n"
+            text += _("Use the following redirect command to unblock it:\n")
+            text += "redirect %s NONE" %key
+        else:
+            text += _("This website is in one of your blocklists:\n")
+            text += key + "\n"
         if print_error:
             print(text)
         cache = set_error(newurl, text)
+        report["status"] = "blocked"
+        report["error"] = text
         return cache, newurl
     elif redirection and redirection.lower() != "whitelisted":
         parsed = urllib.parse.urlparse(url)
@@ -1194,6 +1461,7 @@ def fetch(
         offline and is_cache_valid(url, validity=0)
     ):
         path = get_cache_path(url)
+        report["status"] = "cached"
         # if the cache is a folder, we should add a "/" at the end of the URL
         if not url.endswith("/") and os.path.isdir(
             get_cache_path(url, add_index=False)
@@ -1201,21 +1469,50 @@ def fetch(
             newurl = url + "/"
     elif offline and is_cache_valid(url, validity=0):
         path = get_cache_path(url)
+        report["status"] = "cached"
+    elif offline:
+        report["status"] = "offline"
     elif "://" in url and not offline:
+        # If a netcache daemon is running, it does the fetching for us
+        if cookiejar is None:
+            with offutils.span("fetch.daemon"):
+                answer = _daemon_fetch(newurl, offline=offline,
+                                       download_image_first=download_image_first,
+                                       images_mode=images_mode, validity=validity,
+                                       redirects=redirects, **kwargs)
+            # The daemon is never interactive. If the page asked for an input,
+            # we fetch it ourselves.
+            if answer and not (answer["path"] is None and answer["report"].get("status") == "fetched"
+                               and kwargs.get("interactive", True)):
+                report.update(answer["report"])
+                if print_error and report.get("status") == "error":
+                    print(_("ERROR: %s") % report.get("error"))
+                return answer["path"], answer["url"]
         try:
             scheme = url.split("://")[0]
             if scheme not in PROTOCOLS:
                 if print_error:
                     print(_("%s is not a supported protocol") % scheme)
                 path = None
+                report["status"] = "unsupported"
             elif scheme in PROTOCOLS:
-                path, newurl = PROTOCOLS[scheme]["fetch"](newurl, **kwargs)
+                _TRANSFER.bytes = 0
+                _TRANSFER.unchanged = False
+                with offutils.span("fetch." + scheme):
+                    path, newurl = PROTOCOLS[scheme]["fetch"](newurl, **kwargs)
+                report["status"] = "fetched"
+                report["bytes"] = _TRANSFER.bytes
+                report["unchanged"] = _TRANSFER.unchanged
             else:
                 print("scheme %s not implemented yet" % scheme)
         except UserAbortException:
+            report["status"] = "aborted"
             return None, newurl
         except Exception as err:
             cache = set_error(newurl, err)
+            report["status"] = "error"
+            report["error"] = str(err)
+            report["error_class"] = error_class(err)
             # Print an error message
             # we fail silently when sync_only
             if isinstance(err, socket.gaierror):
@@ -1284,11 +1581,236 @@ def fetch(
                             redirects=redirects,
                             **kwargs,
                         )
-    if download_image_first and cookiejar is not None:
-        cookiejar.save()
     return path, newurl
 
 
+# "netcache --serve" runs a daemon listening on a Unix socket in the cache
+# folder. While it is running, fetch() asks it to do the network part of the
+# job so all offpunk processes share its DNS cache, TLS contexts and cookie jars
+# and only the daemon writes new content in the cache. Identical requests
+# received at the same time are only fetched once. If there’s no daemon,
+# fetch() does everything by itself, as usual.
+# The protocol is one JSON object per line: a request, then the answer.
+_USE_DAEMON = True
+# Set in the threads of the daemon, which should not call themselves
+_IN_DAEMON = threading.local()
+
+
+# The socket is in a folder only readable by the user
+def _daemon_socket_path():
+    return os.path.join(xdg("cache"), ".netcache", "netcache.sock")
+
+
+# While it fetches, the daemon sends a space every _DAEMON_HEARTBEAT seconds
+# (json.loads ignores them). A daemon silent for _DAEMON_TIMEOUT is stuck.
+_DAEMON_HEARTBEAT = 1
+_DAEMON_TIMEOUT = 5
+
+
+def _daemon_request(path, request):
+    # Return the answer of the daemon or None if it is not available.
+    # The socket of a dead or stuck daemon is removed so that the next
+    # fetches don’t wait for it. A busy daemon still answers a ping.
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(_DAEMON_TIMEOUT)
+            sock.connect(path)
+            sock.sendall(json.dumps(request).encode() + b"\n")
+            answer = sock.makefile("rb").readline()
+        return json.loads(answer)
+    except socket.timeout:
+        if "ping" not in request and _daemon_request(path, {"ping": True}):
+            return None
+        _remove_daemon_socket(path)
+        return None
+    except ConnectionRefusedError:
+        _remove_daemon_socket(path)
+        return None
+    except (OSError, ValueError):
+        return None
+
+
+def _remove_daemon_socket(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _daemon_fetch(url, redirects={}, **kwargs):
+    if not _USE_DAEMON or getattr(_IN_DAEMON, "active", False) or not hasattr(socket, "AF_UNIX"):
+        return None
+    path = _daemon_socket_path()
+    if not os.path.exists(path):
+        return None
+    request = {
+        "url": url,
+        "redirects": dict(redirects),
+        "blocklist": getattr(redirects, "blocklist", None) is not None,
+        "kwargs": kwargs,
+    }
+    try:
+        return _daemon_request(path, request)
+    except TypeError:
+        # Some parameters can’t be sent to the daemon
+        return None
+
+
+def serve(path=None):
+    import signal
+    import socketserver
+
+    global _DNS_CACHE
+    _DNS_CACHE = {}
+    if not path:
+        path = _daemon_socket_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.chmod(os.path.dirname(path), 0o700)
+    if os.path.exists(path):
+        if _daemon_request(path, {"ping": True}):
+            print(_("A netcache daemon is already running on %s") % path)
+            return
+        os.remove(path)
+    inflight = {}
+    inflight_lock = threading.Lock()
+
+    def do_fetch(request):
+        _IN_DAEMON.active = True
+        blocklist = offutils.load_blocklists() if request["blocklist"] else None
+        redirects = offutils.redirect_list(request["redirects"], blocklist=blocklist)
+        kwargs = request["kwargs"]
+        kwargs["interactive"] = False
+        kwargs["print_error"] = False
+        report = {}
+        path, newurl = fetch(request["url"], redirects=redirects, report=report, **kwargs)
+        return {"path": path, "url": newurl, "report": report}
+
+    def coalesced_fetch(request):
+        key = json.dumps(request, sort_keys=True)
+        with inflight_lock:
+            leader = key not in inflight
+            if leader:
+                inflight[key] = (threading.Event(), {})
+            done, result = inflight[key]
+        if leader:
+            try:
+                result.update(do_fetch(request))
+            except Exception as err:
+                result.update({"path": None, "url": request["url"],
+                               "report": {"status": "error", "error": str(err),
+                                          "error_class": error_class(err)}})
+            finally:
+                with inflight_lock:
+                    del inflight[key]
+                done.set()
+        else:
+            done.wait()
+        return result
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                request = json.loads(self.rfile.readline())
+            except ValueError:
+                return
+            if "ping" in request:
+                answer = {"pong": True}
+            else:
+                done = threading.Event()
+
+                def heartbeat():
+                    while not done.wait(_DAEMON_HEARTBEAT):
+                        try:
+                            self.wfile.write(b" ")
+                        except OSError:
+                            return
+                beating = threading.Thread(target=heartbeat, daemon=True)
+                beating.start()
+                try:
+                    answer = coalesced_fetch(request)
+                finally:
+                    done.set()
+                    beating.join()
+            self.wfile.write(json.dumps(answer).encode() + b"\n")
+
+    server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    os.chmod(path, 0o600)
+    inode = os.stat(path).st_ino
+    server.daemon_threads = True
+    server.timeout = _DAEMON_HEARTBEAT
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(_("netcache daemon listening on %s") % path)
+
+    # The socket may have been removed (by a client which found the daemon
+    # stuck) or replaced by another daemon: nobody can reach this one anymore
+    def own_socket():
+        try:
+            return os.stat(path).st_ino == inode
+        except OSError:
+            return False
+    try:
+        while own_socket():
+            server.handle_request()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        flush_cookiejars()
+        if own_socket():
+            os.remove(path)
+
+
+# Fetch urls concurrently (used by "netcache --batch")
+# At most "workers" fetches are running and at most "per_host" for a given host.
+# For each url, a JSON line is written in output as soon as it is fetched.
+def fetch_batch(urls, workers=4, per_host=2, output=None, **kwargs):
+    import concurrent.futures
+    import json
+
+    if output is None:
+        output = sys.stdout
+    host_locks = {}
+    host_locks_lock = threading.Lock()
+
+    def fetch_one(url):
+        host = urllib.parse.urlparse(url).hostname
+        with host_locks_lock:
+            if host not in host_locks:
+                host_locks[host] = threading.BoundedSemaphore(per_host)
+            lock = host_locks[host]
+        result = {"url": url}
+        report = {}
+        with lock:
+            start = time.monotonic()
+            try:
+                path, newurl = fetch(url, report=report, **kwargs)
+            except Exception as err:
+                path, newurl = None, url
+                report["status"] = "error"
+                report["error"] = str(err)
+                report["error_class"] = error_class(err)
+            result["time"] = round(time.monotonic() - start, 3)
+        result["final_url"] = newurl
+        result["path"] = path
+        if path and os.path.isfile(path):
+            result["mime"] = ansicat.get_mime(path, url=newurl)
+            result["bytes"] = os.path.getsize(path)
+        else:
+            result["mime"] = None
+            result["bytes"] = 0
+        result["status"] = report.get("status", "unsupported")
+        result["error"] = report.get("error")
+        result["error_class"] = report.get("error_class")
+        return result
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fetch_one, url) for url in urls]
+        for future in concurrent.futures.as_completed(futures):
+            output.write(json.dumps(future.result()) + "\n")
+            output.flush()
+
+
 def main():
     descri = _("Netcache is a command-line tool to retrieve, cache and access networked content.\n\
             By default, netcache will returns a cached version of a given URL, downloading it \
@@ -1328,6 +1850,28 @@ def main():
         help=_("maximum age, in second, of the cached version before \
                                 redownloading a new version"),
     )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help=_("run as a daemon doing the fetching for all offpunk tools until interrupted"),
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help=_("read URLs from stdin, fetch them concurrently and write one JSON line per URL"),
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help=_("number of concurrent fetches in batch mode (default: 4)"),
+    )
+    parser.add_argument(
+        "--per-host",
+        type=int,
+        default=2,
+        help=_("maximum number of concurrent fetches to the same host in batch mode (default: 2)"),
+    )
     # No argument: write help
     parser.add_argument(
         "url",
@@ -1339,6 +1883,30 @@ def main():
     # --force-download : download and replace cache, even if valid
     args = parser.parse_args()
     param = {}
+    redirects = offutils.redirect_list(offblocklist.redirects, offblocklist.blocked,
+                                       offutils.load_blocklists())
+    max_size = args.max_size * 1000000 if args.max_size else None
+
+    if args.serve:
+        serve()
+        return
+    if args.batch:
+        urls = [line.strip() for line in sys.stdin if line.strip()]
+        urls += args.url
+        kwargs = {}
+        if args.timeout:
+            kwargs["timeout"] = args.timeout
+        # Progress messages from fetch should not be mixed with the JSON output
+        output = sys.stdout
+        sys.stdout = sys.stderr
+        try:
+            fetch_batch(urls, workers=max(1, args.workers), per_host=max(1, args.per_host),
+                        output=output, offline=args.offline, max_size=max_size,
+                        validity=args.cache_validity, redirects=redirects, interactive=False,
+                        **kwargs)
+        finally:
+            sys.stdout = output
+        return
 
     for u in args.url:
         if args.offline:
@@ -1348,11 +1916,10 @@ def main():
         else:
             path, url = fetch(
                 u,
-                max_size=args.max_size,
+                max_size=max_size,
                 timeout=args.timeout,
                 validity=args.cache_validity,
-                redirects=offblocklist.redirects,
-                blocked=offblocklist.blocked,
+                redirects=redirects,
             )
         if args.path:
             print(path)
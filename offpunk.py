@@ -9,6 +9,7 @@ __version__ = "3.1"
 # Initial imports and conditional imports {{{
 import argparse
 import cmd
+import json
 import os
 import os.path
 import shutil
@@ -25,6 +26,7 @@ import offthemes
 import openk
 from offutils import (
     is_local,
+    set_umask,
     looks_like_url,
     mode_url,
     run,
@@ -39,6 +41,11 @@ from offutils import (
     _LESS_RESTORE_POSITION,
     edit_file,
     clean_url,
+    atomic_open,
+    file_lock,
+    is_profiling,
+    profile_report,
+    set_profiling,
 )
 
 gettext.bindtextdomain('offpunk', _LOCALE_DIR)
@@ -165,6 +172,173 @@ def needs_gi(inner):
     outer.__doc__ = inner.__doc__
     return outer
 
+# Statistics about a sync, written by "offpunk --sync --metrics-file PATH"
+# in JSON or, if PATH ends with ".prom", in the OpenMetrics text format
+# (which can be read by the node_exporter textfile collector).
+class SyncMetrics:
+    def __init__(self):
+        self.start = time.time()
+        self.duration = None
+        self.current_list = None
+        self.lists = {}
+        self.protocols = {}
+        self.errors = {}
+        self.errors_by_host = {}
+        self.latencies = []
+
+    @staticmethod
+    def _new_group():
+        return {"urls": 0, "cached": 0, "new": 0, "refreshed": 0, "unchanged": 0,
+                "errors": 0, "blocked": 0, "bytes": 0, "new_tour_items": 0,
+                "latencies": []}
+
+    def _groups(self, url):
+        protocol = urllib.parse.urlparse(url).scheme or "file"
+        if self.current_list not in self.lists:
+            self.lists[self.current_list] = self._new_group()
+        if protocol not in self.protocols:
+            self.protocols[protocol] = self._new_group()
+        return self.lists[self.current_list], self.protocols[protocol]
+
+    # report is the report of netcache.fetch (plus "path")
+    # isnew is True if there was no previous version of url in the cache
+    def add_fetch(self, url, report, latency, isnew):
+        status = report.get("status", "unsupported")
+        # what was received, not the size of the cache (after a 304, nothing)
+        size = report.get("bytes") or 0
+        for group in self._groups(url):
+            group["urls"] += 1
+            group["bytes"] += size
+            if status == "cached":
+                group["cached"] += 1
+            elif status == "fetched":
+                if report.get("unchanged"):
+                    group["unchanged"] += 1
+                else:
+                    group["new" if isnew else "refreshed"] += 1
+                group["latencies"].append(latency)
+            elif status == "blocked":
+                group["blocked"] += 1
+            else:
+                group["errors"] += 1
+        if status == "fetched":
+            self.latencies.append(latency)
+        elif status not in ("cached", "blocked"):
+            err = report.get("error_class") or status
+            self.errors[err] = self.errors.get(err, 0) + 1
+            host = urllib.parse.urlparse(url).hostname or url
+            self.errors_by_host[host] = self.errors_by_host.get(host, 0) + 1
+
+    # url was still in the cache, we didn’t try to fetch it
+    def add_cached(self, url):
+        for group in self._groups(url):
+            group["urls"] += 1
+            group["cached"] += 1
+
+    def add_tour_item(self, url):
+        for group in self._groups(url):
+            group["new_tour_items"] += 1
+
+    def stop(self):
+        self.duration = time.time() - self.start
+
+    @staticmethod
+    def percentiles(values):
+        # nearest-rank percentiles, in seconds
+        result = {}
+        values = sorted(values)
+        for p in (50, 90, 99):
+            if values:
+                rank = max(1, -(-len(values) * p // 100))
+                result["p%s" % p] = round(values[rank - 1], 4)
+            else:
+                result["p%s" % p] = None
+        return result
+
+    def _summary(self, group):
+        summary = dict(group)
+        summary["latency"] = self.percentiles(summary.pop("latencies"))
+        return summary
+
+    def to_dict(self):
+        totals = self._new_group()
+        for group in self.lists.values():
+            for key in totals:
+                if key != "latencies":
+                    totals[key] += group[key]
+        totals["latencies"] = self.latencies
+        return {
+            "start": int(self.start),
+            "duration": round(self.duration or time.time() - self.start, 3),
+            "total": self._summary(totals),
+            "lists": {name: self._summary(g) for name, g in self.lists.items()},
+            "protocols": {name: self._summary(g) for name, g in self.protocols.items()},
+            "errors": self.errors,
+            "errors_by_host": self.errors_by_host,
+        }
+
+    def to_openmetrics(self):
+        data = self.to_dict()
+
+        def escape(value):
+            value = str(value).replace("\\", "\\\\").replace("\n", "\\n")
+            return value.replace('"', '\\"')
+
+        lines = []
+
+        def metric(name, samples, help_text, kind="gauge"):
+            lines.append("# HELP offpunk_sync_%s %s" % (name, help_text))
+            lines.append("# TYPE offpunk_sync_%s %s" % (name, kind))
+            for labels, value in samples:
+                if value is None:
+                    continue
+                labels = ",".join('%s="%s"' % (k, escape(v)) for k, v in labels)
+                if labels:
+                    labels = "{" + labels + "}"
+                lines.append("offpunk_sync_%s%s %s" % (name, labels, value))
+
+        metric("start_timestamp_seconds", [((), data["start"])], "Start of the last sync.")
+        metric("duration_seconds", [((), data["duration"])], "Wall time of the last sync.")
+        counters = [("urls", "URLs processed."),
+                    ("cached", "URLs still valid in the cache."),
+                    ("new", "URLs fetched for the first time."),
+                    ("refreshed", "URLs fetched again."),
+                    ("unchanged", "URLs not modified since they were cached (HTTP 304)."),
+                    ("errors", "URLs which could not be fetched."),
+                    ("blocked", "URLs blocked by a rule or a blocklist."),
+                    ("bytes", "Bytes downloaded."),
+                    ("new_tour_items", "Items added to the tour.")]
+        for key, help_text in counters:
+            samples = [((("list", name),), g[key]) for name, g in data["lists"].items()]
+            samples += [((("protocol", name),), g[key]) for name, g in data["protocols"].items()]
+            metric(key, samples, help_text)
+        samples = []
+        for name, g in data["protocols"].items():
+            for p, value in g["latency"].items():
+                quantile = str(int(p[1:]) / 100)
+                samples.append(((("protocol", name), ("quantile", quantile)), value))
+        metric("fetch_latency_seconds", samples, "Fetch latency percentiles.", kind="summary")
+        for name, g in self.protocols.items():
+            latencies = g["latencies"]
+            lines.append('offpunk_sync_fetch_latency_seconds_sum{protocol="%s"} %s'
+                         % (escape(name), round(sum(latencies), 4)))
+            lines.append('offpunk_sync_fetch_latency_seconds_count{protocol="%s"} %s'
+                         % (escape(name), len(latencies)))
+        metric("errors_by_class", [((("class", c),), n) for c, n in data["errors"].items()],
+               "Errors by class (dns, timeout, tofu, curl-N, etc.).")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        path = os.path.expanduser(path)
+        if path.endswith(".prom"):
+            content = self.to_openmetrics()
+        else:
+            content = json.dumps(self.to_dict(), indent=2) + "\n"
+        with atomic_open(path) as f:
+            f.write(content)
+
+
 #red warning to print
 REDERROR="\x1b[1;31m"+_("Error: ")+"\x1b[0m"
 
@@ -174,7 +348,7 @@ class GeminiClient(cmd.Cmd):
         # Set umask so that nothing we create can be read by anybody else.
         # The certificate cache and TOFU database contain "browser history"
         # type sensitive information.
-        os.umask(0o077)
+        set_umask(0o077)
         self.opencache = openk.opencache()
         self.theme = offthemes.default
         self.current_url = None
@@ -217,9 +391,19 @@ class GeminiClient(cmd.Cmd):
             "prompt_off": "OFF",
             "prompt_close": "> ",
             "gemini_images": True,
+            # print the time spent in each step of a command
+            "profile": False,
+            # if set, a cProfile dump of each command is written in that folder
+            "profile_dump": None,
+            # renderings are kept on disk to reopen pages faster in a new session
+            "render_cache": True,
+            # memory used by the renderers of the pages opened in the session
+            "render_cache_mb": openk._RENDER_CACHE_MB,
         }
+        self.profiler = None
+        self.profile_start = None
+        self.profile_count = 0
         self.set_prompt("ON")
-        self.opencache.redirects = offblocklist.redirects
         for i in offblocklist.blocked:
             self.opencache.redirects[i] = "blocked"
         for i in offblocklist.whitelisted:
@@ -331,6 +515,7 @@ class GeminiClient(cmd.Cmd):
         mode=None,
         limit_size=False,
         force_large_download=False,
+        report=None,
     ):
         """This method might be considered "the heart of Offpunk".
         Everything involved in fetching a gemini resource happens here:
@@ -374,6 +559,7 @@ class GeminiClient(cmd.Cmd):
         params["gemini_images"] = self.options["gemini_images"]
         # available linkmode are "none" and "end".
         params["linkmode"] = self.options["linkmode"]
+        params["render_cache"] = self.options["render_cache"]
         if force_refresh:
             params["validity"] = 1
         elif not self.offline_only:
@@ -404,7 +590,10 @@ class GeminiClient(cmd.Cmd):
         else:
             # we are asked not to handle or in sync_only mode
             if netcache.load_HTTP() or parsed.scheme not in ["http", "https"]:
-                netcache.fetch(url, redirects=self.opencache.redirects,**params)
+                path, url = netcache.fetch(url, redirects=self.opencache.redirects,
+                                           report=report, **params)
+                if report is not None:
+                    report["path"] = path
 
     @needs_gi
     def _show_lookup(self, offset=0, end=None, show_url=False):
@@ -504,6 +693,10 @@ class GeminiClient(cmd.Cmd):
             toprint += "--------------------\n"
             for r in self.opencache.redirects:
                 toprint += "%s\t->\t%s\n" % (r, self.opencache.redirects[r])
+            blocklist = self.opencache.redirects.blocklist
+            if blocklist:
+                toprint += _("%s domains are also blocked by the lists in %s\n") % (
+                    len(blocklist), os.path.join(xdg("config"), "blocklists"))
             toprint += "\n"
             toprint += _('To add new, use "redirect origin.com destination.org"')
             toprint += "\n"
@@ -514,6 +707,9 @@ class GeminiClient(cmd.Cmd):
             toprint += _('To block also subdomains, prefix with *: "redirect *origin.com BLOCK"')
             toprint += "\n"
             toprint += _('To always fully display a website, use "redirect origin.com WHITELIST"')
+            toprint += "\n"
+            toprint += _('Hosts files and lists of domains to block can be put in %s') % (
+                os.path.join(xdg("config"), "blocklists"))
             print(toprint)
 
     def do_set(self, line):
@@ -556,6 +752,20 @@ class GeminiClient(cmd.Cmd):
                     term_width(new_width=value)
                 else:
                     print(_("%s is not a valid width (integer required)") % value)
+            elif option == "render_cache_mb":
+                try:
+                    value = float(value)
+                except ValueError:
+                    print(_("%s is not a valid size in MB") % value)
+                    return
+                if value.is_integer():
+                    value = int(value)
+            elif option == "profile_dump":
+                # a folder, or None to stop writing the dumps
+                if value.strip().lower() in ("none", "", '""'):
+                    value = None
+                elif value.startswith('"') and value.endswith('"'):
+                    value = value[1:-1]
             elif option == "linkmode":
                 if value.lower() not in ("none", "end"):
                     print(_("Available linkmode are `none` and `end`."))
@@ -576,8 +786,13 @@ class GeminiClient(cmd.Cmd):
                     pass
             self.options[option] = value
             #We clean the cache for some options that affect rendering
-            if option in ["preformat_wrap","width", "linkmode","gemini_images"]:
+            if option in ["preformat_wrap", "linkmode","gemini_images"]:
                 self.opencache.cleanup()
+            elif option == "profile":
+                set_profiling(value)
+            elif option == "render_cache_mb":
+                self.opencache.render_cache_mb = value
+                self.opencache.limit_renderers()
 
     def do_theme(self, line):
         """Change the colors of your rendered text.
@@ -1047,7 +1262,7 @@ class GeminiClient(cmd.Cmd):
             cj = netcache.get_cookiejar(url, create=True)
             try:
                 cj.load(os.path.expanduser(al[1]))
-                cj.save()
+                netcache.mark_cookiejar_dirty(cj)
             except FileNotFoundError:
                 print(_("File not found"))
                 return
@@ -1297,7 +1512,8 @@ class GeminiClient(cmd.Cmd):
         else:
             rend = "None"
         out += _("Renderer :   ") + rend + "\n"
-        out += _("Cleaned with : ") + renderer.get_cleanlib() + "\n\n"
+        out += _("Cleaned with : ") + renderer.get_cleanlib() + "\n"
+        out += _("In memory    : ") + self.opencache.renderers_info() + "\n\n"
         lists = []
         for l in self.list_lists():
             if self.list_has_url(url, l):
@@ -1489,6 +1705,48 @@ class GeminiClient(cmd.Cmd):
         self.do_links(line)
 
 
+    def postcmd(self, stop, line):
+        # Cookies modified during the command are written only once
+        netcache.flush_cookiejars()
+        return stop
+
+    # Commands from the config file or --command don’t go through
+    # precmd/postcmd so they are profiled here
+    def onecmd(self, line):
+        self.start_profile()
+        try:
+            return super().onecmd(line)
+        finally:
+            self.stop_profile(line)
+
+    # With "set profile True", we time each command (see offutils.span)
+    def start_profile(self):
+        if not is_profiling():
+            return
+        # We forget what happened between two commands
+        profile_report()
+        if self.options["profile_dump"]:
+            import cProfile
+
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.profile_start = time.perf_counter()
+
+    def stop_profile(self, line):
+        if self.profiler:
+            self.profiler.disable()
+            self.profile_count += 1
+            folder = os.path.expanduser(str(self.options["profile_dump"]))
+            os.makedirs(folder, exist_ok=True)
+            name = "".join(c for c in line.split(" ")[0] if c.isalnum()) or "cmd"
+            dump = os.path.join(folder, "%s-%03d-%s.prof" % (os.getpid(), self.profile_count, name))
+            self.profiler.dump_stats(dump)
+            self.profiler = None
+        if is_profiling() and self.profile_start is not None:
+            wall = time.perf_counter() - self.profile_start
+            print(profile_report(title=line.strip() or "(empty line)", wall=wall))
+        self.profile_start = None
+
     def emptyline(self):
         """Default action when line is empty"""
         if "default_cmd" in self.options:
@@ -1892,9 +2150,8 @@ Use "view XX" where XX is a number to view information about link XX.
                 if verbose:
                     print(_("%s has updated mode in %s to %s") % (url, list, mode))
             else:
-                with open(list_path, "a") as l_file:
+                with file_lock(list_path), open(list_path, "a") as l_file:
                     l_file.write(self.to_map_line(url))
-                    l_file.close()
                 if verbose:
                     #TRANSLATORS parameters are url, list
                     print(_("%s added to %s") % (url, list))
@@ -1912,37 +2169,36 @@ Use "view XX" where XX is a number to view information about link XX.
             stri += _(", added to %s on ") % list
         stri += time.ctime() + "\n"
         list_path = self.get_list(list)
-        # We read the whole list
-        with open(list_path, "r") as l_file:
-            lines = l_file.readlines()
-            l_file.close()
-        # Now, we write it back, 
-        with open(list_path, "w") as l_file:
-            l_file.write("#%s\n" % list)
-            l_file.write(stri)
-            counter = 0
-            previous_line = stri
-            # Truncating is useful in case we open a new branch
-            # after a few back in history
-            to_truncate = truncate_lines
-            for l in lines:
-                # Removing duplicate lines of the same URL
-                # when there are in a row
-                if not l.startswith("#") and len(l.split(" ")) >= 2:
-                    previousurl = unmode_url(previous_line.split(" ")[1])[0]
-                    currenturl = unmode_url(l.split(" ")[1])[0]
-                    similar = previousurl == currenturl 
-                    if not similar : 
-                        if to_truncate > 0:
-                            to_truncate -= 1
-                        elif limit == 0 or counter < limit:
-                            previous_line = l
-                            l_file.write(l)
-                            counter += 1
-                    else:
-                        # even if similar, we should handle back/forward 
-                        if to_truncate > 0: to_truncate -= 1
-            l_file.close()
+        with file_lock(list_path):
+            # We read the whole list
+            with open(list_path, "r") as l_file:
+                lines = l_file.readlines()
+            # Now, we write it back, 
+            with atomic_open(list_path, "w") as l_file:
+                l_file.write("#%s\n" % list)
+                l_file.write(stri)
+                counter = 0
+                previous_line = stri
+                # Truncating is useful in case we open a new branch
+                # after a few back in history
+                to_truncate = truncate_lines
+                for l in lines:
+                    # Removing duplicate lines of the same URL
+                    # when there are in a row
+                    if not l.startswith("#") and len(l.split(" ")) >= 2:
+                        previousurl = unmode_url(previous_line.split(" ")[1])[0]
+                        currenturl = unmode_url(l.split(" ")[1])[0]
+                        similar = previousurl == currenturl 
+                        if not similar : 
+                            if to_truncate > 0:
+                                to_truncate -= 1
+                            elif limit == 0 or counter < limit:
+                                previous_line = l
+                                l_file.write(l)
+                                counter += 1
+                        else:
+                            # even if similar, we should handle back/forward 
+                            if to_truncate > 0: to_truncate -= 1
 
     # remove an url from a list.
     # return True if the URL was removed
@@ -1962,49 +2218,54 @@ Use "view XX" where XX is a number to view information about link XX.
     ):
         list_path = self.list_path(list)
         if list_path:
-            to_return = False
-            with open(list_path, "r") as lf:
-                lines = lf.readlines()
-                lf.close()
-            to_write = []
-            # let’s remove the mode
-            if not exact_mode:
-                url = unmode_url(url)[0]
-            for l in lines:
-                # we separate components of the line
-                # to ensure we identify a complete URL, not a part of it
-                splitted = l.split()
-                if url not in splitted and len(splitted) > 1:
-                    current = unmode_url(splitted[1])[0]
-                    # sometimes, we must remove the ending "/"
-                    if url == current or (url.endswith("/") and url[:-1] == current):
-                        to_return = True
-                        if update_mode:
-                            new_line = l.replace(current, mode_url(url, update_mode))
-                            to_write.append(new_line)
-                        elif not deletion:
-                            to_write.append(l)
-                    else:
-                        to_write.append(l)
-                elif url in splitted:
+            # We only need to lock the list if we modify it
+            if deletion or update_mode:
+                with file_lock(list_path):
+                    return self._list_has_url(list_path, url, deletion, exact_mode, update_mode)
+            return self._list_has_url(list_path, url, deletion, exact_mode, update_mode)
+        else:
+            return False
+
+    def _list_has_url(self, list_path, url, deletion, exact_mode, update_mode):
+        to_return = False
+        with open(list_path, "r") as lf:
+            lines = lf.readlines()
+        to_write = []
+        # let’s remove the mode
+        if not exact_mode:
+            url = unmode_url(url)[0]
+        for l in lines:
+            # we separate components of the line
+            # to ensure we identify a complete URL, not a part of it
+            splitted = l.split()
+            if url not in splitted and len(splitted) > 1:
+                current = unmode_url(splitted[1])[0]
+                # sometimes, we must remove the ending "/"
+                if url == current or (url.endswith("/") and url[:-1] == current):
                     to_return = True
-                    # We update the mode if asked by replacing the old url
-                    # by a moded one in the same line
                     if update_mode:
-                        new_line = l.replace(url, mode_url(url, update_mode))
+                        new_line = l.replace(current, mode_url(url, update_mode))
                         to_write.append(new_line)
                     elif not deletion:
                         to_write.append(l)
                 else:
                     to_write.append(l)
-            if deletion or update_mode:
-                with open(list_path, "w") as lf:
-                    for l in to_write:
-                        lf.write(l)
-                    lf.close()
-            return to_return
-        else:
-            return False
+            elif url in splitted:
+                to_return = True
+                # We update the mode if asked by replacing the old url
+                # by a moded one in the same line
+                if update_mode:
+                    new_line = l.replace(url, mode_url(url, update_mode))
+                    to_write.append(new_line)
+                elif not deletion:
+                    to_write.append(l)
+            else:
+                to_write.append(l)
+        if deletion or update_mode:
+            with atomic_open(list_path, "w") as lf:
+                for l in to_write:
+                    lf.write(l)
+        return to_return
 
     def list_get_links(self, list):
         list_path = self.list_path(list)
@@ -2135,25 +2396,24 @@ Use "view XX" where XX is a number to view information about link XX.
     # action is either #frozen, #subscribed or None
     def list_modify(self, list, action=None):
         path = self.list_path(list)
-        with open(path) as f:
-            lines = f.readlines()
-            f.close()
-        if lines[0].strip().startswith("#"):
-            first_line = lines.pop(0).strip("\n")
-        else:
-            first_line = "# %s " % list
-        first_line = first_line.replace("#subscribed", "").replace("#frozen", "")
-        if action:
-            first_line += " " + action
-            print(_("List %s has been marked as %s") % (list, action))
-        else:
-            print(_("List %s is now a normal list") % list)
-        first_line += "\n"
-        lines.insert(0, first_line)
-        with open(path, "w") as f:
-            for line in lines:
-                f.write(line)
-            f.close()
+        with file_lock(path):
+            with open(path) as f:
+                lines = f.readlines()
+            if lines[0].strip().startswith("#"):
+                first_line = lines.pop(0).strip("\n")
+            else:
+                first_line = "# %s " % list
+            first_line = first_line.replace("#subscribed", "").replace("#frozen", "")
+            if action:
+                first_line += " " + action
+                print(_("List %s has been marked as %s") % (list, action))
+            else:
+                print(_("List %s is now a normal list") % list)
+            first_line += "\n"
+            lines.insert(0, first_line)
+            with atomic_open(path, "w") as f:
+                for line in lines:
+                    f.write(line)
 
     def do_list(self, arg):
         """Manage list of bookmarked pages.
@@ -2309,7 +2569,8 @@ Use "view XX" where XX is a number to view information about link XX.
             validity = 0
         self.call_sync(refresh_time=validity)
 
-    def call_sync(self, refresh_time=0, depth=1, lists=None):
+    def call_sync(self, refresh_time=0, depth=1, lists=None, metrics_file=None,
+                  prerender=False):
         # fetch_url is the core of the sync algorithm.
         # It takes as input :
         # - an URL to be fetched
@@ -2325,6 +2586,7 @@ Use "view XX" where XX is a number to view information about link XX.
                 toprint += " " * (width - len(toprint))
                 print(toprint)
                 self.list_add_line("tour", url=url, verbose=False)
+                metrics.add_tour_item(url)
                 return True
             else:
                 return False
@@ -2352,12 +2614,22 @@ Use "view XX" where XX is a number to view information about link XX.
                 print(toprint, end=endline)
                 # If not saving to tour, then we should limit download size
                 limit = not savetotour
+                report = {}
+                start = time.monotonic()
                 self._go_to_url(url, update_hist=False, limit_size=limit,\
-                        force_large_download=force_large_download)
+                        force_large_download=force_large_download, report=report)
+                metrics.add_fetch(url, report, time.monotonic() - start, isnew)
+                # The page is rendered now so it opens instantly later
+                if prerender and report.get("status") == "fetched":
+                    r = self.get_renderer(url)
+                    if r:
+                        r.get_body(mode=unmode_url(url)[1] or "readable")
                 if savetotour and isnew and netcache.is_cache_valid(url):
                     # we add to the next tour only if we managed to cache
                     # the resource
                     add_to_tour(url)
+            else:
+                metrics.add_cached(url)
             # Now, recursive call, even if we didn’t refresh the cache
             # This recursive call is impacting performances a lot but is needed
             # For the case when you add a address to a list to read later
@@ -2398,6 +2670,7 @@ Use "view XX" where XX is a number to view information about link XX.
             links = self.list_get_links(list)
             end = len(links)
             counter = 0
+            metrics.current_list = list
             print(_(" * * * %s to fetch in %s * * *") % (end, list))
             for l in links:
                 counter += 1
@@ -2415,6 +2688,7 @@ Use "view XX" where XX is a number to view information about link XX.
                         self.list_rm_url(l, list)
 
         self.sync_only = True
+        metrics = SyncMetrics()
         if not lists:
             lists = self.list_lists()
         # We will fetch all the lists except "archives" and "history"
@@ -2452,6 +2726,11 @@ Use "view XX" where XX is a number to view information about link XX.
             fetch_list(l, validity=0, depth=depth)
         # tour should be the last one as item my be added to it by others
         fetch_list("tour", validity=refresh_time, depth=depth)
+        netcache.flush_cookiejars()
+        ansicat.prune_render_cache()
+        metrics.stop()
+        if metrics_file:
+            metrics.write(metrics_file)
         print(_("End of sync"))
         self.sync_only = False
 
@@ -2462,7 +2741,9 @@ Use "view XX" where XX is a number to view information about link XX.
     # The end!
     def do_quit(self, *args):
         """Exit Offpunk."""
+        netcache.flush_cookiejars()
         self.opencache.cleanup()
+        ansicat.prune_render_cache()
         print(_("You can close your screen!"))
         sys.exit()
 
@@ -2521,6 +2802,26 @@ def main():
         "--cache-validity",
         help=_("duration for which a cache is valid before sync (seconds)"),
     )
+    parser.add_argument(
+        "--metrics-file",
+        metavar="FILE",
+        help=_("with --sync, write statistics about the sync in FILE (JSON, or OpenMetrics if FILE ends with .prom)"),
+    )
+    parser.add_argument(
+        "--prerender",
+        action="store_true",
+        help=_("with --sync, also render the pages fetched so they open instantly"),
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help=_("print the time spent in each step of every command (or of the sync)"),
+    )
+    parser.add_argument(
+        "--profile-dump",
+        metavar="FOLDER",
+        help=_("write a cProfile dump of each command in FOLDER (implies --profile)"),
+    )
     parser.add_argument(
         "--version", action="store_true", help=_("display version information and quit")
     )
@@ -2568,6 +2869,10 @@ def main():
 
     if args.disable_http:
         gc.support_http = False
+    if args.profile or args.profile_dump:
+        gc.options["profile"] = True
+        gc.options["profile_dump"] = args.profile_dump
+        set_profiling(True)
 
     # Endless interpret loop (except while --sync or --fetch-later)
     if args.fetch_later:
@@ -2606,7 +2911,10 @@ def main():
         for line in torun_queue:
             # This doesn’t seem to run on sync. Why?
             gc.onecmd(line)
-        gc.call_sync(refresh_time=refresh_time, depth=depth, lists=args.url)
+        gc.start_profile()
+        gc.call_sync(refresh_time=refresh_time, depth=depth, lists=args.url,
+                     metrics_file=args.metrics_file, prerender=args.prerender)
+        gc.stop_profile("sync")
     else:
         # We are in the normal mode. First process config file
         torun_queue += init_config(rcfile=args.config_file,interactive=True)
@@ -6,15 +6,30 @@
 # run : run a shell command and get the results with some security
 # term_width : get or set the width to display on the terminal
 
+import array
+import bisect
+import contextlib
+import functools
 import gettext
+import hashlib
 import io
+import json
 import os
+import re
 import shlex
 import shutil
 import subprocess
 import sys
 import urllib.parse
 import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory locks on this platform (Windows)
+    fcntl = None
 
 import netcache
 
@@ -159,6 +174,7 @@ CMDS["cat"] = less_base + " -EF %s"
 
 # We upgrade the cache only once at startup, hence the CACHE_UPGRADED variable
 # This is only to avoid unnecessary checks each time the cache is accessed
+# (it contains the last upgraded folder, in case OFFPUNK_CACHE_PATH changes)
 CACHE_UPGRADED = False
 
 
@@ -184,7 +200,8 @@ def upgrade_cache(cache_folder):
         with open(version_path, "w") as f:
             f.write(str(current_version))
             f.close()
-    CACHE_UPGRADED = True
+    global CACHE_UPGRADED
+    CACHE_UPGRADED = cache_folder
 
 
 CERT_UPGRADED = False
@@ -217,7 +234,8 @@ def upgrade_cert(config_folder: str, data_folder: str) -> None:
         with open(version_path, "w") as f:
             f.write(str(current_version))
             f.close()
-    CERT_UPGRADED = True
+    global CERT_UPGRADED
+    CERT_UPGRADED = data_folder
 
 
 # get xdg folder. Folder should be "cache", "data" or "config"
@@ -248,14 +266,14 @@ def xdg(folder="cache"):
     if not _CACHE_PATH.endswith("/"):
         _CACHE_PATH += "/"
     os.makedirs(_CACHE_PATH, exist_ok=True)
-    if folder == "cache" and not CACHE_UPGRADED:
+    if folder == "cache" and CACHE_UPGRADED != _CACHE_PATH:
         upgrade_cache(_CACHE_PATH)
     if folder == "cache":
         return _CACHE_PATH
     elif folder == "config":
         return _CONFIG_DIR
     elif folder == "data":
-        if not CERT_UPGRADED:
+        if CERT_UPGRADED != _DATA_DIR:
             upgrade_cert(_CONFIG_DIR, _DATA_DIR)
         return _DATA_DIR
     else:
@@ -502,6 +520,152 @@ def urlify(url):
         newparsed = parsed._replace(path=newpath)
         return urllib.parse.urlunparse(newparsed)
 
+# The MIME type of an image from its first bytes (None if it is not a known
+# image format). Faster than running "file" for each image.
+_IMAGE_MAGIC = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+    (b"\x00\x00\x01\x00", "image/vnd.microsoft.icon"),
+    (b"qoif", "image/qoi"),
+    (b"\xff\x0a", "image/jxl"),
+    (b"\x00\x00\x00\x0cJXL \r\n\x87\n", "image/jxl"),
+]
+
+
+def sniff_image(data):
+    for magic, mime in _IMAGE_MAGIC:
+        if data.startswith(magic):
+            return mime
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[4:8] == b"ftyp" and data[8:12] in (b"avif", b"avis", b"heic", b"heix", b"mif1"):
+        return "image/avif" if data[8:11] == b"avi" else "image/heif"
+    # netpbm: P1 to P6 followed by a space
+    if len(data) > 2 and data[:1] == b"P" and data[1:2] in b"123456" and data[2:3].isspace():
+        return "image/x-portable-anymap"
+    text = data[:1024].lstrip()
+    if text.startswith((b"<svg", b"<?xml", b"<!DOCTYPE svg")) and b"<svg" in text:
+        return "image/svg+xml"
+    return None
+
+# The MIME type of a file from its first bytes, as "file --mime-type" would
+# give it for the documents we render (and with the same quirks, as
+# get_mime() is written for them). None if we can’t tell: "file" has to decide.
+SNIFF_SIZE = 4096
+# file looks for those tags anywhere in the first 4096 bytes
+_HTML_TAGS = re.compile(rb"<(?:!doctype\s+html|(?:head|title|html|script|style|table)[\s>]"
+                        rb"|a\s+href=)", re.IGNORECASE)
+_TEXT_MAGIC = [
+    (b"-----BEGIN PGP PUBLIC KEY BLOCK-----", "application/pgp-keys"),
+    (b"-----BEGIN PGP SIGNATURE-----", "application/pgp-signature"),
+    (b"-----BEGIN PGP", None),
+    (b"Path:", "message/news"),
+    (b"Xref:", "message/news"),
+    (b"Article ", None),
+    (b"From:", "message/rfc822"),
+    (b"Return-Path:", "message/rfc822"),
+    (b"Received:", "message/rfc822"),
+    (b"Relay-Version:", "message/rfc822"),
+    # scripts, json, postscript…
+    (b"#!", None),
+    (b"<?php", None),
+    (b"{", None),
+    (b"[", None),
+    (b"%!", None),
+]
+_BINARY_MAGIC = [
+    (b"%PDF-", "application/pdf"),
+    (b"\x1f\x8b", "application/gzip"),
+]
+
+
+def sniff_mime(data):
+    data = data[:SNIFF_SIZE]
+    if data.startswith(b"\xef\xbb\xbf"):
+        data = data[3:]
+    elif data.startswith((b"\xff\xfe", b"\xfe\xff")):
+        # UTF-16
+        return None
+    mime = sniff_image(data)
+    if mime:
+        return mime
+    for magic, mime in _BINARY_MAGIC:
+        if data.startswith(magic):
+            return mime
+    if b"\x00" in data:
+        return None
+    if data.startswith(b"<?xml"):
+        return "text/xml"
+    for magic, mime in _TEXT_MAGIC:
+        if data.startswith(magic):
+            return mime
+    if _HTML_TAGS.search(data):
+        return "text/html"
+    return "text/plain"
+
+
+# What we know of a cached file is kept with it, as extended attributes,
+# where the filesystem supports them: the MIME type given by the server and
+# the charset of the file (declared by the server or detected). A new file
+# replacing it comes without them.
+_MIME_XATTR = "user.offpunk.mime"
+_CHARSET_XATTR = "user.offpunk.charset"
+
+
+def _set_xattr(path, name, value):
+    if value and hasattr(os, "setxattr"):
+        try:
+            os.setxattr(path, name, value.encode())
+        except OSError:
+            pass
+
+
+def _get_xattr(path, name):
+    if hasattr(os, "getxattr"):
+        try:
+            return os.getxattr(path, name).decode()
+        except (OSError, UnicodeDecodeError):
+            pass
+    return None
+
+
+def set_file_mime(path, mime):
+    _set_xattr(path, _MIME_XATTR, mime)
+
+
+def get_file_mime(path):
+    return _get_xattr(path, _MIME_XATTR)
+
+
+# The charset is only valid for the file as it was when it was set
+# (local files may be modified in place)
+def set_file_charset(path, charset):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+    _set_xattr(path, _CHARSET_XATTR, "%s %s %s" % (charset, st.st_mtime_ns, st.st_size))
+
+
+def get_file_charset(path):
+    value = _get_xattr(path, _CHARSET_XATTR)
+    if not value or value.count(" ") != 2:
+        return None
+    charset, mtime, size = value.split(" ")
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if (str(st.st_mtime_ns), str(st.st_size)) != (mtime, size):
+        return None
+    return charset
+
+
 # This method return the image URL or invent it if it’s a base64 inline image
 # It returns [url,image_data] where image_data is None for normal image
 def looks_like_base64(src, baseurl):
@@ -527,26 +691,300 @@ def looks_like_base64(src, baseurl):
     return imgurl, imgdata
 
 #if returnkey=True, we return [redirection, matching pattern]
+# Redirection rules are a dict "domain" -> "destination" (or "blocked",
+# or "whitelisted"). A key starting with "*" also matches subdomains.
+# RedirectList keeps that dict interface but compiles the rules, the first
+# time they are used, into a dict of exact hosts and a trie of reversed labels
+# for "*" rules. Matching an URL then doesn’t depend on the number of rules.
+# Any modification of the rules invalidates the compiled version.
+_TRIE_ALL = 0
+_TRIE_SUB = 1
+
+
+class RedirectList(dict):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._compiled = None
+        # Optional DomainBlocklist consulted after the rules
+        self.blocklist = getattr(args[0], "blocklist", None) if args else None
+
+    def _invalidate(self):
+        self._compiled = None
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._invalidate()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._invalidate()
+
+    def pop(self, *args):
+        self._invalidate()
+        return super().pop(*args)
+
+    def popitem(self):
+        self._invalidate()
+        return super().popitem()
+
+    def setdefault(self, key, default=None):
+        self._invalidate()
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._invalidate()
+
+    def clear(self):
+        super().clear()
+        self._invalidate()
+
+    def compile(self):
+        exact = {}
+        trie = {}
+        for key in self.keys():
+            if key.startswith("*"):
+                domain = key[1:]
+                # "*.example.com" is only for subdomains,
+                # "*example.com" is for the domain and its subdomains
+                flag = _TRIE_ALL
+                if domain.startswith("."):
+                    domain = domain[1:]
+                    flag = _TRIE_SUB
+                node = trie
+                if domain:
+                    for label in reversed(domain.split(".")):
+                        node = node.setdefault(label, {})
+                node.setdefault(flag, key)
+            else:
+                exact.setdefault(key, key)
+        self._compiled = (exact, trie)
+
+    def match_netloc(self, netloc):
+        # return the key of the rule matching netloc, None if there’s none
+        if self._compiled is None:
+            self.compile()
+        exact, trie = self._compiled
+        if netloc in exact:
+            return exact[netloc]
+        matching_key = trie.get(_TRIE_ALL)
+        node = trie
+        labels = netloc.split(".")
+        depth = len(labels)
+        for label in reversed(labels):
+            node = node.get(label)
+            if node is None:
+                break
+            depth -= 1
+            # The longest matching rule wins
+            if _TRIE_ALL in node:
+                matching_key = node[_TRIE_ALL]
+            if depth > 0 and _TRIE_SUB in node:
+                matching_key = node[_TRIE_SUB]
+        return matching_key
+
+
+# Big blocklists (ads and trackers) are files in XDG_CONFIG/offpunk/blocklists/
+# either in the "hosts" format ("0.0.0.0 domain") or with one domain per line.
+# They block the domains and their subdomains.
+# As they may contain hundreds of thousands of domains, a DomainBlocklist
+# only keeps a sorted array of 64 bits hashes of the domains (8 bytes per
+# domain) and lookups are binary searches in that array.
+# The array is saved as is in the cache so the lists are only parsed again
+# when they change.
+_BLOCKLIST_HEADER = b"OFFPUNK-BLOCKLIST 1\n"
+_NOT_BLOCKABLE = ["localhost", "localhost.localdomain", "local", "broadcasthost",
+                  "ip6-localhost", "ip6-loopback", "0.0.0.0"]
+
+
+def _domain_hash(domain):
+    return int.from_bytes(hashlib.blake2b(domain, digest_size=8).digest(), "little")
+
+
+class DomainBlocklist:
+    def __init__(self, hashes=None):
+        self.hashes = hashes if hashes is not None else array.array("Q")
+        self._digest = None
+
+    @classmethod
+    def from_domains(cls, domains):
+        return cls(array.array("Q", sorted(set(map(_domain_hash, domains)))))
+
+    def __len__(self):
+        return len(self.hashes)
+
+    # Identifies the content of the blocklist (renderings depend on it)
+    def digest(self):
+        if self._digest is None:
+            self._digest = hashlib.sha1(self.hashes).hexdigest()
+        return self._digest
+
+    def __contains__(self, domain):
+        if isinstance(domain, str):
+            domain = domain.encode()
+        h = _domain_hash(domain)
+        i = bisect.bisect_left(self.hashes, h)
+        return i < len(self.hashes) and self.hashes[i] == h
+
+    def match(self, netloc):
+        # return the blocked domain matching netloc (or a parent domain)
+        host = netloc.rpartition("@")[2].lower()
+        if host.count(":") == 1:
+            host = host.split(":")[0]
+        try:
+            host = host.encode("ascii")
+        except UnicodeEncodeError:
+            return None
+        while host:
+            if host in self:
+                return host.decode()
+            host = host.partition(b".")[2]
+        return None
+
+    def save(self, path, signature):
+        header = json.dumps({"signature": signature, "count": len(self)})
+        with open(path + ".tmp", "wb") as f:
+            f.write(_BLOCKLIST_HEADER)
+            f.write(header.encode() + b"\n")
+            f.write(self.hashes.tobytes())
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path, signature):
+        # Return None if the prebuilt file doesn’t match the signature
+        with open(path, "rb") as f:
+            if f.readline() != _BLOCKLIST_HEADER:
+                return None
+            header = json.loads(f.readline())
+            if header["signature"] != signature:
+                return None
+            hashes = array.array("Q")
+            data = f.read()
+            # a truncated file (after a crash or with a full disk) is built again
+            if len(data) != header["count"] * hashes.itemsize:
+                return None
+            hashes.frombytes(data)
+            return cls(hashes)
+
+
+def parse_blocklist(path):
+    # Return the list of domains (as bytes) of a hosts file or domain list
+    domains = []
+    with open(path, "r", errors="ignore") as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            words = line.split()
+            if len(words) > 1:
+                # hosts format: ip followed by one or more domains
+                words = words[1:]
+            for word in words:
+                # adblock style "||domain^" and "*.domain"
+                word = word.strip("|^").lower().rstrip(".")
+                if word.startswith("*."):
+                    word = word[2:]
+                if "." not in word or "/" in word or word in _NOT_BLOCKABLE:
+                    continue
+                try:
+                    domains.append(word.encode("idna"))
+                except UnicodeError:
+                    pass
+    return domains
+
+
+_BLOCKLIST = None
+
+
+def load_blocklists(folder=None):
+    # Load (once) all the blocklists from folder. Return None if there are none
+    global _BLOCKLIST
+    default_folder = folder is None
+    if default_folder:
+        if _BLOCKLIST is not None:
+            return _BLOCKLIST or None
+        folder = os.path.join(xdg("config"), "blocklists")
+    files = []
+    if os.path.isdir(folder):
+        for name in sorted(os.listdir(folder)):
+            path = os.path.join(folder, name)
+            if os.path.isfile(path) and not name.startswith("."):
+                files.append(path)
+    blocklist = False
+    if files:
+        signature = []
+        for path in files:
+            st = os.stat(path)
+            signature.append([path, st.st_mtime_ns, st.st_size])
+        prebuilt = os.path.join(xdg("cache"), "blocklists.bin")
+        try:
+            blocklist = DomainBlocklist.load(prebuilt, signature)
+        except (OSError, ValueError, KeyError):
+            blocklist = None
+        if not blocklist:
+            domains = []
+            for path in files:
+                domains += parse_blocklist(path)
+            blocklist = DomainBlocklist.from_domains(domains)
+            try:
+                blocklist.save(prebuilt, signature)
+            except OSError:
+                pass
+    if default_folder:
+        _BLOCKLIST = blocklist
+    return blocklist or None
+
+
+# The last RedirectLists made by redirect_list(), with the rules and the
+# blocked domains they were made from
+_REDIRECT_LISTS = []
+_REDIRECT_LISTS_LOCK = threading.Lock()
+
+
+# A RedirectList of the rules of redirects (any dict), of the blocked
+# domains, which don’t replace a rule of the same domain, and of blocklist
+# (by default, the one of redirects). It is reused as long as they are the
+# same, so it is only compiled once. It must not be modified.
+def redirect_list(redirects, blocked=(), blocklist=False):
+    if blocklist is False:
+        blocklist = getattr(redirects, "blocklist", None)
+    if isinstance(redirects, RedirectList) and not blocked \
+            and redirects.blocklist is blocklist:
+        return redirects
+    blocked = set(blocked)
+    with _REDIRECT_LISTS_LOCK:
+        for redirectlist, rules, blocked_domains in _REDIRECT_LISTS:
+            if redirectlist.blocklist is blocklist and blocked_domains == blocked \
+                    and rules == redirects:
+                return redirectlist
+        rules = dict(redirects)
+        redirectlist = RedirectList(rules)
+        for b in blocked:
+            redirectlist.setdefault(b, "blocked")
+        redirectlist.blocklist = blocklist
+        _REDIRECT_LISTS.insert(0, (redirectlist, rules, blocked))
+        del _REDIRECT_LISTS[8:]
+    return redirectlist
+
+
 def get_url_redirected(url,redirectlist,returnkey=False):
-    parsed =urllib.parse.urlparse(url)
-    netloc = parsed.netloc
-    if netloc.startswith("www."):
-        netloc = netloc[4:]
     matching_key = None
-    match = False
-    keys = list(redirectlist.keys())
-    while not match and len(keys) > 0:
-        key = keys.pop(0)
-        match = key == netloc
-        #We also match subdomains
-        if key.startswith("*"):
-            match = netloc.endswith(key[1:])
-        if match:
-            matching_key = key
-    if matching_key:
-        value = redirectlist[matching_key]
-    else:
-        value = None
+    value = None
+    blocklist = getattr(redirectlist, "blocklist", None)
+    if redirectlist or blocklist:
+        redirectlist = redirect_list(redirectlist)
+        parsed =urllib.parse.urlparse(url)
+        netloc = parsed.netloc
+        if netloc.startswith("www."):
+            netloc = netloc[4:]
+        matching_key = redirectlist.match_netloc(netloc)
+        if matching_key:
+            value = redirectlist[matching_key]
+        elif blocklist:
+            # rules have priority over blocklists
+            matching_key = blocklist.match(netloc)
+            if matching_key:
+                value = "blocked"
     if returnkey:
         return [value,matching_key]
     else:
@@ -563,6 +1001,140 @@ def is_url_blocked(url,redirectlist):
     if get_url_blocking_rule(url,redirectlist): return True
     else: return False
 
+# The umask can only be read by setting it, which would change it for the
+# files created meanwhile by other threads. So it is read once, at import
+# (before any thread is started), and changed only through set_umask().
+_UMASK = os.umask(0o077)
+os.umask(_UMASK)
+
+
+def set_umask(mask):
+    global _UMASK
+    os.umask(mask)
+    _UMASK = mask
+
+
+# Write a file atomically: the content is written in a temporary file in the
+# same folder which then replaces path. Readers never see a partial file.
+@contextlib.contextmanager
+def atomic_open(path, mode="w"):
+    folder = os.path.dirname(path) or "."
+    fd, tmp = tempfile.mkstemp(dir=folder, prefix=".tmp-")
+    try:
+        # mkstemp creates files readable only by us, we want the usual permissions
+        if os.path.exists(path):
+            os.chmod(tmp, os.stat(path).st_mode & 0o777)
+        else:
+            os.chmod(tmp, 0o666 & ~_UMASK)
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+# Take an advisory lock for a read-modify-write of path (a list, for example)
+# so concurrent offpunk processes don’t lose each other’s changes.
+# The lock is on a separate ".name.lock" file as path may be replaced.
+@contextlib.contextmanager
+def file_lock(path):
+    if fcntl is None:
+        yield
+        return
+    folder, name = os.path.split(path)
+    with open(os.path.join(folder, "." + name + ".lock"), "a") as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+# Lightweight tracing: code to be measured is wrapped in a named span
+#     with offutils.span("fetch.gemini"):
+# When profiling is disabled (the default), span() returns a shared no-op
+# context so the cost is a single test. When enabled ("offpunk --profile" or
+# "set profile True"), the number of calls, total and max duration of each span
+# are recorded until the next profile_report().
+_PROFILING = False
+_SPANS = {}
+_NO_SPAN = contextlib.nullcontext()
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.start
+        stats = _SPANS.get(self.name)
+        if stats is None:
+            stats = _SPANS.setdefault(self.name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += duration
+        if duration > stats[2]:
+            stats[2] = duration
+        return False
+
+
+def span(name):
+    if _PROFILING:
+        return _Span(name)
+    return _NO_SPAN
+
+
+# Decorator version of span() for whole functions
+def traced(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _PROFILING:
+                return func(*args, **kwargs)
+            with _Span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def set_profiling(enabled):
+    global _PROFILING
+    _PROFILING = bool(enabled)
+    _SPANS.clear()
+
+
+def is_profiling():
+    return _PROFILING
+
+
+# Return the time spent in each span since the last report as a table,
+# sorted by total duration. Spans can be nested ("openk" includes
+# "openk.fetch" which includes "fetch.gemini"): totals are not additive.
+def profile_report(title=None, wall=None, reset=True):
+    lines = []
+    if title:
+        if wall is not None:
+            lines.append("%s: %.1f ms" % (title, wall * 1000))
+        else:
+            lines.append(title)
+    spans = sorted(_SPANS.items(), key=lambda s: s[1][1], reverse=True)
+    if spans:
+        width = max(len(name) for name, _stats in spans)
+        for name, (calls, total, longest) in spans:
+            lines.append("  %s %6d calls %9.1f ms  (max %.1f ms)"
+                         % (name.ljust(width), calls, total * 1000, longest * 1000))
+    if reset:
+        _SPANS.clear()
+    return "\n".join(lines)
+
+
+
 # Method for editing a file, or a temporal file.
 # It will find the user's editor, and if path to edit is None,
 # it will create a temporal file, add some text_to_append to it
@@ -4,11 +4,15 @@
 # If not possible, it will fallback to xdg-open
 # URL are retrieved through netcache
 import argparse
+import collections
 import fnmatch
 import os
+import queue
 import shutil
+import subprocess
 import sys
 import tempfile
+import threading
 import time
 import gettext
 
@@ -55,24 +59,99 @@ def less_cmd(file, histfile=None, cat=False, grep=None):
     run(cmd_str, parameter=file, direct_output=True, env=env)
 
 
+# Pages bigger than this (in characters) are given to less while they are
+# rendered instead of once fully rendered
+_STREAM_SIZE = 200000
+
+# Memory used by the renderers kept in opencache, in MB (render_cache_mb)
+_RENDER_CACHE_MB = 100
+
+
+# Raised by the write function of less_stream once less has been quit: the
+# rest of the page will not be displayed, so its rendering is stopped. It is
+# not an Exception so that the error handling of the renderers lets it through.
+class _PagerClosed(BaseException):
+    pass
+
+
+# Like less_cmd, but less reads the text on its standard input while it is
+# produced. display is called with a function receiving the text (see
+# AbstractRenderer.display), which is also written in file for the next times.
+def less_stream(display, file, histfile=None, cat=False):
+    env = dict(os.environ)
+    if histfile:
+        env["LESSHISTFILE"] = histfile
+    if cat:
+        cmd_str = CMDS["cat"]
+    else:
+        cmd_str = CMDS["less"]
+    pager = subprocess.Popen(cmd_str % "-", shell=True, stdin=subprocess.PIPE, env=env)
+    chunks = queue.Queue()
+
+    # less stops reading when its screen is full (or when it quits): the
+    # rendering goes on in the meantime
+    def feed():
+        pipe = pager.stdin
+        while True:
+            text = chunks.get()
+            if text is None:
+                break
+            if pipe:
+                try:
+                    pipe.write(text.encode("UTF-8"))
+                    pipe.flush()
+                except OSError:
+                    pipe = None
+        try:
+            pager.stdin.close()
+        except OSError:
+            pass
+
+    def write(text):
+        if pager.poll() is not None:
+            raise _PagerClosed()
+        file.write(text)
+        chunks.put(text)
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    try:
+        display(write)
+    finally:
+        chunks.put(None)
+        pager.wait()
+        feeder.join()
+
+
 class opencache:
     def __init__(self):
         # We have a cache of the rendering of file and, for each one,
         # a less_histfile containing the current position in the file
         self.temp_files = {}
         self.less_histfile = {}
+        # The width of the terminal when each temp file was rendered.
+        # When it changes, the renderer only has to layout the page again
+        # (it keeps its parsed document) and the position in less is kept.
+        self.temp_width = {}
         # This dictionary contains an url -> ansirenderer mapping. This allows
         # to reuse a renderer when visiting several times the same URL during
         # the same session
         # We save the time at which the renderer was created in renderer_time
         # This way, we can invalidate the renderer if a new version of the source
         # has been downloaded
-        self.rendererdic = {}
+        # Renderers are ordered from the least recently used to the most. When
+        # they use more than render_cache_mb, the least recently used are
+        # unloaded: they keep their title and links but not their body and
+        # renderings, which are built again if needed (see limit_renderers).
+        self.rendererdic = collections.OrderedDict()
         self.renderer_time = {}
+        self.render_cache_mb = _RENDER_CACHE_MB
+        self.renderer_stats = {"hits": 0, "misses": 0, "unloads": 0}
+        self.last_renderer = None
         self.mime_handlers = {}
         self.last_mode = {}
-        self.last_width = term_width(absolute=True)
-        self.redirects = offblocklist.redirects
+        self.redirects = offutils.RedirectList(offblocklist.redirects)
+        self.redirects.blocklist = offutils.load_blocklists()
 
     def _get_handler_cmd(self, mimetype,file_extension=None):
         # Now look for a handler for this mimetype
@@ -135,13 +214,18 @@ class opencache:
         renderer = None
         path = netcache.get_cache_path(inpath)
         if path:
-            usecache = inpath in self.rendererdic.keys() and not is_local(inpath)
-            # Screen size may have changed
-            width = term_width(absolute=True)
-            if usecache and self.last_width != width:
-                self.cleanup()
-                usecache = False
-            if usecache:
+            usecache = inpath in self.rendererdic.keys()
+            if usecache and is_local(inpath):
+                # Local files (lists, for example) are modified without being
+                # downloaded: their renderer is kept while its file has the same
+                # mtime and size. Folders are always rendered again.
+                try:
+                    st = os.stat(path)
+                    stamp = (st.st_mtime_ns, st.st_size)
+                    usecache = self.rendererdic[inpath].source_stamp == stamp
+                except OSError:
+                    usecache = False
+            elif usecache:
                 if inpath in self.renderer_time.keys():
                     last_downloaded = netcache.cache_last_modified(inpath)
                     last_cached = self.renderer_time[inpath]
@@ -152,21 +236,53 @@ class opencache:
                 else:
                     usecache = False
             if not usecache:
+                self.renderer_stats["misses"] += 1
                 renderer = ansicat.renderer_from_file(path, url=inpath, theme=theme,\
                                                       redirectlist=self.redirects,**kwargs)
                 if renderer:
+                    self.rendererdic.pop(inpath, None)
                     self.rendererdic[inpath] = renderer
                     self.renderer_time[inpath] = int(time.time())
             else:
+                self.renderer_stats["hits"] += 1
                 renderer = self.rendererdic[inpath]
+                self.rendererdic.move_to_end(inpath)
+            # the previous renderer has been used (and has grown) since the last check
+            if renderer and inpath != self.last_renderer:
+                self.last_renderer = inpath
+                self.limit_renderers()
         return renderer
 
+    # Unloads the least recently used renderers, but not the last one, until
+    # they use less than render_cache_mb
+    def limit_renderers(self):
+        budget = self.render_cache_mb * 1000000
+        sizes = [(url, r, r.footprint()) for url, r in self.rendererdic.items()]
+        total = sum(size for url, r, size in sizes)
+        for url, renderer, size in sizes[:-1]:
+            if total <= budget:
+                break
+            renderer.unload()
+            unloaded = renderer.footprint()
+            if unloaded < size:
+                self.renderer_stats["unloads"] += 1
+                total += unloaded - size
+        return total
+
+    def renderers_info(self):
+        total = sum(r.footprint() for r in self.rendererdic.values())
+        return _("%s renderers (%.1f/%s MB), %s hits, %s misses, %s unloaded") % (
+            len(self.rendererdic), total / 1000000, self.render_cache_mb,
+            self.renderer_stats["hits"], self.renderer_stats["misses"],
+            self.renderer_stats["unloads"])
+
     def get_temp_filename(self, url):
         if url in self.temp_files.keys():
             return self.temp_files[url]
         else:
             return None
 
+    @offutils.traced("openk")
     def openk(self, inpath, mode="readable", terminal=True, grep=None, theme=None, \
                 link=None, direct_open_unsupported=False, **kwargs):
         # Return True if inpath opened in Terminal
@@ -181,12 +297,14 @@ class opencache:
         if not offutils.is_local(inpath):
             if mode:
                 kwargs["images_mode"] = mode
-            cachepath, inpath = netcache.fetch(inpath, redirects=self.redirects,**kwargs)
+            with offutils.span("openk.fetch"):
+                cachepath, inpath = netcache.fetch(inpath, redirects=self.redirects,**kwargs)
             if not cachepath:
                 return False, inpath
         # following line is for :// which are locals (file,list)
         elif "://" in inpath:
-            cachepath, inpath = netcache.fetch(inpath, redirects=self.redirects,**kwargs)
+            with offutils.span("openk.fetch"):
+                cachepath, inpath = netcache.fetch(inpath, redirects=self.redirects,**kwargs)
         elif inpath.startswith("mailto:"):
             cachepath = inpath
         elif os.path.exists(inpath):
@@ -215,9 +333,13 @@ class opencache:
                 renderer.display(mode=mode, directdisplay=True)
                 return True, inpath
             else:
-                body = renderer.display(mode=mode)
                 # Should we use the cache ? only if it is not local and there’s a cache
+                # (rendered at the current size of the screen)
+                width = (term_width(), term_width(absolute=True))
                 usecache = key in self.temp_files and not is_local(inpath)
+                if usecache and self.temp_width.get(key) != width:
+                    usecache = False
+                    os.remove(self.temp_files.pop(key))
                 if usecache:
                     # and the cache is still valid!
                     last_downloaded = netcache.cache_last_modified(inpath)
@@ -226,14 +348,6 @@ class opencache:
                         usecache = False
                         self.temp_files.pop(key)
                         self.less_histfile.pop(key)
-                # We actually put the body in a tmpfile before giving it to less
-                if not usecache:
-                    tmpf = tempfile.NamedTemporaryFile(
-                        "w", encoding="UTF-8", delete=False, prefix="openk."
-                    )
-                    self.temp_files[key] = tmpf.name
-                    tmpf.write(body)
-                    tmpf.close()
                 if key not in self.less_histfile:
                     firsttime = True
                     tmpf = tempfile.NamedTemporaryFile(
@@ -243,12 +357,49 @@ class opencache:
                 else:
                     # We don’t want to restore positions in lists
                     firsttime = is_local(inpath)
-                less_cmd(
-                    self.temp_files[key],
-                    histfile=self.less_histfile[key],
-                    cat=firsttime,
-                    grep=grep,
-                )
+                # A long page is shown while it is rendered
+                if not usecache and not grep and len(renderer.body) > _STREAM_SIZE:
+                    tmpf = tempfile.NamedTemporaryFile(
+                        "w", encoding="UTF-8", delete=False, prefix="openk."
+                    )
+                    try:
+                        with offutils.span("openk.less"), tmpf:
+                            less_stream(
+                                lambda write: renderer.display(mode=mode, stream=write),
+                                tmpf,
+                                histfile=self.less_histfile[key],
+                                cat=firsttime,
+                            )
+                    except _PagerClosed:
+                        # less was quit before the end: the partial
+                        # rendering is not kept
+                        os.remove(tmpf.name)
+                        return True, inpath
+                    except BaseException:
+                        os.remove(tmpf.name)
+                        raise
+                    self.temp_files[key] = tmpf.name
+                    self.temp_width[key] = width
+                    return True, inpath
+                # We actually put the body in a tmpfile before giving it to less
+                if not usecache:
+                    with offutils.span("openk.render"):
+                        body = renderer.display(mode=mode)
+                    tmpf = tempfile.NamedTemporaryFile(
+                        "w", encoding="UTF-8", delete=False, prefix="openk."
+                    )
+                    self.temp_files[key] = tmpf.name
+                    self.temp_width[key] = width
+                    tmpf.write(body)
+                    tmpf.close()
+                # (this includes the time spent reading the page in less)
+                with offutils.span("openk.less"):
+                    less_cmd(
+                        self.temp_files[key],
+                        histfile=self.less_histfile[key],
+                        cat=firsttime,
+                        grep=grep,
+                    )
                 return True, inpath
         # maybe, we have no renderer. Or we want to skip it.
         else:
@@ -293,10 +444,10 @@ class opencache:
             os.remove(self.temp_files.popitem()[1])
         while len(self.less_histfile) > 0:
             os.remove(self.less_histfile.popitem()[1])
-        #After cleanup, we set the current size of the terminal
-        self.last_width = term_width(absolute=True)
-        self.rendererdic = {}
+        self.temp_width = {}
+        self.rendererdic = collections.OrderedDict()
         self.renderer_time = {}
+        self.last_renderer = None
         self.last_mode = {}
 
     # Clean only a specific url cache
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# Benchmark of the blocklists: memory used and lookup speed of a
+# DomainBlocklist compared to a plain python set, and of RedirectList
+# compared to the previous linear scan of the redirect rules.
+#
+# Usage: python tests/bench_blocklist.py [--domains 200000] [--lookups 100000]
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OFFPUNK_CACHE_PATH", tempfile.mkdtemp(prefix="offpunk-bench-"))
+
+import netcache  # noqa: E402,F401
+import offutils  # noqa: E402
+
+TLDS = ["com", "net", "org", "io", "fr", "de", "co.uk", "info"]
+
+
+def random_domains(rng, n):
+    domains = set()
+    while len(domains) < n:
+        labels = rng.randint(1, 3)
+        name = ".".join(
+            "".join(rng.choice("abcdefghijklmnopqrstuvwxyz0123456789-")
+                    for _ in range(rng.randint(3, 12)))
+            for _ in range(labels)
+        )
+        domains.add("%s.%s" % (name, rng.choice(TLDS)))
+    return sorted(domains)
+
+
+def measure(func):
+    start = time.perf_counter()
+    func()
+    duration = time.perf_counter() - start
+    # Memory is measured on a second run as tracemalloc slows things down
+    tracemalloc.start()
+    result = func()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, duration, size
+
+
+def old_get_url_redirected(netloc, redirectlist):
+    # The linear scan used before RedirectList
+    keys = list(redirectlist.keys())
+    for key in keys:
+        if key == netloc or (key.startswith("*") and netloc.endswith(key[1:])):
+            return redirectlist[key]
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Blocklists benchmark")
+    parser.add_argument("--domains", type=int, default=200000)
+    parser.add_argument("--lookups", type=int, default=100000)
+    args = parser.parse_args()
+    rng = random.Random(42)
+    domains = random_domains(rng, args.domains)
+    # Half of the lookups are subdomains of blocked domains
+    hosts = []
+    for i in range(args.lookups):
+        if i % 2:
+            hosts.append("www.sub." + rng.choice(domains))
+        else:
+            hosts.append("unknown%s.example.%s" % (i, rng.choice(TLDS)))
+
+    with tempfile.TemporaryDirectory() as folder:
+        with open(os.path.join(folder, "hosts"), "w") as f:
+            for d in domains:
+                f.write("0.0.0.0 %s\n" % d)
+        _, parse_time, _ = measure(lambda: offutils.parse_blocklist(os.path.join(folder, "hosts")))
+        blocklist, build_time, bl_size = measure(lambda: offutils.load_blocklists(folder))
+        _, load_time, _ = measure(lambda: offutils.load_blocklists(folder))
+    # (a set of new strings, like the ones parsed from a file)
+    pyset, _, set_size = measure(lambda: set(d.upper().lower() for d in domains))
+
+    def set_match(host):
+        while host:
+            if host in pyset:
+                return host
+            host = host.partition(".")[2]
+
+    start = time.perf_counter()
+    found = sum(1 for h in hosts if blocklist.match(h))
+    bl_lookup = time.perf_counter() - start
+    start = time.perf_counter()
+    found_set = sum(1 for h in hosts if set_match(h))
+    set_lookup = time.perf_counter() - start
+    assert found == found_set
+
+    print("Blocklist of %s domains" % len(blocklist))
+    print("  parsing the hosts file : %8.1f ms" % (parse_time * 1000))
+    print("  parsing and prebuilding: %8.1f ms" % (build_time * 1000))
+    print("  loading prebuilt       : %8.1f ms" % (load_time * 1000))
+    print("  memory DomainBlocklist : %8.1f MB" % (bl_size / 1e6))
+    print("  memory python set      : %8.1f MB" % (set_size / 1e6))
+    print("  lookup DomainBlocklist : %8.2f µs" % (bl_lookup / len(hosts) * 1e6))
+    print("  lookup python set      : %8.2f µs" % (set_lookup / len(hosts) * 1e6))
+
+    # Redirect rules: compiled lookup vs linear scan
+    rules = {}
+    for d in domains[:2000]:
+        rules["*" + d if len(rules) % 2 else d] = "blocked"
+    redirects = offutils.RedirectList(rules)
+    sample = hosts[:10000]
+    start = time.perf_counter()
+    for h in sample:
+        offutils.get_url_redirected("https://" + h, redirects)
+    compiled = time.perf_counter() - start
+    start = time.perf_counter()
+    for h in sample:
+        old_get_url_redirected(h, rules)
+    linear = time.perf_counter() - start
+    print("Redirect rules (%s rules)" % len(rules))
+    print("  lookup RedirectList    : %8.2f µs" % (compiled / len(sample) * 1e6))
+    print("  lookup linear scan     : %8.2f µs" % (linear / len(sample) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# Fetching benchmark against the local servers of servers.py (no network
+# needed): URLs per second and p50/p99 latency of netcache.fetch for each
+# protocol, sequentially and with fetch_batch, then of a whole call_sync
+# at different depths.
+#
+# Usage: python tests/bench_fetch.py [--pages 200] [--latency 5] [--depths 0,1,2]
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+_TMP = tempfile.mkdtemp(prefix="offpunk-bench-")
+os.environ["OFFPUNK_CACHE_PATH"] = os.path.join(_TMP, "cache")
+os.environ["XDG_DATA_HOME"] = os.path.join(_TMP, "data")
+os.environ["XDG_CONFIG_HOME"] = os.path.join(_TMP, "config")
+
+import netcache  # noqa: E402
+import offpunk  # noqa: E402
+from offutils import CMDS, xdg  # noqa: E402
+from servers import LocalServers, Site  # noqa: E402
+
+
+def percentiles(values):
+    return offpunk.SyncMetrics.percentiles(values)
+
+
+def clear_cache():
+    import shutil
+
+    cache = xdg("cache")
+    for name in os.listdir(cache):
+        if os.path.isdir(os.path.join(cache, name)):
+            shutil.rmtree(os.path.join(cache, name))
+
+
+def bench_sequential(servers, protocol, pages):
+    latencies = []
+    start = time.perf_counter()
+    for i in range(pages):
+        t = time.perf_counter()
+        netcache.fetch(servers.url(protocol, "/page/%s" % i), interactive=False,
+                       download_image_first=False)
+        latencies.append(time.perf_counter() - t)
+    return pages / (time.perf_counter() - start), percentiles(latencies)
+
+
+def bench_batch(servers, protocol, pages, workers):
+    output = io.StringIO()
+    urls = [servers.url(protocol, "/page/%s" % i) for i in range(pages)]
+    start = time.perf_counter()
+    netcache.fetch_batch(urls, workers=workers, per_host=workers, output=output,
+                         interactive=False, download_image_first=False)
+    duration = time.perf_counter() - start
+    latencies = [json.loads(line)["time"] for line in output.getvalue().splitlines()]
+    return pages / duration, percentiles(latencies)
+
+
+def bench_sync(servers, protocol, depth):
+    gc = offpunk.GeminiClient(sync_only=True)
+    lists = os.path.join(xdg("data"), "lists")
+    os.makedirs(lists, exist_ok=True)
+    with open(os.path.join(lists, "bench.gmi"), "w") as f:
+        for i in range(5):
+            f.write("=> %s\n" % servers.url(protocol, "/page/%s" % i))
+    metrics_file = os.path.join(_TMP, "metrics.json")
+    with contextlib.redirect_stdout(io.StringIO()):
+        gc.call_sync(depth=depth, lists=["bench"], metrics_file=metrics_file)
+    with open(metrics_file) as f:
+        metrics = json.load(f)
+    total = metrics["total"]
+    fetched = total["new"] + total["refreshed"] + total["errors"]
+    return fetched, fetched / metrics["duration"], total["latency"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fetching benchmark")
+    parser.add_argument("--pages", type=int, default=200, help="pages fetched per measure")
+    parser.add_argument("--links", type=int, default=5, help="links per page")
+    parser.add_argument("--latency", type=float, default=0, help="latency of the servers (ms)")
+    parser.add_argument("--error-rate", type=float, default=0, help="part of pages in error")
+    parser.add_argument("--workers", type=int, default=8, help="workers for fetch_batch")
+    parser.add_argument("--depths", default="0,1,2", help="depths of call_sync")
+    parser.add_argument("--protocols", default="gemini,gopher,spartan,finger,http")
+    args = parser.parse_args()
+    protocols = args.protocols.split(",")
+    if "http" in protocols and not CMDS["curl"]:
+        protocols.remove("http")
+    site = Site(pages=args.pages, links=args.links, latency=args.latency / 1000,
+                error_rate=args.error_rate)
+
+    def row(name, count, rate, lat):
+        print("%-26s %6s %10.1f %9.1f %9.1f" % (name, count, rate,
+              (lat["p50"] or 0) * 1000, (lat["p99"] or 0) * 1000), flush=True)
+
+    with LocalServers(site, protocols=protocols) as servers:
+        print("%-26s %6s %10s %9s %9s" % ("", "urls", "urls/s", "p50 (ms)", "p99 (ms)"))
+        for protocol in protocols:
+            clear_cache()
+            row("fetch %s" % protocol, args.pages, *bench_sequential(servers, protocol, args.pages))
+            clear_cache()
+            rate, lat = bench_batch(servers, protocol, args.pages, args.workers)
+            row("fetch_batch %s ×%s" % (protocol, args.workers), args.pages, rate, lat)
+        for protocol in protocols:
+            for depth in [int(d) for d in args.depths.split(",")]:
+                clear_cache()
+                row("call_sync %s depth %s" % (protocol, depth), *bench_sync(servers, protocol, depth))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# Benchmark of the extraction of links from HTML pages, as done by sync:
+# get_links() in links_only modes compared to the links of a full rendering
+# (what links_only used to do). Pages of the synthetic corpus (see
+# corpus.py) from a few kB to a few hundred kB are used.
+#
+# Usage: python tests/bench_links.py [--repeat 3] [--sizes 1,2,4,8,16]
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+os.environ.setdefault("OFFPUNK_CACHE_PATH", tempfile.mkdtemp(prefix="offpunk-bench-"))
+
+import netcache  # noqa: E402,F401
+import ansicat  # noqa: E402
+import corpus  # noqa: E402
+
+# links_only modes and the mode rendering the same cleaned page
+MODES = [("links_only", "readable"), ("full_links_only", "full")]
+
+
+def links_once(content, url, mode):
+    renderer = ansicat.set_renderer(content, url, "text/html")
+    start = time.perf_counter()
+    links = renderer.get_links(mode=mode)
+    return time.perf_counter() - start, links
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Links extraction benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measure (best is kept)")
+    parser.add_argument("--sizes", default="1,2,4,8,16", help="sections in each page")
+    args = parser.parse_args()
+
+    print("%-10s %-16s %6s %12s %12s %8s" % ("size", "mode", "links", "render (ms)",
+                                             "links (ms)", "speedup"))
+    for sections in [int(s) for s in args.sizes.split(",")]:
+        content = corpus.html(random.Random(sections), depth=4, sections=sections)
+        url = "https://example.org/page-%s.html" % sections
+        for links_mode, mode in MODES:
+            old = min(links_once(content, url, mode)[0] for _ in range(args.repeat))
+            runs = [links_once(content, url, links_mode) for _ in range(args.repeat)]
+            new = min(r[0] for r in runs)
+            # Both must find the same links
+            if runs[0][1] != links_once(content, url, mode)[1]:
+                print("Different links in %s for %s" % (links_mode, url))
+            print("%8.0fk  %-16s %6s %12.1f %12.1f %7.1fx" % (
+                len(content.encode()) / 1000, links_mode, len(runs[0][1]),
+                old * 1000, new * 1000, old / new), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# Benchmark of get_mime() on a cache full of pages of the synthetic corpus
+# (see corpus.py) and of small images: with "file" for each file (as before),
+# with the first bytes of the files and with the type given by the server
+# when the page was fetched. The types found must be the same (or, for the
+# type given by the server, be rendered by the same renderer).
+#
+# Usage: python tests/bench_mime.py [--files 1000]
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+os.environ.setdefault("OFFPUNK_CACHE_PATH", tempfile.mkdtemp(prefix="offpunk-bench-"))
+
+import netcache  # noqa: E402
+import ansicat  # noqa: E402
+import corpus  # noqa: E402
+import offutils  # noqa: E402
+from mime_test import PNG  # noqa: E402
+
+KINDS = [
+    ("gemini://example.org/page/%s", "text/gemini", lambda rng: corpus.gemtext(rng, links=30)),
+    ("https://example.org/page/%s", "text/html", lambda rng: corpus.html(rng, depth=3, sections=1)),
+    ("https://example.org/feed/%s", "application/rss+xml", lambda rng: corpus.rss(rng, items=5)),
+    ("https://example.org/atom/%s", "application/atom+xml", lambda rng: corpus.atom(rng, entries=5)),
+    ("gemini://example.org/notes/%s", "text/plain", lambda rng: corpus.plaintext(rng, lines=40)),
+    ("https://example.org/img/%s", "image/png", lambda rng: PNG),
+]
+
+
+def fill_cache(count):
+    rng = random.Random(count)
+    paths = []
+    for i in range(count):
+        url, mime, content = KINDS[i % len(KINDS)]
+        body = content(rng)
+        if not mime.startswith("text/"):
+            body = body.encode() if isinstance(body, str) else body
+        paths.append(netcache.write_body(url % i, body, mime))
+    return paths
+
+
+def renderer(mime):
+    for m, func in ansicat._FORMAT_RENDERERS.items():
+        if ansicat.fnmatch.fnmatch(mime, m):
+            return func
+    return None
+
+
+def measure(paths):
+    start = time.perf_counter()
+    mimes = [ansicat.get_mime(p) for p in paths]
+    return time.perf_counter() - start, mimes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MIME detection benchmark")
+    parser.add_argument("--files", type=int, default=1000, help="files in the cache")
+    args = parser.parse_args()
+    if not offutils.CMDS["file"]:
+        sys.exit("file is needed for this benchmark")
+    paths = fill_cache(args.files)
+    get_file_mime = ansicat.get_file_mime
+    sniff_mime = ansicat.sniff_mime
+    # Without the type given by the server
+    ansicat.get_file_mime = lambda path: None
+    ansicat.sniff_mime = lambda data: None
+    old, expected = measure(paths)
+    ansicat.sniff_mime = sniff_mime
+    sniffed, mimes = measure(paths)
+    ansicat.get_file_mime = get_file_mime
+    fetched, fetched_mimes = measure(paths)
+    print("%s files, %s kB" % (len(paths), sum(os.path.getsize(p) for p in paths) // 1000))
+    print("%-14s %10s %10s %8s %10s %10s" % ("", "total (s)", "each (ms)", "speedup",
+                                            "other type", "renderer"))
+    for name, duration, found in [("file", old, expected), ("first bytes", sniffed, mimes),
+                                  ("server type", fetched, fetched_mimes)]:
+        different = sum(1 for a, b in zip(expected, found) if a != b)
+        renderers = sum(1 for a, b in zip(expected, found) if renderer(a) != renderer(b))
+        print("%-14s %10.3f %10.3f %7.1fx %10s %10s" % (name, duration, duration * 1000 / len(paths),
+                                                       old / duration, different, renderers))
+
+
+if __name__ == "__main__":
+    main()
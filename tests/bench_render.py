@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# Benchmark of the renderers on a deterministic synthetic corpus (see
+# corpus.py): each document is rendered from scratch in each mode and at
+# several widths and the best time of a few runs is kept.
+#
+# Results can be saved as a baseline and later runs are compared to it:
+#   python tests/bench_render.py --save       # store the baseline
+#   python tests/bench_render.py              # compare with the baseline
+#   python tests/bench_render.py --quick      # smaller corpus, one run
+# Baselines are stored in tests/.benchmarks/ (not versioned, timings only
+# make sense on the same machine). With --fail, the exit status is 1 if
+# something is slower than the baseline by more than --threshold percent.
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+os.environ.setdefault("OFFPUNK_CACHE_PATH", tempfile.mkdtemp(prefix="offpunk-bench-"))
+
+import netcache  # noqa: E402,F401
+import ansicat  # noqa: E402
+import offutils  # noqa: E402
+from corpus import corpus  # noqa: E402
+
+WIDTHS = [40, 72, 120]
+MODES = {
+    "html": ["readable", "full", "links_only"],
+    "rss": ["readable", "full"],
+    "atom": ["readable", "full"],
+}
+DEFAULT_BASELINE = os.path.join(TESTS_DIR, ".benchmarks", "render.json")
+
+
+def render_once(mime, url, content, mode, width):
+    # A new renderer each time, so nothing is cached between runs
+    renderer = ansicat.set_renderer(content, url, mime)
+    start = time.perf_counter()
+    renderer.get_body(width=width, mode=mode)
+    renderer.get_links(mode=mode)
+    return time.perf_counter() - start
+
+
+def run(docs, repeat):
+    results = {}
+    for name, (mime, url, content) in docs.items():
+        for mode in MODES.get(name, ["readable"]):
+            for width in WIDTHS:
+                offutils.term_width(new_width=width)
+                best = min(render_once(mime, url, content, mode, width) for _ in range(repeat))
+                key = "%s/%s/%s" % (name, mode, width)
+                results[key] = best
+                yield key, best, len(content.encode())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rendering benchmark")
+    parser.add_argument("--scale", type=float, default=1.0, help="size of the corpus")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measure (best is kept)")
+    parser.add_argument("--quick", action="store_true", help="same as --scale 0.1 --repeat 1")
+    parser.add_argument("--only", help="only benchmark documents whose name contains ONLY")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline file")
+    parser.add_argument("--save", action="store_true", help="save the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=20, help="regression threshold in percent")
+    parser.add_argument("--fail", action="store_true", help="exit with 1 if there is a regression")
+    args = parser.parse_args()
+    if args.quick:
+        args.scale = 0.1
+        args.repeat = 1
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            saved = json.load(f)
+        if saved.get("scale") == args.scale:
+            baseline = saved["results"]
+        else:
+            print("Baseline %s was made with another scale, not comparing" % args.baseline)
+
+    docs = corpus(scale=args.scale)
+    if args.only:
+        docs = {k: v for k, v in docs.items() if args.only in k}
+    results = {}
+    regressions = []
+    print("%-28s %9s %10s %10s %8s" % ("document/mode/width", "size", "time (ms)", "baseline", "diff"))
+    for key, duration, size in run(docs, args.repeat):
+        results[key] = duration
+        line = "%-28s %8.0fk %10.1f" % (key, size / 1000, duration * 1000)
+        if key in baseline:
+            diff = (duration - baseline[key]) / baseline[key] * 100
+            line += " %10.1f %+7.1f%%" % (baseline[key] * 1000, diff)
+            if diff > args.threshold:
+                line += "  REGRESSION"
+                regressions.append(key)
+        print(line, flush=True)
+    print("Total: %.1f ms" % (sum(results.values()) * 1000))
+
+    if args.save:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump({
+                "scale": args.scale,
+                "date": time.strftime("%Y-%m-%d %H:%M"),
+                "python": platform.python_version(),
+                "machine": platform.node(),
+                "results": results,
+            }, f, indent=2)
+        print("Baseline saved in %s" % args.baseline)
+    if regressions:
+        print("%s regression(s) above %s%%" % (len(regressions), args.threshold))
+        if args.fail:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
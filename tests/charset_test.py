@@ -0,0 +1,69 @@
+import os
+
+import pytest
+
+import netcache
+import ansicat
+from offutils import get_file_charset, set_file_charset
+
+TEXT = "Café, crème brûlée et œufs à la coque.\n" * 20
+
+
+# Calls to the detection of charsets
+@pytest.fixture
+def detections(monkeypatch):
+    if not netcache.load_CHARDET():
+        pytest.skip("charset detection needs charset_normalizer or chardet")
+    calls = []
+    detect = netcache.chardet.detect
+
+    def counting_detect(data):
+        calls.append(len(data))
+        return detect(data)
+    monkeypatch.setattr(netcache.chardet, "detect", counting_detect)
+    monkeypatch.setattr(ansicat, "_DETECTED_CHARSETS", {})
+    return calls
+
+
+def write(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_declared_charsets(tmp_path, detections):
+    assert ansicat.decode_file(write(tmp_path, "utf8", TEXT.encode())) == TEXT
+    assert ansicat.decode_file(write(tmp_path, "bom", b"\xef\xbb\xbf" + TEXT.encode())) == TEXT
+    assert ansicat.decode_file(write(tmp_path, "utf16", TEXT.encode("utf-16"))) == TEXT
+    html = '<html><head><meta http-equiv="Content-Type" content="text/html; charset=iso-8859-15">'
+    html += "</head><body>%s</body></html>" % TEXT
+    assert ansicat.decode_file(write(tmp_path, "html", html.encode("iso-8859-15"))) == html
+    html = "<meta charset='windows-1252'><p>%s</p>" % TEXT
+    assert ansicat.decode_file(write(tmp_path, "html5", html.encode("cp1252"))) == html
+    xml = '<?xml version="1.0" encoding="ISO-8859-15"?>\n<rss><title>%s</title></rss>' % TEXT
+    assert ansicat.decode_file(write(tmp_path, "xml", xml.encode("iso-8859-15"))) == xml
+    assert not detections
+    # A charset given by the server
+    path = write(tmp_path, "declared", TEXT.encode("cp1252"))
+    set_file_charset(path, "cp1252")
+    if get_file_charset(path):
+        assert ansicat.decode_file(path) == TEXT
+        assert not detections
+
+
+def test_detected_charset(tmp_path, detections):
+    path = write(tmp_path, "latin", TEXT.encode("cp1252"))
+    assert ansicat.decode_file(path) == TEXT
+    assert len(detections) == 1
+    assert ansicat.decode_file(path) == TEXT
+    # The detected charset is also kept with the file
+    if get_file_charset(path):
+        ansicat._DETECTED_CHARSETS.clear()
+        assert ansicat.decode_file(path) == TEXT
+    assert len(detections) == 1
+    # until it is modified
+    with open(path, "ab") as f:
+        f.write("Noël\n".encode("cp1252"))
+    os.utime(path, ns=(0, 0))
+    assert ansicat.decode_file(path) == TEXT + "Noël\n"
+    assert len(detections) == 2
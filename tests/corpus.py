@@ -0,0 +1,196 @@
+# Deterministic synthetic documents used by the benchmarks (and some tests).
+# The same seed and scale always give exactly the same documents so
+# timings can be compared between runs.
+#
+# corpus(scale=1.0, seed=42) returns a dict name -> (mime, url, content).
+# With scale=1.0: a gemtext page with 3000 links, a deeply nested HTML
+# article, a 5000 lines gophermap, RSS and Atom feeds of a few MB and a long
+# plaintext.
+
+import random
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+    "tempor incididunt ut labore et dolore magna aliqua offline gemini gopher "
+    "capsule smolnet bookmark terminal readability cache sync tour subscribe "
+    "l’été français über naïve café 日本語 emoji 🙂 long-hyphenated-compound-word"
+).split()
+
+
+def words(rng, n):
+    return " ".join(rng.choice(WORDS) for _ in range(n))
+
+
+def sentence(rng, low=6, high=30):
+    text = words(rng, rng.randint(low, high))
+    return text[0].upper() + text[1:] + "."
+
+
+def paragraph(rng, sentences=5):
+    return " ".join(sentence(rng) for _ in range(rng.randint(1, sentences)))
+
+
+def hostname(rng):
+    return "%s.%s" % (rng.choice(WORDS[:20]), rng.choice(["org", "net", "fr", "space"]))
+
+
+def path(rng):
+    return "/" + "/".join(rng.choice(WORDS[:30]) for _ in range(rng.randint(1, 4)))
+
+
+def gemtext(rng, links=3000):
+    lines = ["# " + sentence(rng, 3, 8), ""]
+    for i in range(links):
+        kind = rng.random()
+        if kind < 0.05:
+            lines.append("## " + sentence(rng, 2, 6))
+        elif kind < 0.10:
+            lines.append("```")
+            lines.extend(words(rng, rng.randint(3, 25)) for _ in range(rng.randint(2, 8)))
+            lines.append("```")
+        elif kind < 0.15:
+            lines.append("> " + paragraph(rng, 2))
+        elif kind < 0.25:
+            lines.append("* " + sentence(rng))
+        elif kind < 0.35:
+            lines.append(paragraph(rng))
+        # One link per loop: absolute, relative or without label
+        choice = rng.random()
+        if choice < 0.4:
+            lines.append("=> gemini://%s%s %s" % (hostname(rng), path(rng), sentence(rng, 2, 8)))
+        elif choice < 0.8:
+            lines.append("=> %s.gmi %s" % (path(rng), sentence(rng, 2, 8)))
+        elif choice < 0.9:
+            lines.append("=> https://%s%s" % (hostname(rng), path(rng)))
+        else:
+            lines.append("=> gopher://%s/1%s %s" % (hostname(rng), path(rng), words(rng, 3)))
+    return "\n".join(lines) + "\n"
+
+
+def _html_block(rng, depth):
+    if depth <= 0:
+        return "<p>%s <a href=\"%s\">%s</a> <b>%s</b> <i>%s</i></p>" % (
+            paragraph(rng), path(rng), words(rng, 3), words(rng, 2), words(rng, 2))
+    parts = []
+    tag = rng.choice(["div", "section", "article", "div", "blockquote"])
+    parts.append("<%s class=\"c%s\">" % (tag, depth))
+    for _ in range(rng.randint(1, 3)):
+        kind = rng.random()
+        if kind < 0.15:
+            parts.append("<h%s>%s</h%s>" % (min(6, 7 - depth), sentence(rng, 2, 6), min(6, 7 - depth)))
+        elif kind < 0.25:
+            items = "".join("<li>%s <a href=\"%s\">%s</a></li>" % (sentence(rng), path(rng), words(rng, 2))
+                            for _ in range(rng.randint(2, 6)))
+            parts.append("<ul>%s</ul>" % items)
+        elif kind < 0.30:
+            parts.append("<pre>%s</pre>" % "\n".join(words(rng, 8) for _ in range(5)))
+        elif kind < 0.35:
+            parts.append("<img src=\"/img/%s.png\" alt=\"%s\">" % (rng.randint(0, 999), words(rng, 3)))
+        elif kind < 0.40:
+            rows = "".join("<tr><td>%s</td><td>%s</td></tr>" % (words(rng, 2), words(rng, 4))
+                           for _ in range(4))
+            parts.append("<table>%s</table>" % rows)
+        parts.append(_html_block(rng, depth - 1))
+        parts.append("<p>%s</p>" % paragraph(rng, 8))
+    parts.append("</%s>" % tag)
+    return "".join(parts)
+
+
+def html(rng, depth=6, sections=6):
+    nav = "".join("<li><a href=\"https://%s%s\">%s</a></li>" % (hostname(rng), path(rng), words(rng, 2))
+                  for _ in range(80))
+    body = "".join(_html_block(rng, depth) for _ in range(sections))
+    return (
+        "<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>%s</title>"
+        "<link rel=\"alternate\" type=\"application/rss+xml\" title=\"Feed\" href=\"/feed.xml\">"
+        "<style>body {color: black}</style><script>var x = 1;</script></head>"
+        "<body><header><nav><ul>%s</ul></nav></header><main><article><h1>%s</h1>%s</article></main>"
+        "<footer><p>%s</p></footer></body></html>"
+        % (sentence(rng, 3, 6), nav, sentence(rng, 3, 8), body, paragraph(rng))
+    )
+
+
+def gophermap(rng, lines=5000):
+    out = []
+    for _ in range(lines):
+        kind = rng.random()
+        host = hostname(rng)
+        if kind < 0.5:
+            out.append("i%s\t\t%s\t70" % (sentence(rng, 3, 12), host))
+        elif kind < 0.75:
+            out.append("1%s\t%s\t%s\t70" % (words(rng, 4), path(rng), host))
+        elif kind < 0.9:
+            out.append("0%s\t%s.txt\t%s\t70" % (words(rng, 4), path(rng), host))
+        elif kind < 0.95:
+            out.append("h%s\tURL:https://%s%s\t%s\t70" % (words(rng, 3), host, path(rng), host))
+        else:
+            out.append("7%s\t%s\t%s\t70" % (words(rng, 2), path(rng), host))
+    return "\r\n".join(out) + "\r\n.\r\n"
+
+
+def rss(rng, items=1500):
+    entries = []
+    for i in range(items):
+        entries.append(
+            "<item><title>%s</title><link>https://%s%s/%s</link>"
+            "<pubDate>Mon, %02d Jan 2024 10:00:00 +0000</pubDate>"
+            "<description><![CDATA[<p>%s</p><p>%s <a href=\"%s\">%s</a></p>]]></description></item>"
+            % (sentence(rng, 3, 10), hostname(rng), path(rng), i, i % 28 + 1,
+               paragraph(rng, 8), paragraph(rng, 5), path(rng), words(rng, 2))
+        )
+    return (
+        "<?xml version=\"1.0\" encoding=\"UTF-8\"?><rss version=\"2.0\"><channel>"
+        "<title>%s</title><link>https://example.org/</link><description>%s</description>%s"
+        "</channel></rss>" % (sentence(rng, 2, 5), sentence(rng), "".join(entries))
+    )
+
+
+def atom(rng, entries=1500):
+    out = []
+    for i in range(entries):
+        out.append(
+            "<entry><title>%s</title><link href=\"gemini://%s%s/%s.gmi\"/>"
+            "<id>tag:example.org,2024:%s</id><updated>2024-01-%02dT10:00:00Z</updated>"
+            "<summary>%s</summary><content type=\"html\">&lt;p&gt;%s&lt;/p&gt;</content></entry>"
+            % (sentence(rng, 3, 10), hostname(rng), path(rng), i, i, i % 28 + 1,
+               paragraph(rng, 3), paragraph(rng, 8))
+        )
+    return (
+        "<?xml version=\"1.0\" encoding=\"utf-8\"?><feed xmlns=\"http://www.w3.org/2005/Atom\">"
+        "<title>%s</title><link href=\"gemini://example.org/\"/><updated>2024-01-01T00:00:00Z</updated>"
+        "<id>gemini://example.org/</id>%s</feed>" % (sentence(rng, 2, 5), "".join(out))
+    )
+
+
+def plaintext(rng, lines=20000):
+    out = []
+    for _ in range(lines):
+        if rng.random() < 0.1:
+            out.append("")
+        else:
+            out.append(words(rng, rng.randint(1, 30)))
+    return "\n".join(out) + "\n"
+
+
+def corpus(scale=1.0, seed=42):
+    def n(value):
+        return max(1, int(value * scale))
+
+    # Each document has its own generator so scaling one doesn’t change the others
+    def rng(name):
+        return random.Random("%s-%s" % (seed, name))
+
+    return {
+        "gemtext": ("text/gemini", "gemini://example.org/index.gmi",
+                    gemtext(rng("gemtext"), links=n(3000))),
+        "html": ("text/html", "https://example.org/article.html",
+                 html(rng("html"), sections=n(6))),
+        "gophermap": ("text/gopher", "gopher://example.org/1/",
+                      gophermap(rng("gophermap"), lines=n(5000))),
+        "rss": ("application/rss+xml", "https://example.org/feed.xml",
+                rss(rng("rss"), items=n(1500))),
+        "atom": ("application/atom+xml", "gemini://example.org/atom.xml",
+                 atom(rng("atom"), entries=n(1500))),
+        "plaintext": ("text/plain", "gemini://example.org/notes.txt",
+                      plaintext(rng("plaintext"), lines=n(20000))),
+    }
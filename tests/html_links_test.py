@@ -0,0 +1,92 @@
+import random
+
+import pytest
+
+import netcache  # noqa: F401
+import ansicat
+import corpus
+from offutils import RedirectList
+from render_golden_test import TRICKY_HTML
+
+# Bad HTML, as found in the wild
+MESSY_HTML = """<!DOCTYPE html><html><head><base href="/sub/dir/">
+<link rel="alternate stylesheet" type="text/css" href="/style.css">
+<link rel="alternate" type="application/atom+xml" title="Atom" href="atom.xml">
+<link rel="Alternate" type="application/rss+xml" href="/ignored.xml">
+<link rel=alternate type="application/rss+xml" title="RSS">
+<script>document.write('<a href="/in-script">x</a>')</script></head>
+<body><p>Unclosed <a href="one.html">one <p>para <b>bold <a href="two.html">two</b></a>
+</p></p></span><br></br><br/><div/>text after empty div
+<section><a href="single-child.html">the only child</a></section>
+<section><!-- comment --><a href="after-comment.html">x</a></section>
+<section>&amp;<a href="after-entity.html">x</a></section>
+<a href="img.png"><img src="img.png" alt="same  url"></a>
+<a href="big.png"><img src="small.png" alt="other url"><img src="small2.png"></a>
+<a href="https://blocked.example/page"><img src="thumb.png"></a>
+<a href="https://blocked.example/other">blocked but a link</a>
+<img src="https://blocked.example/tracker.gif">
+<img src="data:image/svg+xml,<svg/>" data-src="lazy.jpg" alt="lazy">
+<img src="data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk">
+<img alt="no src"><a name="anchor">no href</a><a href="">empty</a>
+<video poster="poster.jpg"><source src="movie.webm"></video>
+<video poster="poster2.jpg"></video><video src="clip.mp4" alt="a clip"></video>
+<table><tr><td><a href="cell.html">cell</a></td></tr></table>
+<pre><a href="pre.html">in pre</a></pre><template><a href="tpl.html">x</a></template>
+<ul><li><a href="my page.html">spaces</a><li><a href="caf%C3%A9 ü.html">unicode</a></ul>
+<custom><span><a href="deep.html">deep</a></span></custom>
+<em><a href="/abs.html"><img src="/abs.html"></a></em>
+</body></html>
+<p><a href="after-body.html">after the body</a>
+"""
+
+
+# Links are found like BeautifulSoup does with lxml or with html.parser
+@pytest.fixture(params=["lxml", "html.parser"], autouse=True)
+def soup_parser(request, monkeypatch):
+    if request.param == "html.parser":
+        monkeypatch.setattr(ansicat, "load_LXML", lambda: False)
+    return request.param
+
+
+def documents():
+    docs = [("https://example.org/tricky.html", TRICKY_HTML),
+            ("https://www.example.org/messy.html", MESSY_HTML),
+            ("https://example.org/nobody.html", "<a href='x'>x</a><p><a href='y'>y</a>"),
+            ("https://example.org/empty.html", "")]
+    for i in range(5):
+        docs.append(("https://example.org/%s.html" % i,
+                     corpus.html(random.Random(i), depth=3, sections=2)))
+    return docs
+
+
+def links_and_images(url, content, mode, **options):
+    renderer = ansicat.set_renderer(content, url, "text/html")
+    renderer.redirects = RedirectList({"blocked.example": "blocked", **options})
+    links = renderer.get_links(mode=mode)
+    return links, renderer.get_images(mode=mode)
+
+
+# links_only modes don’t render the page but must give the same links as
+# the readable and full modes (from which they are cleaned)
+@pytest.mark.parametrize("url,content", documents())
+@pytest.mark.parametrize("mode,links_mode", [("readable", "links_only"),
+                                             ("full", "full_links_only")])
+def test_links_only(url, content, mode, links_mode):
+    expected = links_and_images(url, content, mode)
+    assert links_and_images(url, content, links_mode) == expected
+    whitelisted = {"example.org": "whitelisted"}
+    expected = links_and_images(url, content, mode, **whitelisted)
+    assert links_and_images(url, content, links_mode, **whitelisted) == expected
+
+
+def test_messy_links():
+    links, images = links_and_images("https://www.example.org/messy.html", MESSY_HTML,
+                                     "full_links_only")
+    site = "https://www.example.org/"
+    assert links[:4] == [site + "one.html", site + "two.html", site + "after-comment.html",
+                         site + "after-entity.html"]
+    # A single link as the only content of an unknown tag is rendered as text
+    assert site + "single-child.html" not in links
+    # Images are relative to <base>
+    assert site + "sub/dir/lazy.jpg" in images
+    assert links[-2:] == [site + "atom.xml", site + "messy.html"]
@@ -0,0 +1,66 @@
+import json
+import random
+
+import netcache  # noqa: F401
+import ansicat
+import corpus
+import offutils
+
+
+# Opening a page and using it in every mode only parses it once with
+# lxml, once with readability and once with BeautifulSoup (plus its summary)
+def test_parse_once():
+    content = corpus.html(random.Random(1), depth=3, sections=2)
+    offutils.set_profiling(True)
+    try:
+        renderer = ansicat.set_renderer(content, "https://example.org/page.html", "text/html")
+        title = renderer.get_title()
+        for width in [40, 72]:
+            renderer.get_body(width=width, mode="readable")
+            renderer.get_body(width=width, mode="full")
+        renderer.get_links(mode="links_only")
+        renderer.get_links(mode="full_links_only")
+        renderer.get_subscribe_links()
+        calls = {name: stats[0] for name, stats in offutils._SPANS.items()}
+    finally:
+        offutils.set_profiling(False)
+    assert calls["html.tree"] == 1
+    assert calls["html.readability"] == 1
+    assert calls["html.soup"] == 2
+    # The title and the summary are the same as with readability alone
+    readable = ansicat.Document(content)
+    assert title == readable.short_title()
+    assert renderer.summary[1] == ansicat.Document(content).summary()
+
+
+# The page is walked once per mode, other widths only lay its model out again
+def test_model_once(monkeypatch):
+    content = corpus.html(random.Random(2), depth=3, sections=2)
+    url = "https://example.org/page.html"
+    calls = []
+    model = ansicat.HtmlRenderer.model
+
+    def counting_model(self, *args, **kwargs):
+        calls.append(kwargs.get("mode"))
+        return model(self, *args, **kwargs)
+    renderer = ansicat.set_renderer(content, url, "text/html")
+    with monkeypatch.context() as m:
+        m.setattr(ansicat.HtmlRenderer, "model", counting_model)
+        bodies = {}
+        for width in [40, 72, 100]:
+            for mode in ["readable", "full"]:
+                bodies[(width, mode)] = renderer.get_body(width=width, mode=mode)
+    assert sorted(calls) == ["full", "readable"]
+    # only the last layout of each mode is kept
+    assert sorted(renderer.rendered_text) == ["full", "readable"]
+    assert renderer.rendered_text["full"][1] == bodies[(100, "full")]
+    # with the same result as a new rendering
+    for (width, mode), body in bodies.items():
+        assert ansicat.set_renderer(content, url, "text/html").get_body(width=width, mode=mode) == body
+    page, _links = ansicat.set_renderer(content, url, "text/html").model(content, mode="full")
+    assert renderer.get_title() in page.get_text()
+    # the model is only data (images included): it can be saved and laid out
+    saved = ansicat.PageModel(title=page.title, center=page.center)
+    saved.ops = json.loads(json.dumps(page.ops))
+    assert any(name == "add_image" for name, args, kwargs in saved.ops)
+    assert renderer.layout(saved, 72) == renderer.layout(page, 72)
@@ -0,0 +1,93 @@
+import time
+
+import pytest
+
+import netcache
+import ansicat
+from offutils import CMDS, sniff_image
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 100
+
+
+# chafa is replaced by a script writing its arguments in a log
+@pytest.fixture
+def chafa(tmp_path, monkeypatch):
+    monkeypatch.setenv("OFFPUNK_CACHE_PATH", str(tmp_path / "cache"))
+    log = tmp_path / "chafa.log"
+    script = tmp_path / "chafa"
+    script.write_text("#!/bin/sh\nsleep 0.3\necho \"$@\" >> %s\necho \"ANSI $8\"\n" % log)
+    script.chmod(0o755)
+    monkeypatch.setitem(CMDS, "chafa", str(script))
+    monkeypatch.setitem(CMDS, "timg", None)
+    monkeypatch.setattr(ansicat, "_RENDER_IMAGE", True)
+    monkeypatch.setattr(ansicat, "_IMAGE_DIGESTS", {})
+
+    def calls():
+        return log.read_text().splitlines() if log.exists() else []
+    return calls
+
+
+def image(tmp_path, name, data=PNG):
+    path = tmp_path / name
+    path.write_bytes(data + name.encode())
+    return str(path)
+
+
+def test_inline_image_cache(tmp_path, chafa):
+    img = image(tmp_path, "a.png")
+    assert ansicat.inline_image(img, 40) == "ANSI 40\n"
+    assert ansicat.inline_image(img, 40) == "ANSI 40\n"
+    assert len(chafa()) == 1
+    ansicat.inline_image(img, 20)
+    assert len(chafa()) == 2
+    # The same image somewhere else is not converted again
+    copy = tmp_path / "copy.png"
+    with open(img, "rb") as f:
+        copy.write_bytes(f.read())
+    assert ansicat.inline_image(str(copy), 40) == "ANSI 40\n"
+    assert len(chafa()) == 2
+    # Not an image: chafa is not even run
+    assert ansicat.inline_image(image(tmp_path, "page.png", b"<html>"), 40) == ""
+    assert ansicat.inline_image(str(tmp_path / "missing.png"), 40) == ""
+    assert len(chafa()) == 2
+
+
+def test_prefetch(tmp_path, chafa):
+    images = [image(tmp_path, "%s.png" % i) for i in range(4)]
+    start = time.perf_counter()
+    ansicat.prefetch_images([(img, 30) for img in images])
+    ansicat.prefetch_images([(img, 30) for img in images])
+    assert [ansicat.inline_image(img, 30) for img in images] == ["ANSI 30\n"] * 4
+    # Conversions were done in parallel
+    assert time.perf_counter() - start < 0.3 * 4
+    assert len(chafa()) == 4
+    assert not ansicat._IMAGE_JOBS
+
+
+def test_html_images(tmp_path, chafa):
+    for i in range(3):
+        netcache.write_body("https://example.org/img/%s.png" % i, PNG + bytes([i]), "image/png")
+    html = "<html><body><p>Text</p>%s</body></html>" % "".join(
+        '<p><img src="/img/%s.png" alt="image %s"></p>' % (i, i) for i in range(3))
+    renderer = ansicat.set_renderer(html, "https://example.org/page.html", "text/html")
+    renderer.options["images_size"] = 25
+    body = renderer.get_body(width=60, mode="full")
+    assert body.count("ANSI 25") == 3
+    assert len(chafa()) == 3
+    # An other session, images are still in cache
+    renderer = ansicat.set_renderer(html, "https://example.org/page.html", "text/html")
+    renderer.options["images_size"] = 25
+    assert renderer.get_body(width=60, mode="full") == body
+    assert len(chafa()) == 3
+
+
+def test_sniff_image():
+    assert sniff_image(PNG) == "image/png"
+    assert sniff_image(b"\xff\xd8\xff\xe0\x00\x10JFIF") == "image/jpeg"
+    assert sniff_image(b"GIF89a\x01\x00") == "image/gif"
+    assert sniff_image(b"RIFF\x00\x00\x00\x00WEBPVP8 ") == "image/webp"
+    assert sniff_image(b"\x00\x00\x00\x1cftypavif") == "image/avif"
+    assert sniff_image(b'<?xml version="1.0"?>\n<svg xmlns="http://www.w3.org/2000/svg">') \
+        == "image/svg+xml"
+    assert sniff_image(b"<!DOCTYPE html><html>") is None
+    assert sniff_image(b"") is None
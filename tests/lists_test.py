@@ -0,0 +1,65 @@
+import os
+
+import netcache  # noqa: F401
+import ansicat
+
+LISTS = {
+    "bookmarks": "# Bookmarks\n=> gemini://example.org/ Example\n=> https://example.org/a A\n"
+                 "See also https://example.org/b and gemini://example.org/c\n"
+                 "* https://example.org/not-a-link\n",
+    "news": "# News #subscribed\n=> gemini://example.org/news\n\n```\n=> not a link\n```\n",
+    "old": "# Old #frozen\n=> gemini://example.org/old\n=>\n",
+    "history": "#history\n" + "".join("=> gemini://example.org/%s\n" % i for i in range(50)),
+    "empty": "",
+}
+
+
+def write_lists(datadir):
+    listdir = os.path.join(datadir, "lists")
+    os.makedirs(listdir)
+    for name, content in LISTS.items():
+        with open(os.path.join(listdir, name + ".gmi"), "w") as f:
+            f.write(content)
+    return listdir
+
+
+def folder(datadir):
+    renderer = ansicat.FolderRenderer("", "list:///", datadir=datadir)
+    return renderer.get_body(mode="readable"), renderer.get_links(mode="readable")
+
+
+# The page of the lists only reads the lists which have been modified
+def test_list_summary(tmp_path, monkeypatch):
+    monkeypatch.setenv("OFFPUNK_CACHE_PATH", str(tmp_path / "cache"))
+    listdir = write_lists(str(tmp_path))
+    read = []
+    decode_file = ansicat.decode_file
+
+    def counting_decode(path):
+        read.append(os.path.basename(path))
+        return decode_file(path)
+    monkeypatch.setattr(ansicat, "decode_file", counting_decode)
+    body, links = folder(str(tmp_path))
+    assert sorted(read) == sorted(name + ".gmi" for name in LISTS)
+    summary = ansicat.list_summary(listdir)
+    page = ansicat.FolderRenderer("", "list:///", datadir=str(tmp_path)).prepare("")[0][0]
+    for name in LISTS:
+        # the same number of items as in the list itself
+        path = os.path.join(listdir, name + ".gmi")
+        items = len(ansicat.renderer_from_file(path).get_links())
+        assert summary[name]["items"] == items
+        assert "=> list:///%s %s (%s items)\n" % (name, name, items) in page
+    assert summary["news"]["subscribed"] and summary["old"]["frozen"]
+    assert summary["bookmarks"]["title"] == "# Bookmarks"
+    read.clear()
+    assert folder(str(tmp_path)) == (body, links)
+    assert not read
+    # A modified list is read again, a deleted one is forgotten
+    with open(os.path.join(listdir, "bookmarks.gmi"), "a") as f:
+        f.write("=> gemini://example.org/b B\n")
+    os.remove(os.path.join(listdir, "old.gmi"))
+    body, links = folder(str(tmp_path))
+    assert read == ["bookmarks.gmi"]
+    assert "list:///old" not in links
+    summary = ansicat.list_summary(listdir)
+    assert summary["bookmarks"]["items"] == 5 and "old" not in summary
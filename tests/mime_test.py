@@ -0,0 +1,89 @@
+import random
+
+import pytest
+
+import netcache
+import ansicat
+import corpus
+from offutils import CMDS, get_file_mime, set_file_mime
+
+# A 1x1 PNG
+PNG = (b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x00"
+       b"\x00\x00\x00:~\x9bU\x00\x00\x00\nIDATx\x9cc`\x00\x00\x00\x02\x00\x01H\xaf\xa4q"
+       b"\x00\x00\x00\x00IEND\xaeB`\x82")
+
+SAMPLES = [
+    b"<!DOCTYPE html><html><body>x</body></html>",
+    b"  \n\n<!doctype HTML>\n<HTML>",
+    b"\xef\xbb\xbf<!DOCTYPE html><html>",
+    b"<p>hello <a href=\"x\">x</a></p>",
+    b"<div>not enough for file</div>",
+    b"text then <html> later",
+    b"<!-- comment -->\n<html><body>",
+    b"<head><title>x</title></head>",
+    b"<?xml version=\"1.0\"?>\n<rss version=\"2.0\"><channel></channel></rss>",
+    b"<rss version=\"2.0\"><channel><title>x</title></channel></rss>",
+    b"<feed xmlns=\"http://www.w3.org/2005/Atom\"><title>x</title></feed>",
+    b"<?xml version=\"1.0\"?>\n<!DOCTYPE html PUBLIC \"x\" \"y\"><html></html>",
+    b"\n<?xml version=\"1.0\"?><rss>",
+    b"<svg xmlns=\"http://www.w3.org/2000/svg\"></svg>",
+    b"# title\n=> gemini://example.org/ link\n",
+    b"caf\xe9 latin1\n",
+    b"a\x1b[1mbold\n",
+    b"From: someone@example.org\nSubject: x\n\nbody\n",
+    b"Path: news.example.org\n",
+    b"-----BEGIN PGP PUBLIC KEY BLOCK-----\n\nabc\n",
+    b"-----BEGIN PGP SIGNATURE-----\n\nabc\n",
+    b"%PDF-1.4\n",
+    PNG,
+    b"GIF89a\x01\x00\x01\x00",
+]
+
+
+def documents():
+    rng = random.Random(3)
+    docs = [s for s in SAMPLES]
+    docs += [corpus.gemtext(rng, links=20).encode(), corpus.html(rng, depth=2, sections=1).encode(),
+             corpus.rss(rng, items=3).encode(), corpus.atom(rng, entries=3).encode(),
+             corpus.gophermap(rng, lines=20).encode(), corpus.plaintext(rng, lines=20).encode()]
+    return docs
+
+
+def mimes(tmp_path):
+    result = []
+    for i, data in enumerate(documents()):
+        for name in ("page", "page.html", "feed.xml", "notes.txt", "image.svg"):
+            path = tmp_path / str(i) / name
+            path.parent.mkdir(exist_ok=True)
+            path.write_bytes(data)
+            result.append((str(path), ansicat.get_mime(str(path))))
+    return result
+
+
+# The first bytes of a file are enough to find the same type as "file"
+@pytest.mark.skipif(not CMDS["file"], reason="file is needed for the comparison")
+def test_sniff_like_file(tmp_path, monkeypatch):
+    with monkeypatch.context() as m:
+        m.setattr(ansicat, "sniff_mime", lambda data: None)
+        expected = mimes(tmp_path)
+    monkeypatch.setitem(CMDS, "file", "")
+    assert mimes(tmp_path) == expected
+
+
+def test_fetched_mime(tmp_path, monkeypatch):
+    monkeypatch.setenv("OFFPUNK_CACHE_PATH", str(tmp_path / "cache"))
+    monkeypatch.setitem(CMDS, "file", "")
+    path = netcache.write_body("gemini://example.org/about", "<html>\n# About\n", "text/gemini")
+    if not get_file_mime(path):
+        pytest.skip("no extended attributes on this filesystem")
+    # The type given by the server is used
+    assert ansicat.get_mime(path) == "text/gemini"
+    atom = corpus.atom(random.Random(1), entries=2).encode()
+    path = netcache.write_body("https://example.org/feed", atom, "application/atom+xml; charset=utf-8")
+    assert ansicat.get_mime(path) == "application/atom+xml"
+    # but not if it is too vague
+    path = netcache.write_body("https://example.org/rss", corpus.rss(random.Random(1), items=2),
+                               "text/html")
+    assert ansicat.get_mime(path) == "text/xml"
+    set_file_mime(path, "application/octet-stream")
+    assert ansicat.get_mime(path) == "text/xml"
@@ -0,0 +1,241 @@
+import io
+import json
+import os
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import ansicat
+import netcache
+from offutils import CMDS
+from servers import LocalServers, Site
+
+
+@pytest.fixture(scope="module")
+def servers():
+    with LocalServers(Site(pages=20, links=3, error_rate=0.2)) as local:
+        yield local
+
+
+# Each test has its own cache and certificates
+@pytest.fixture(autouse=True)
+def folders(tmp_path, monkeypatch):
+    monkeypatch.setenv("OFFPUNK_CACHE_PATH", str(tmp_path / "cache"))
+    monkeypatch.setenv("XDG_DATA_HOME", str(tmp_path / "data"))
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(tmp_path / "config"))
+    return tmp_path
+
+
+def fetch(url, **kwargs):
+    report = {}
+    path, newurl = netcache.fetch(url, report=report, interactive=False, **kwargs)
+    return path, newurl, report
+
+
+@pytest.mark.parametrize("protocol", ["gemini", "gopher", "spartan", "finger"])
+def test_fetch(servers, protocol):
+    path, newurl, report = fetch(servers.url(protocol, "/page/1"))
+    assert report["status"] == "fetched"
+    with open(path) as f:
+        assert "Page 1" in f.read()
+    # Second time, it comes from the cache
+    path2, _, report = fetch(servers.url(protocol, "/page/1"), validity=60)
+    assert report["status"] == "cached"
+    assert path2 == path
+
+
+@pytest.mark.skipif(not CMDS["curl"], reason="curl is needed for http")
+def test_fetch_http(servers):
+    path, newurl, report = fetch(servers.url("http", "/redirect/2"))
+    assert report["status"] == "fetched"
+    with open(path) as f:
+        assert "<h1>Page 0</h1>" in f.read()
+    assert report["bytes"] == os.path.getsize(path)
+    assert not report["unchanged"]
+    # The page did not change: nothing is downloaded, the cache is kept
+    path2, _, report = fetch(servers.url("http", "/redirect/2"), validity=1)
+    assert report["status"] == "fetched"
+    assert report["unchanged"]
+    assert report["bytes"] == 0
+    assert path2 == path
+
+
+def test_redirects(servers):
+    path, newurl, report = fetch(servers.url("gemini", "/redirect/3"))
+    assert newurl == servers.url("gemini", "/page/0")
+    path, newurl, report = fetch(servers.url("spartan", "/redirect/1"))
+    assert newurl == servers.url("spartan", "/page/0")
+    assert report["status"] == "fetched"
+
+
+def test_errors(servers):
+    _, _, report = fetch(servers.url("gemini", "/slowdown"))
+    assert report["status"] == "error"
+    assert report["error_class"] == "server"
+    _, _, report = fetch(servers.url("gemini", "/notfound"))
+    assert report["error"] == "Not found"
+    # Some pages are in error (always the same ones)
+    reports = [fetch(servers.url("gemini", "/page/%s" % i))[2] for i in range(20)]
+    errors = [i for i, r in enumerate(reports) if r["status"] == "error"]
+    assert errors
+    for i in errors:
+        assert reports[i]["error"] == "Injected error on page %s" % i
+
+
+def test_daemon(servers, folders):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    daemon = subprocess.Popen([sys.executable, os.path.join(root, "netcache.py"), "--serve"],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        socket_path = netcache._daemon_socket_path()
+        for _ in range(100):
+            if netcache._daemon_request(socket_path, {"ping": True}):
+                break
+            time.sleep(0.05)
+        else:
+            pytest.fail("the daemon didn’t start")
+        url = servers.url("gopher", "/page/2")
+        before = servers.site.hits.get("/page/2", 0)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(fetch(url))) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert all(r[2]["status"] == "fetched" for r in results)
+        assert len(set(r[0] for r in results)) == 1
+        # Identical concurrent requests are coalesced by the daemon
+        assert servers.site.hits["/page/2"] - before < 4
+        # Only the user can use the socket
+        assert os.stat(socket_path).st_mode & 0o077 == 0
+        assert os.stat(os.path.dirname(socket_path)).st_mode & 0o777 == 0o700
+        # Without its socket, nobody can reach the daemon: it stops
+        os.remove(socket_path)
+        assert daemon.wait(5) == 0
+    finally:
+        daemon.terminate()
+        daemon.wait(10)
+
+
+# A daemon which doesn’t answer is not waited for
+def test_stuck_daemon(servers, monkeypatch):
+    monkeypatch.setattr(netcache, "_DAEMON_TIMEOUT", 0.5)
+    socket_path = netcache._daemon_socket_path()
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as stuck:
+        stuck.bind(socket_path)
+        stuck.listen()
+        start = time.monotonic()
+        path, newurl, report = fetch(servers.url("gemini", "/page/3"))
+        assert report["status"] == "fetched"
+        assert time.monotonic() - start < 5
+        # and its socket is removed
+        assert not os.path.exists(socket_path)
+
+
+# A busy daemon still answers a ping: its socket is kept
+def test_busy_daemon(servers, monkeypatch):
+    monkeypatch.setattr(netcache, "_DAEMON_TIMEOUT", 0.5)
+    socket_path = netcache._daemon_socket_path()
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+
+    class Busy(socketserver.StreamRequestHandler):
+        def handle(self):
+            if "ping" in json.loads(self.rfile.readline()):
+                self.wfile.write(b'{"pong": true}\n')
+            else:
+                time.sleep(1)
+    busy = socketserver.ThreadingUnixStreamServer(socket_path, Busy)
+    busy.daemon_threads = True
+    threading.Thread(target=busy.serve_forever, daemon=True).start()
+    try:
+        path, newurl, report = fetch(servers.url("gemini", "/page/4"))
+        assert report["status"] == "fetched"
+        assert os.path.exists(socket_path)
+    finally:
+        busy.shutdown()
+        busy.server_close()
+
+
+# Concurrent fetches used to read the TOFU counters while they were written
+def test_batch(servers):
+    output = io.StringIO()
+    urls = [servers.url("gemini", "/page/%s" % i) for i in range(20)]
+    netcache.fetch_batch(urls, workers=8, per_host=8, output=output, interactive=False)
+    results = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert len(results) == 20
+    for r in results:
+        assert r["status"] == "fetched" or r["error"].startswith("Injected error")
+
+
+def test_stat_cache(folders):
+    netcache.write_body("gemini://example.org/", "=> new.gmi\n=> old.gmi\n", "text/gemini")
+    netcache.write_body("gemini://example.org/new.gmi", "# New\n", "text/gemini")
+    netcache.write_body("gemini://example.org/old.gmi", "# Old\n", "text/gemini")
+    netcache.write_body("gemini://example.org/dir/", "# Folder\n", "text/gemini")
+    old = netcache.get_cache_path("gemini://example.org/old.gmi")
+    os.utime(old, (time.time() - 3600, time.time() - 3600))
+    urls = ["gemini://example.org/", "gemini://example.org/new.gmi", "gemini://example.org/old.gmi",
+            "gemini://example.org/dir", "gemini://example.org/missing", "gemini://other.org/"]
+
+    def lookups():
+        return [(netcache.get_cache_path(u), netcache.cache_last_modified(u),
+                 netcache.is_cache_valid(u), netcache.is_cache_valid(u, validity=60)) for u in urls]
+
+    expected = lookups()
+    with netcache.stat_cache():
+        assert lookups() == expected
+    # Relative links are compared with the cache of their target
+    with open(netcache.get_cache_path("gemini://example.org/")) as f:
+        renderer = ansicat.set_renderer(f.read(), "gemini://example.org/", "text/gemini")
+    new, old = renderer.get_body(width=40).splitlines()[:2]
+    assert "\x1b[1m" in new and "\x1b[1m" not in old
+
+
+# Identities are found for the host and its parent domains, new ones are seen
+# at once and the certificates of an identity are loaded only once
+@pytest.mark.skipif(not netcache.load_CRYPTOGRAPHY(), reason="cryptography is needed")
+def test_identities(folders, monkeypatch):
+    monkeypatch.setattr(netcache, "_IDENTITIES", None)
+    monkeypatch.setattr(netcache, "_SSL_CONTEXTS", {})
+    netcache.create_certificate("me", 30, "example.org")
+    assert netcache.get_certs("gemini://example.org/") == ["me"]
+    assert netcache.get_certs("gemini://sub.example.org/page") == ["me"]
+    assert netcache.get_certs("gemini://other.org/") == []
+    certkey = netcache._get_client_certkey("me", "sub.example.org")
+    assert certkey["cert"].endswith(os.path.join("example.org", "me.cert"))
+    netcache.create_certificate("other", 30, "sub.example.org")
+    assert sorted(netcache.get_certs("gemini://sub.example.org/")) == ["me", "other"]
+    assert netcache.get_certs("gemini://example.org/") == ["me"]
+    # identities added by another process are seen too
+    certdir = os.path.join(str(folders), "data", "offpunk", "certs")
+    for host, name in [("example.org", "copy"), ("new.org", "me")]:
+        os.makedirs(os.path.join(certdir, host), exist_ok=True)
+        for ext in [".cert", ".key"]:
+            with open(os.path.join(certdir, "example.org", "me" + ext), "rb") as f:
+                data = f.read()
+            with open(os.path.join(certdir, host, name + ext), "wb") as f:
+                f.write(data)
+    assert sorted(netcache.get_certs("gemini://example.org/")) == ["copy", "me"]
+    assert netcache.get_certs("gemini://new.org/") == ["me"]
+    loaded = []
+    load_cert_chain = netcache.ssl.SSLContext.load_cert_chain
+
+    def counting_load(self, certfile, keyfile=None, *args):
+        loaded.append(certfile)
+        return load_cert_chain(self, certfile, keyfile, *args)
+    monkeypatch.setattr(netcache.ssl.SSLContext, "load_cert_chain", counting_load)
+    certkey = netcache._get_client_certkey("me", "example.org")
+    context = netcache._get_ssl_context(certkey)
+    assert netcache._get_ssl_context(dict(certkey)) is context
+    assert netcache._get_ssl_context() is not context
+    assert loaded == [certkey["cert"]]
+    # a new identity makes the contexts load their files again
+    netcache.create_certificate("third", 30, "example.org")
+    assert netcache._get_ssl_context(certkey) is not context
+    assert loaded == [certkey["cert"]] * 2
@@ -0,0 +1,23 @@
+import pytest
+
+import offpunk
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setenv("OFFPUNK_CACHE_PATH", str(tmp_path / "cache"))
+    monkeypatch.setenv("XDG_DATA_HOME", str(tmp_path / "data"))
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(tmp_path / "config"))
+    return offpunk.GeminiClient()
+
+
+# "set profile_dump None" stops writing the dumps
+def test_set_profile_dump(client):
+    client.do_set("profile_dump ~/dumps")
+    assert client.options["profile_dump"] == "~/dumps"
+    client.do_set("profile_dump None")
+    assert client.options["profile_dump"] is None
+    client.do_set('profile_dump "2024"')
+    assert client.options["profile_dump"] == "2024"
+    client.do_set('profile_dump ""')
+    assert client.options["profile_dump"] is None
@@ -0,0 +1,27 @@
+import os
+
+import netcache  # noqa: F401 (offutils needs netcache to be imported first)
+import offutils
+
+
+# atomic_open() never changes the umask (other threads may create files)
+def test_atomic_open_umask(tmp_path, monkeypatch):
+    umask = offutils._UMASK
+    try:
+        offutils.set_umask(0o027)
+
+        def no_umask(mask):
+            raise AssertionError("the umask was changed")
+        monkeypatch.setattr(os, "umask", no_umask)
+        with offutils.atomic_open(str(tmp_path / "new")) as f:
+            f.write("new")
+        assert os.stat(tmp_path / "new").st_mode & 0o777 == 0o640
+        # the permissions of an existing file are kept
+        os.chmod(tmp_path / "new", 0o604)
+        with offutils.atomic_open(str(tmp_path / "new")) as f:
+            f.write("replaced")
+        assert os.stat(tmp_path / "new").st_mode & 0o777 == 0o604
+        assert (tmp_path / "new").read_text() == "replaced"
+    finally:
+        monkeypatch.undo()
+        offutils.set_umask(umask)
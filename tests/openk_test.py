@@ -0,0 +1,187 @@
+import os
+import random
+import time
+
+import pytest
+
+import netcache
+import ansicat
+import corpus
+import offutils
+import openk
+from offutils import CMDS
+
+
+@pytest.fixture
+def renderer():
+    text = corpus.plaintext(random.Random(1), lines=3000)
+    return ansicat.set_renderer(text, "gemini://example.org/long.txt", "text/plain")
+
+
+# less is replaced by a command writing what it reads in a file
+def test_less_stream(renderer, tmp_path, monkeypatch):
+    out = tmp_path / "out"
+    monkeypatch.setitem(CMDS, "less", "cat %%s > %s" % out)
+    bodies = []
+
+    def display(write):
+        bodies.append(renderer.display(mode="readable", stream=write))
+
+    # the title has the time of access, which may change during the test
+    titles = [renderer.get_formatted_title(linksnbr=False) + "\n"]
+    with open(tmp_path / "page", "w") as f:
+        openk.less_stream(display, f)
+    titles.append(renderer.get_formatted_title(linksnbr=False) + "\n")
+    body = bodies[0]
+    assert body.startswith(tuple(titles))
+    assert (tmp_path / "page").read_text() == body
+    assert out.read_text() == body
+
+
+# When less is quit before the end of the page, the rendering is stopped
+def test_less_stream_quit(renderer, tmp_path, monkeypatch):
+    monkeypatch.setitem(CMDS, "less", "head -c 1 %s > /dev/null")
+
+    def display(write):
+        write("Start\n")
+        time.sleep(0.5)
+        renderer.display(mode="readable", stream=write)
+
+    with open(tmp_path / "page", "w") as f:
+        with pytest.raises(openk._PagerClosed):
+            openk.less_stream(display, f)
+    # Nothing of the partial rendering is kept
+    assert "readable" not in renderer.links
+    assert renderer.get_body(mode="readable").count("\n") > 3000
+
+
+# A long page already rendered, in memory or in the render cache, is given
+# to less at once
+@pytest.mark.parametrize("rendered", ["memory", "disk"])
+def test_less_stream_rendered(tmp_path, monkeypatch, rendered):
+    monkeypatch.setenv("OFFPUNK_CACHE_PATH", str(tmp_path / "cache"))
+    monkeypatch.setitem(CMDS, "less", "cat %s > " + str(tmp_path / "shown"))
+    monkeypatch.setitem(CMDS, "cat", CMDS["less"])
+    url = "gemini://example.org/long.txt"
+    text = corpus.plaintext(random.Random(1), lines=8000)
+    assert len(text) > openk._STREAM_SIZE
+    path = netcache.write_body(url, text, "text/plain")
+    os.utime(path, (time.time() - 60, time.time() - 60))
+    key = openk.mode_url(url, "readable")
+    cache = openk.opencache()
+    if rendered == "memory":
+        cache.get_renderer(url, render_cache=True).get_links(mode="readable")
+    else:
+        # rendered in a previous session
+        openk.opencache().openk(url, render_cache=True)
+    cache.openk(url, render_cache=True)
+    page = open(cache.temp_files[key]).read()
+    cache.cleanup()
+    assert page.count("\n") > 8000
+    assert (tmp_path / "shown").read_text() == page
+
+
+# A resized terminal only needs a new layout of the page, which is parsed once
+def test_resize(tmp_path, monkeypatch):
+    monkeypatch.setenv("OFFPUNK_CACHE_PATH", str(tmp_path / "cache"))
+    monkeypatch.setitem(CMDS, "less", "cat %s >> " + str(tmp_path / "shown"))
+    monkeypatch.setitem(CMDS, "cat", CMDS["less"])
+    url = "https://example.org/page.html"
+    path = netcache.write_body(url, corpus.html(random.Random(2), depth=3, sections=2), "text/html")
+    os.utime(path, (time.time() - 60, time.time() - 60))
+    cache = openk.opencache()
+    offutils.set_profiling(True)
+    try:
+        widths = {}
+        histfiles = set()
+        for columns in ["100", "50", "100"]:
+            monkeypatch.setenv("COLUMNS", columns)
+            cache.openk(url)
+            key = openk.mode_url(url, "readable")
+            widths.setdefault(columns, set()).add(open(cache.temp_files[key]).read())
+            histfiles.add(cache.less_histfile[key])
+        parsed = offutils._SPANS["html.readability"][0]
+    finally:
+        offutils.set_profiling(False)
+    cache.cleanup()
+    assert parsed == 1
+    assert widths["100"] != widths["50"] and len(widths["100"]) == 1
+    # The position in less is kept
+    assert len(histfiles) == 1
+
+
+# Renderers not used for a while are unloaded when they use too much memory
+# but they still know their title and links
+def test_render_cache_mb(tmp_path, monkeypatch):
+    monkeypatch.setenv("OFFPUNK_CACHE_PATH", str(tmp_path / "cache"))
+    rng = random.Random(3)
+    urls = ["https://example.org/%s.html" % i for i in range(5)]
+    for url in urls:
+        path = netcache.write_body(url, corpus.html(rng, depth=3, sections=2), "text/html")
+        os.utime(path, (time.time() - 60, time.time() - 60))
+    cache = openk.opencache()
+    expected = {}
+    for url in urls:
+        renderer = cache.get_renderer(url)
+        expected[url] = (renderer.get_body(mode="full"), renderer.get_title(),
+                         renderer.get_links(mode="full"))
+    sizes = [cache.rendererdic[url].footprint() for url in urls]
+    loaded = sizes[0]
+    assert min(sizes) > 100000
+    assert cache.renderer_stats == {"hits": 0, "misses": 5, "unloads": 0}
+    # (an unloaded renderer still uses a bit of memory for its links)
+    cache.render_cache_mb = (sum(sizes[2:]) + 50000) / 1000000
+    assert cache.limit_renderers() <= cache.render_cache_mb * 1000000
+    assert cache.renderer_stats["unloads"] == 2
+    first = cache.rendererdic[urls[0]]
+    assert first.footprint() < loaded / 10
+    assert first._body is None and first.soup is None
+    # The most recently used are kept
+    assert [cache.rendererdic[url].footprint() for url in urls[2:]] == sizes[2:]
+    # An unloaded renderer gives its title and links without reading its page
+    with monkeypatch.context() as m:
+        m.setattr(ansicat, "decode_file", None)
+        assert cache.get_renderer(urls[0]) is first
+        assert (first.get_title(), first.get_links(mode="full")) == expected[urls[0]][1:]
+    # and renders it again if needed
+    assert first.get_body(mode="full") == expected[urls[0]][0]
+    assert cache.renderer_stats["hits"] == 1
+    assert "5 renderers" in cache.renderers_info()
+
+
+# Lists are rendered again only when they are modified, or when their links
+# are downloaded
+def test_local_renderers(tmp_path, monkeypatch):
+    monkeypatch.setenv("OFFPUNK_CACHE_PATH", str(tmp_path / "cache"))
+    monkeypatch.setenv("XDG_DATA_HOME", str(tmp_path / "data"))
+    lists = tmp_path / "data" / "offpunk" / "lists"
+    lists.mkdir(parents=True)
+    urls = ["gemini://example.org/%s.gmi" % i for i in range(2000)]
+    history = lists / "history.gmi"
+    history.write_text("# History\n" + "".join("=> %s\n" % url for url in urls))
+    os.utime(history, (time.time() - 60, time.time() - 60))
+    cache = openk.opencache()
+    renderer = cache.get_renderer("list:///history")
+    assert renderer.get_links() == urls
+    body = renderer.get_body()
+    calls = []
+    model = ansicat.GemtextRenderer.model
+
+    def counting_model(self, *args, **kwargs):
+        calls.append(self.url)
+        return model(self, *args, **kwargs)
+    monkeypatch.setattr(ansicat.GemtextRenderer, "model", counting_model)
+    assert cache.get_renderer("list:///history") is renderer
+    assert renderer.get_links() == urls and renderer.get_body() == body
+    assert not calls
+    # A link which is now in the cache may be displayed differently
+    netcache.write_body(urls[5], "# Five\n", "text/gemini")
+    assert cache.get_renderer("list:///history") is renderer
+    renderer.get_body()
+    assert calls == ["list:///history"]
+    # A modified list has a new renderer
+    with open(history, "a") as f:
+        f.write("=> gemini://example.org/new.gmi\n")
+    renderer = cache.get_renderer("list:///history")
+    assert renderer.get_links() == urls + ["gemini://example.org/new.gmi"]
+    assert cache.renderer_stats["misses"] == 2
@@ -0,0 +1,110 @@
+import os
+
+import netcache  # noqa: F401 (offutils needs netcache to be imported first)
+from offutils import (
+    DomainBlocklist,
+    RedirectList,
+    get_url_redirected,
+    is_url_blocked,
+    load_blocklists,
+    redirect_list,
+    xdg,
+)
+
+
+def test_exact_and_subdomains():
+    redirects = RedirectList({"*reddit.com": "teddit.net", "ex.org": "blocked"})
+    assert get_url_redirected("https://www.reddit.com/r/x", redirects) == "teddit.net"
+    assert get_url_redirected("https://old.reddit.com", redirects) == "teddit.net"
+    assert get_url_redirected("https://sub.ex.org", redirects) is None
+    assert is_url_blocked("http://ex.org/page", redirects)
+    assert not is_url_blocked("http://example.org/page", redirects)
+
+
+# "*.domain" only matches subdomains and the longest rule wins
+def test_longest_rule():
+    redirects = RedirectList({"*example.com": "blocked", "*.a.example.com": "whitelisted"})
+    assert get_url_redirected("http://example.com", redirects, returnkey=True) == [
+        "blocked",
+        "*example.com",
+    ]
+    assert get_url_redirected("http://a.example.com", redirects) == "blocked"
+    assert get_url_redirected("http://b.a.example.com", redirects) == "whitelisted"
+
+
+# Modifying the rules should be taken into account immediately
+def test_modified_rules():
+    redirects = RedirectList({"example.com": "blocked"})
+    assert is_url_blocked("http://example.com", redirects)
+    redirects.pop("example.com")
+    assert not is_url_blocked("http://example.com", redirects)
+    redirects["*com"] = "blocked"
+    assert is_url_blocked("http://example.com", redirects)
+    # plain dicts are still accepted
+    assert is_url_blocked("http://example.com", {"example.com": "blocked"})
+
+
+# The rules of a dict and the blocked domains are only compiled once
+def test_redirect_list(monkeypatch):
+    compiled = []
+    compile = RedirectList.compile
+
+    def counting_compile(self):
+        compiled.append(dict(self))
+        return compile(self)
+    monkeypatch.setattr(RedirectList, "compile", counting_compile)
+    rules = {"ex.org": "whitelisted", "*reddit.com": "teddit.net"}
+    blocked = {"ex.org", "spam.org"}
+    for url in ["https://spam.org/", "https://ex.org/", "https://www.reddit.com/x"] * 10:
+        redirects = redirect_list(rules, blocked)
+        get_url_redirected(url, redirects)
+        get_url_redirected(url, rules)
+    assert redirects["ex.org"] == "whitelisted" and redirects["spam.org"] == "blocked"
+    assert is_url_blocked("https://spam.org/", redirects)
+    assert len(compiled) == 2
+    # but again if they change
+    rules["spam.org"] = "whitelisted"
+    assert not is_url_blocked("https://spam.org/", redirect_list(rules, blocked))
+    assert len(compiled) == 3
+    redirects = RedirectList(rules)
+    assert redirect_list(redirects) is redirects
+
+
+def test_blocklists(tmp_path, monkeypatch):
+    monkeypatch.setenv("OFFPUNK_CACHE_PATH", str(tmp_path / "cache"))
+    folder = tmp_path / "blocklists"
+    folder.mkdir()
+    (folder / "hosts").write_text(
+        "# comment\n127.0.0.1 localhost\n0.0.0.0 ads.example.com tracker.net\n"
+    )
+    (folder / "domains.txt").write_text("spam.org\n||adblock.style.com^\n")
+    blocklist = load_blocklists(str(folder))
+    assert len(blocklist) == 4
+    assert blocklist.match("tracker.net") == "tracker.net"
+    assert blocklist.match("a.b.spam.org:8080") == "spam.org"
+    assert blocklist.match("example.com") is None
+    assert blocklist.match("localhost") is None
+    # The prebuilt version is reused
+    prebuilt = DomainBlocklist.load(
+        os.path.join(xdg("cache"), "blocklists.bin"),
+        [[str(p), p.stat().st_mtime_ns, p.stat().st_size] for p in sorted(folder.iterdir())],
+    )
+    assert prebuilt.hashes == blocklist.hashes
+    # but not if it is truncated
+    path = os.path.join(xdg("cache"), "blocklists.bin")
+    with open(path, "rb") as f:
+        data = f.read()
+    signature = [[str(p), p.stat().st_mtime_ns, p.stat().st_size] for p in sorted(folder.iterdir())]
+    for size in [len(data) - 8, len(data) - 3]:
+        with open(path, "wb") as f:
+            f.write(data[:size])
+        assert DomainBlocklist.load(path, signature) is None
+        assert load_blocklists(str(folder)).hashes == blocklist.hashes
+    # Rules have priority over blocklists
+    redirects = RedirectList({"ads.example.com": "whitelisted"})
+    redirects.blocklist = blocklist
+    assert get_url_redirected("https://ads.example.com", redirects) == "whitelisted"
+    assert get_url_redirected("https://www.tracker.net/x", redirects, returnkey=True) == [
+        "blocked",
+        "tracker.net",
+    ]
@@ -0,0 +1,87 @@
+import os
+import time
+
+import pytest
+
+import netcache
+import ansicat
+
+PAGE = "gemini://example.org/"
+HTML = "https://example.org/article.html"
+
+
+@pytest.fixture(autouse=True)
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("OFFPUNK_CACHE_PATH", str(tmp_path / "cache"))
+    netcache.write_body(PAGE, "# A page\n\n=> other.gmi Other\n=> /img.png An image\n", "text/gemini")
+    netcache.write_body(HTML, "<html><head><title>An article</title></head><body><article>"
+                              "<h1>An article</h1><p>Some text <a href='/x'>x</a>.</p>"
+                              "</article></body></html>", "text/html")
+    return tmp_path / "cache"
+
+
+def open_renderer(url, **options):
+    return ansicat.renderer_from_file(netcache.get_cache_path(url), url=url,
+                                      render_cache=True, **options)
+
+
+def no_rendering(*args, **kwargs):
+    raise AssertionError("rendered instead of loaded from the cache")
+
+
+@pytest.mark.parametrize("url", [PAGE, HTML])
+def test_render_cache(url, monkeypatch):
+    first = open_renderer(url)
+    body = first.display(mode="readable")
+    links = first.get_links(mode="readable")
+    monkeypatch.setattr(ansicat.GemtextRenderer, "model", no_rendering)
+    monkeypatch.setattr(ansicat.HtmlRenderer, "model", no_rendering)
+    monkeypatch.setattr(ansicat.HtmlRenderer, "get_title", no_rendering)
+    second = open_renderer(url)
+    assert second.display(mode="readable") == body
+    assert second.get_links(mode="readable") == links
+    # Another width is another rendering
+    with pytest.raises(AssertionError):
+        second.get_body(width=30, mode="full")
+
+
+def test_render_cache_invalidation(cache, monkeypatch):
+    open_renderer(PAGE).get_body(mode="readable")
+    assert len(list((cache / "rendered").glob("*/*.json"))) == 1
+    # The rendering depends on the options…
+    open_renderer(PAGE, gemini_images=False).get_body(mode="readable")
+    assert len(list((cache / "rendered").glob("*/*.json"))) == 2
+    # …and on the cache of the links
+    with monkeypatch.context() as m:
+        m.setattr(ansicat.GemtextRenderer, "model", no_rendering)
+        open_renderer(PAGE).get_body(mode="readable")
+        netcache.write_body(PAGE + "other.gmi", "# Other\n", "text/gemini")
+        with pytest.raises(AssertionError):
+            open_renderer(PAGE).get_body(mode="readable")
+    # Nothing is written without the option
+    renderer = ansicat.renderer_from_file(netcache.get_cache_path(PAGE), url=PAGE)
+    renderer.get_body(mode="full")
+    assert len(list((cache / "rendered").glob("*/*.json"))) == 2
+
+
+def test_prune_render_cache(cache):
+    open_renderer(PAGE).get_body(mode="readable")
+    open_renderer(HTML).get_body(mode="readable")
+    old, recent = sorted((cache / "rendered").glob("*/*.json"))
+    os.utime(old, (time.time() - 3600, time.time() - 3600))
+    assert ansicat.prune_render_cache(max_age=60) == 1
+    assert not old.exists() and recent.exists()
+
+
+def test_prune_render_cache_size(cache):
+    open_renderer(PAGE).get_body(mode="readable")
+    page, = (cache / "rendered").glob("*/*.json")
+    open_renderer(HTML).get_body(mode="readable")
+    html, = set((cache / "rendered").glob("*/*.json")) - {page}
+    os.utime(html, (time.time() - 60, time.time() - 60))
+    os.utime(page, (time.time() - 120, time.time() - 120))
+    # Reading a rendering is a use: the page is now the most recent one
+    open_renderer(PAGE).get_body(mode="readable")
+    max_size = max(page.stat().st_size, html.stat().st_size)
+    assert ansicat.prune_render_cache(max_size=max_size) == 1
+    assert page.exists() and not html.exists()
@@ -0,0 +1,13 @@
+import ansicat
+from corpus import corpus
+
+
+# A small version of the benchmark corpus is rendered by every renderer
+def test_render_corpus():
+    docs = corpus(scale=0.02)
+    assert docs == corpus(scale=0.02)
+    for name, (mime, url, content) in docs.items():
+        for width in [40, 120]:
+            renderer = ansicat.set_renderer(content, url, mime)
+            assert renderer.get_body(width=width, mode="readable")
+            assert renderer.get_links(mode="readable") or name == "plaintext"
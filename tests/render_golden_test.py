@@ -0,0 +1,135 @@
+# The rendered output of small documents is compared, byte for byte, with
+# the files in tests/golden/. If a change of the rendering is intended,
+# the files can be regenerated with:
+#   python tests/render_golden_test.py --update
+import os
+import random
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+import ansicat  # noqa: E402
+import corpus  # noqa: E402
+import offutils  # noqa: E402
+
+GOLDEN_DIR = os.path.join(TESTS_DIR, "golden")
+WIDTHS = [40, 72]
+# Enough columns for a centering margin
+COLUMNS = 100
+
+TRICKY_HTML = """<html><head><title>A title which is long enough to be wrapped on small screens</title></head>
+<body><article><h1>Colors across wrapped lines</h1>
+<p>Some <b>bold text which goes on and on, <i>italic inside bold, <a href="/x">a link
+inside italic inside bold</a></i> and back to bold</b> then normal text that is long
+enough to be wrapped several times at every width we test.</p>
+<blockquote><p>A quote with <code>some code</code> and a <a href="https://example.org/a/very/long/url">very
+long link label that wraps</a>.</p><blockquote><p>Nested quote, nested quote, nested quote,
+nested quote, nested quote.</p></blockquote></blockquote>
+<ul><li>First item with enough words to need a second line at forty columns.</li>
+<li>Second <em>item</em><ul><li>Nested item, nested item, nested item, nested item.</li></ul></li></ul>
+<ol><li>One</li><li>Two <strong>strong</strong></li></ol>
+<pre>  preformatted   text
+    keeps   its spaces and is not wrapped even if it is much longer than the width of the page</pre>
+<h2>Second   heading</h2><h3>Third</h3><h4>Fourth</h4>
+<p>   Leading spaces, <span>spans</span>, entities &amp; &lt;tags&gt; &eacute;t&eacute;.</p>
+<table><tr><td>cell one</td><td>cell two</td></tr></table>
+<img src="/img/missing.png" alt="an image which is not in the cache">
+<video src="/video.mp4" poster="/poster.png"></video>
+<p><a href="gemini://example.org/">gemini link</a> <a href="#anchor">anchor</a></p>
+<div><div><p>Deep <sup>sup</sup> <sub>sub</sub> <del>deleted</del> <u>under</u></p></div></div>
+</article></body></html>
+"""
+
+
+def documents():
+    def rng(name):
+        return random.Random("golden-" + name)
+
+    return {
+        "gemtext": ("text/gemini", "gemini://example.org/index.gmi",
+                    corpus.gemtext(rng("gemtext"), links=60)),
+        "html": ("text/html", "https://example.org/article.html",
+                 corpus.html(rng("html"), depth=3, sections=1)),
+        "tricky": ("text/html", "https://example.org/tricky.html", TRICKY_HTML),
+        "gophermap": ("text/gopher", "gopher://example.org/1/",
+                      corpus.gophermap(rng("gophermap"), lines=80)),
+        "rss": ("application/rss+xml", "https://example.org/feed.xml",
+                corpus.rss(rng("rss"), items=6)),
+        "atom": ("application/atom+xml", "gemini://example.org/atom.xml",
+                 corpus.atom(rng("atom"), entries=6)),
+        "plaintext": ("text/plain", "gemini://example.org/notes.txt",
+                      corpus.plaintext(rng("plaintext"), lines=80)),
+    }
+
+
+MODES = {
+    "html": ["readable", "full", "links_only"],
+    "tricky": ["readable", "full", "links_only"],
+    "rss": ["readable", "full"],
+    "atom": ["readable", "full"],
+}
+CASES = [(name, mode, width) for name in documents()
+         for mode in MODES.get(name, ["readable"]) for width in WIDTHS]
+
+
+def render(name, mode, width):
+    mime, url, content = documents()[name]
+    offutils.term_width(new_width=width)
+    renderer = ansicat.set_renderer(content, url, mime)
+    body = renderer.get_body(width=width, mode=mode)
+    links = "\n".join(renderer.get_links(mode=mode))
+    return body + "\n----- links -----\n" + links + "\n"
+
+
+def golden_path(name, mode, width):
+    return os.path.join(GOLDEN_DIR, "%s-%s-%s.txt" % (name, mode, width))
+
+
+@pytest.mark.parametrize("name,mode,width", CASES)
+def test_golden(name, mode, width, monkeypatch):
+    monkeypatch.setenv("COLUMNS", str(COLUMNS))
+    with open(golden_path(name, mode, width), encoding="utf-8", newline="") as f:
+        expected = f.read()
+    assert render(name, mode, width) == expected
+
+
+# The text given to stream() while rendering is the same, in several parts
+# (links_only modes have no text)
+@pytest.mark.parametrize("name,mode,width", [c for c in CASES if c[1] != "links_only"])
+def test_stream(name, mode, width, monkeypatch):
+    monkeypatch.setenv("COLUMNS", str(COLUMNS))
+    # small parts, so that the longest documents are in several of them
+    monkeypatch.setattr(ansicat.AbstractRenderer.representation, "_endline",
+                        _small_parts(ansicat.AbstractRenderer.representation._endline))
+    mime, url, content = documents()[name]
+    offutils.term_width(new_width=width)
+    renderer = ansicat.set_renderer(content, url, mime)
+    parts = []
+    renderer.stream = parts.append
+    body = renderer.get_body(width=width, mode=mode)
+    renderer.stream = None
+    with open(golden_path(name, mode, width), encoding="utf-8", newline="") as f:
+        expected = f.read()
+    assert expected.startswith(body + "\n----- links -----\n")
+    assert "".join(parts) == body
+    assert len(parts) > 2
+
+
+def _small_parts(endline):
+    def _endline(self):
+        endline(self)
+        if self.stream and len(self.final_text) > 10:
+            self._flush()
+    return _endline
+
+
+if __name__ == "__main__" and "--update" in sys.argv:
+    os.environ["COLUMNS"] = str(COLUMNS)
+    os.makedirs(GOLDEN_DIR, exist_ok=True)
+    for case in CASES:
+        with open(golden_path(*case), "w", encoding="utf-8", newline="") as f:
+            f.write(render(*case))
+    print("%s golden files written in %s" % (len(CASES), GOLDEN_DIR))
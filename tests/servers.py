@@ -0,0 +1,306 @@
+# Local stand-ins for the servers netcache talks to, so fetching can be
+# tested and benchmarked without network: Gemini (with a self-signed
+# certificate), Gopher, Spartan, Finger and HTTP (fetched with curl).
+#
+# All of them serve the same generated site:
+#   /              index linking to every page
+#   /page/N        a page with some text and links to other pages
+#   /big/N         a document of N bytes
+#   /redirect/N    redirects N times, then to /page/0
+#   /slowdown      "44 SLOW DOWN" (gemini) or 429 (http)
+#   /notfound      "51 Not found" (gemini), 404 (http) or an error (gopher…)
+#
+#     site = Site(pages=50, links=5, latency=0.01, error_rate=0.1)
+#     with LocalServers(site) as servers:
+#         url = servers.url("gemini", "/page/3")
+#
+# latency is added before each answer, error_rate is the part of pages
+# returning an error (always the same ones for a given seed). site.hits
+# counts the requests received for each path.
+
+import datetime
+import http.server
+import ipaddress
+import os
+import random
+import socketserver
+import ssl
+import tempfile
+import threading
+import time
+import urllib.parse
+
+PROTOCOLS = ["gemini", "gopher", "spartan", "finger", "http"]
+
+
+class Site:
+    def __init__(self, pages=100, links=10, page_size=2000, latency=0.0, error_rate=0.0, seed=1):
+        self.pages = pages
+        self.links = links
+        self.page_size = page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.seed = seed
+        self.hits = {}
+        self._lock = threading.Lock()
+
+    def hit(self, path):
+        with self._lock:
+            self.hits[path] = self.hits.get(path, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    # Return (kind, value) for a path:
+    # ("page", (title, text, [linked paths])), ("redirect", path),
+    # ("slowdown", None), ("error", message), ("notfound", None)
+    def resolve(self, path):
+        self.hit(path)
+        parts = path.strip("/").split("/")
+        if path.strip("/") == "":
+            return "page", ("Index", "Welcome on this test site.",
+                            ["/page/%s" % i for i in range(self.pages)])
+        elif len(parts) == 2 and parts[1].isdigit():
+            n = int(parts[1])
+            if parts[0] == "page" and n < self.pages:
+                rng = random.Random("%s-%s" % (self.seed, n))
+                if rng.random() < self.error_rate:
+                    return "error", "Injected error on page %s" % n
+                text = ("Page %s. " % n + "Lorem ipsum dolor sit amet. " * 40)
+                text = (text * (self.page_size // len(text) + 1))[: self.page_size]
+                links = ["/page/%s" % rng.randrange(self.pages) for _ in range(self.links)]
+                return "page", ("Page %s" % n, text, links)
+            elif parts[0] == "big":
+                return "page", ("Big", ("0123456789" * (n // 10 + 1))[:n], [])
+            elif parts[0] == "redirect":
+                if n <= 0:
+                    return "redirect", "/page/0"
+                return "redirect", "/redirect/%s" % (n - 1)
+        elif path.strip("/") == "slowdown":
+            return "slowdown", None
+        return "notfound", None
+
+
+def gemtext(title, text, links):
+    lines = ["# " + title, "", text, ""]
+    lines += ["=> %s %s" % (link, link.strip("/").replace("/", " ")) for link in links]
+    return "\n".join(lines) + "\n"
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.site = self.server.site
+        self.port = self.server.server_address[1]
+
+
+class GeminiHandler(_Handler):
+    def handle(self):
+        request = self.rfile.readline(1027).decode("UTF-8").strip()
+        kind, value = self.site.resolve(urllib.parse.urlparse(request).path)
+        if kind == "page":
+            answer = "20 text/gemini\r\n" + gemtext(*value)
+        elif kind == "redirect":
+            answer = "31 %s\r\n" % value
+        elif kind == "slowdown":
+            answer = "44 5\r\n"
+        elif kind == "error":
+            answer = "40 %s\r\n" % value
+        else:
+            answer = "51 Not found\r\n"
+        self.wfile.write(answer.encode("UTF-8"))
+
+
+class SpartanHandler(_Handler):
+    def handle(self):
+        host, path, length = self.rfile.readline(4096).decode("ascii").split()
+        if int(length):
+            self.rfile.read(int(length))
+        kind, value = self.site.resolve(urllib.parse.unquote(path))
+        if kind == "page":
+            answer = "2 text/gemini\r\n" + gemtext(*value)
+        elif kind == "redirect":
+            answer = "3 %s\r\n" % value
+        elif kind == "error":
+            answer = "5 %s\r\n" % value
+        else:
+            answer = "4 Not found\r\n"
+        self.wfile.write(answer.encode("UTF-8"))
+
+
+class GopherHandler(_Handler):
+    def handle(self):
+        selector = self.rfile.readline(4096).decode("UTF-8").strip("\r\n").split("\t")[0]
+        kind, value = self.site.resolve(selector or "/")
+        lines = []
+        if kind == "page":
+            title, text, links = value
+            lines.append("i%s\t\tnull.host\t1" % title)
+            for i in range(0, len(text), 70):
+                lines.append("i%s\t\tnull.host\t1" % text[i:i + 70])
+            for link in links:
+                lines.append("1%s\t%s\t127.0.0.1\t%s" % (link.strip("/"), link, self.port))
+        elif kind == "redirect":
+            # No redirections in gopher: a link to follow
+            lines.append("1Moved\t%s\t127.0.0.1\t%s" % (value, self.port))
+        else:
+            lines.append("3%s\t\terror.host\t1" % (value or "Not found"))
+        self.wfile.write(("\r\n".join(lines) + "\r\n.\r\n").encode("UTF-8"))
+
+
+class FingerHandler(_Handler):
+    def handle(self):
+        query = self.rfile.readline(4096).decode("UTF-8").strip()
+        kind, value = self.site.resolve("/" + query)
+        if kind == "page":
+            title, text, links = value
+            answer = "%s\n\n%s\n" % (title, text)
+        else:
+            answer = "finger: %s: no such user.\n" % query
+        self.wfile.write(answer.encode("UTF-8"))
+
+
+class HttpHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.0"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        kind, value = self.server.site.resolve(urllib.parse.urlparse(self.path).path)
+        if kind == "page" and self.headers.get("If-Modified-Since"):
+            # pages never change: answer to conditional requests with a 304
+            self.send_response(304)
+            self.end_headers()
+        elif kind == "page":
+            title, text, links = value
+            # links are in the text, readability would remove a list of links
+            related = ", ".join('<a href="%s">%s</a>' % (link, link) for link in links)
+            self.answer(200, "<html><head><title>%s</title></head><body><article><h1>%s</h1>"
+                             "<p>%s</p><p>Related pages: %s.</p></article></body></html>"
+                        % (title, title, text, related))
+        elif kind == "redirect":
+            self.send_response(301)
+            self.send_header("Location", value)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif kind == "slowdown":
+            self.answer(429, "<html><body>Too many requests</body></html>")
+        elif kind == "error":
+            self.answer(500, "<html><body>%s</body></html>" % value)
+        else:
+            self.answer(404, "<html><body>Not found</body></html>")
+
+    def answer(self, code, body):
+        body = body.encode("UTF-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Last-Modified", "Thu, 01 Jan 2015 00:00:00 GMT")
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _HTTPServer(http.server.ThreadingHTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128
+
+
+# A self-signed certificate for 127.0.0.1/localhost, valid for one day
+def self_signed_certificate(folder):
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(hours=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([
+            x509.DNSName("localhost"),
+            x509.DNSName("127.0.0.1"),
+            x509.IPAddress(ipaddress.ip_address("127.0.0.1")),
+        ]), critical=False)
+        .sign(key, hashes.SHA256())
+    )
+    certfile = os.path.join(folder, "server.crt")
+    keyfile = os.path.join(folder, "server.key")
+    with open(certfile, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(keyfile, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM,
+                                  serialization.PrivateFormat.TraditionalOpenSSL,
+                                  serialization.NoEncryption()))
+    return certfile, keyfile
+
+
+class LocalServers:
+    def __init__(self, site=None, protocols=PROTOCOLS):
+        self.site = site or Site()
+        self.protocols = protocols
+        self.servers = {}
+        self.ports = {}
+        self._tmpdir = None
+
+    def start(self):
+        handlers = {
+            "gemini": GeminiHandler,
+            "gopher": GopherHandler,
+            "spartan": SpartanHandler,
+            "finger": FingerHandler,
+        }
+        for protocol in self.protocols:
+            if protocol == "http":
+                server = _HTTPServer(("127.0.0.1", 0), HttpHandler)
+            else:
+                server = _TCPServer(("127.0.0.1", 0), handlers[protocol], bind_and_activate=True)
+            if protocol == "gemini":
+                self._tmpdir = tempfile.TemporaryDirectory(prefix="offpunk-servers-")
+                context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+                context.load_cert_chain(*self_signed_certificate(self._tmpdir.name))
+                # The handshake is done in the thread handling the request
+                server.socket = context.wrap_socket(server.socket, server_side=True,
+                                                    do_handshake_on_connect=False)
+            server.site = self.site
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            self.servers[protocol] = server
+            self.ports[protocol] = server.server_address[1]
+        return self
+
+    def stop(self):
+        for server in self.servers.values():
+            server.shutdown()
+            server.server_close()
+        self.servers = {}
+        if self._tmpdir:
+            self._tmpdir.cleanup()
+            self._tmpdir = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def url(self, protocol, path="/"):
+        base = "%s://127.0.0.1:%s" % (protocol, self.ports[protocol])
+        if protocol == "gopher":
+            return base + "/1" + path
+        elif protocol == "finger":
+            return base + "/" + path.strip("/")
+        return base + path
@@ -0,0 +1,42 @@
+import json
+
+from offpunk import SyncMetrics
+
+
+def test_sync_metrics(tmp_path):
+    page = tmp_path / "page"
+    page.write_text("hello")
+    metrics = SyncMetrics()
+    metrics.current_list = "subscribed"
+    metrics.add_fetch("gemini://a.org/", {"status": "fetched", "path": str(page), "bytes": 5},
+                      0.5, True)
+    # a 304: nothing was downloaded
+    metrics.add_fetch("gemini://a.org/b", {"status": "fetched", "path": str(page), "bytes": 0,
+                                           "unchanged": True}, 0.5, False)
+    metrics.add_tour_item("gemini://a.org/")
+    metrics.current_list = "bookmarks"
+    metrics.add_fetch("https://b.org/", {"status": "error", "error_class": "dns"}, 0.1, True)
+    metrics.add_cached("gemini://a.org/")
+    metrics.stop()
+    metrics.write(str(tmp_path / "metrics.json"))
+    data = json.loads((tmp_path / "metrics.json").read_text())
+    assert data["total"]["urls"] == 4
+    assert data["total"]["unchanged"] == 1 and data["total"]["refreshed"] == 0
+    assert data["lists"]["subscribed"]["new_tour_items"] == 1
+    assert data["protocols"]["gemini"]["bytes"] == 5
+    assert data["protocols"]["gemini"]["latency"]["p50"] == 0.5
+    assert data["protocols"]["https"]["latency"]["p50"] is None
+    assert data["errors"] == {"dns": 1}
+    assert data["errors_by_host"] == {"b.org": 1}
+    metrics.write(str(tmp_path / "metrics.prom"))
+    prom = (tmp_path / "metrics.prom").read_text()
+    assert 'offpunk_sync_errors_by_class{class="dns"} 1\n' in prom
+    assert 'offpunk_sync_fetch_latency_seconds{protocol="gemini",quantile="0.9"} 0.5\n' in prom
+    assert "# TYPE offpunk_sync_fetch_latency_seconds summary\n" in prom
+    assert 'offpunk_sync_fetch_latency_seconds_count{protocol="gemini"} 2\n' in prom
+    assert prom.endswith("# EOF\n")
+
+
+def test_percentiles():
+    values = [i / 100 for i in range(1, 101)]
+    assert SyncMetrics.percentiles(values) == {"p50": 0.5, "p90": 0.9, "p99": 0.99}